@@ -0,0 +1,19 @@
+"""Load the agent scripts as modules so benchmarks exercise the shipped code paths"""
+import importlib.util, os, sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AGENTS = {
+    "ffmpeg_monitor": os.path.join(REPO_ROOT, "ffmpeg", "ffmpeg_monitor.py"),
+    "npm_monitor": os.path.join(REPO_ROOT, "nginx-reverse-proxy", "npm_monitor.py"),
+    "agent_updater": os.path.join(REPO_ROOT, "update_agent", "agent_updater.py"),
+}
+
+def load_agent(name):
+    """Import an agent without running its main loop (module-level config and logging still apply)"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, AGENTS[name])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
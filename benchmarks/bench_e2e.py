@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark: runs npm_monitor.py or ffmpeg_monitor.py as a real process against generated load and a
+fake Graylog, reporting delivered lines/sec, line-to-sink latency, agent CPU and RSS"""
+import argparse, json, os, random, subprocess, sys, tempfile, threading, time
+import psutil
+from _agents import AGENTS
+from fake_graylog import FakeGraylog, percentile
+from npm_loadgen import access_line
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+class ResourceMonitor:
+    """Agent CPU time and peak RSS over the measured window"""
+    def __init__(self, pid, interval=0.25):
+        self.proc = psutil.Process(pid)
+        self.interval = interval
+        self.peak_rss = 0
+        self.stop_event = threading.Event()
+
+    def _cpu(self):
+        t = self.proc.cpu_times()
+        return t.user + t.system
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.peak_rss = max(self.peak_rss, self.proc.memory_info().rss)
+            except psutil.Error:
+                return
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        self.cpu_start = self._cpu()
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def stop(self):
+        """CPU seconds used since start()"""
+        self.stop_event.set()
+        return self._cpu() - self.cpu_start
+
+def write_config(path, sections):
+    with open(path, "w") as f:
+        for section, values in sections.items():
+            f.write(f"[{section}]\n")
+            f.writelines(f"{key} = {value}\n" for key, value in values.items())
+            f.write("\n")
+
+def apply_overrides(sections, overrides):
+    """--set section.key=value, applied on top of the benchmark's config"""
+    for item in overrides:
+        name, _, value = item.partition("=")
+        section, _, key = name.partition(".")
+        sections.setdefault(section, {})[key] = value
+
+def launch_agent(name, workdir, sections):
+    config, log = os.path.join(workdir, f"{name}.conf"), os.path.join(workdir, f"{name}.log")
+    write_config(config, sections)
+    env = dict(os.environ, **{f"{name.upper()}_CONFIG": config, f"{name.upper()}_LOG": log})
+    return subprocess.Popen([sys.executable, AGENTS[name]], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+def wait_for(condition, timeout, what, agent, workdir, name, tick=None):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if agent.poll() is not None or time.monotonic() > deadline:
+            log = os.path.join(workdir, f"{name}.log")
+            tail = open(log).read()[-2000:] if os.path.exists(log) else ""
+            sys.exit(f"Timed out waiting for {what}; agent log:\n{tail}")
+        if tick: tick()
+        time.sleep(0.2)
+
+def drain(sink, expected, timeout):
+    """Wait until every line arrived, or nothing arrived for timeout seconds"""
+    started = time.monotonic()
+    while sink.received() < expected:
+        if time.monotonic() - max(sink.last_arrival, started) > timeout: break
+        time.sleep(0.1)
+
+def base_sections(args, sink, workdir):
+    return {
+        "graylog": {"host": "127.0.0.1", "port": sink.port, "protocol": args.protocol, "format": args.format,
+                    "source": "bench", "stats_interval": 0},
+        "spool": {"dir": os.path.join(workdir, "spool")},
+        "metrics": {"enabled": "false", "stats_interval": 0},
+    }
+
+def run_npm(args, sink, workdir):
+    log_dir = os.path.join(workdir, "logs")
+    os.makedirs(log_dir)
+    probe_log = os.path.join(log_dir, "proxy-host-1_access.log")
+    def probe():
+        with open(probe_log, "a") as f:
+            f.write(access_line(random.Random(), "/bench-probe", time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime())))
+    sections = base_sections(args, sink, workdir)
+    sections["general"] = {"log_dir": log_dir, "checkpoint_file": os.path.join(workdir, "offsets.json"),
+                           "handoff_file": os.path.join(workdir, "handoff.json")}
+    apply_overrides(sections, args.set)
+    agent = launch_agent("npm_monitor", workdir, sections)
+    wait_for(lambda: sink.probes, 30, "the first probe line", agent, workdir, "npm_monitor", probe)
+
+    # The generator gets its own process so it does not compete with the sink for the GIL
+    monitor = ResourceMonitor(agent.pid).start()
+    start = time.monotonic()
+    gen = subprocess.run([sys.executable, os.path.join(HERE, "npm_loadgen.py"), log_dir, "--rate", str(args.rate),
+                          "--hosts", str(args.hosts), "--error-ratio", str(args.error_ratio), "--seconds", str(args.seconds)],
+                         capture_output=True, text=True, check=True)
+    expected = int(gen.stdout.split()[0])
+    drain(sink, expected, args.drain_timeout)
+    return agent, monitor, start, expected
+
+def run_ffmpeg(args, sink, workdir):
+    # Process discovery matches the executable name, so the fake runs as a python named ffmpeg
+    bin_dir = os.path.join(workdir, "bin")
+    os.makedirs(bin_dir)
+    ffmpeg = os.path.join(bin_dir, "ffmpeg")
+    os.symlink(os.path.realpath(sys.executable), ffmpeg)
+    sections = base_sections(args, sink, workdir)
+    sections["general"] = {"interval": args.interval, "handoff_file": os.path.join(workdir, "handoff.json")}
+    sections["modules"] = {"stderr_monitor": "true", "gpu_monitor": "false", "issue_tracker": "true"}
+    sections["discovery"] = {"method": args.discovery, "process_name": "ffmpeg"}
+    apply_overrides(sections, args.set)
+    agent = launch_agent("ffmpeg_monitor", workdir, sections)
+
+    go_file = os.path.join(workdir, "go")
+    procs = []
+    for stream in range(args.processes):
+        stderr = open(os.path.join(workdir, f"stderr-{stream}.log"), "w")
+        procs.append(subprocess.Popen(
+            [ffmpeg, os.path.join(HERE, "fake_ffmpeg.py"), "--stream", str(stream), "--rate", str(args.rate / args.processes),
+             "--noise", str(args.noise), "--seconds", str(args.seconds), "--go-file", go_file,
+             "--linger", str(args.drain_timeout + 2)],
+            stdout=subprocess.PIPE, stderr=stderr, text=True))
+    wait_for(lambda: len(sink.probes) == args.processes, 60, "probe lines from every process", agent, workdir,
+             "ffmpeg_monitor")
+
+    monitor = ResourceMonitor(agent.pid).start()
+    start = time.monotonic()
+    open(go_file, "w").close()
+    expected = sum(int(p.stdout.readline()) for p in procs)
+    drain(sink, expected, args.drain_timeout)
+    for p in procs: p.terminate()
+    return agent, monitor, start, expected
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("agent", choices=["npm", "ffmpeg"])
+    ap.add_argument("--rate", type=float, default=2000, help="lines/sec offered (raise it until delivered lines/sec stops following)")
+    ap.add_argument("--seconds", type=float, default=20)
+    ap.add_argument("--protocol", choices=["tcp", "udp"], default="tcp")
+    ap.add_argument("--format", choices=["syslog", "gelf"], default="syslog")
+    ap.add_argument("--hosts", type=int, default=8, help="npm: proxy hosts (one access and one error log each)")
+    ap.add_argument("--error-ratio", type=float, default=0.05, help="npm: share of lines written to error logs")
+    ap.add_argument("--processes", type=int, default=4, help="ffmpeg: synthetic ffmpeg processes")
+    ap.add_argument("--noise", type=int, default=4, help="ffmpeg: non-matching stderr lines per matching line")
+    ap.add_argument("--interval", type=int, default=1, help="ffmpeg: [general] interval")
+    ap.add_argument("--discovery", default="auto", help="ffmpeg: [discovery] method")
+    ap.add_argument("--drain-timeout", type=float, default=10, help="give up this long after the last arrival")
+    ap.add_argument("--set", action="append", default=[], metavar="SECTION.KEY=VALUE", help="extra agent config")
+    ap.add_argument("--json", action="store_true", help="print one JSON result line for regression tracking")
+    args = ap.parse_args()
+
+    sink = FakeGraylog(args.protocol).start()
+    name = f"{args.agent}_monitor"
+    with tempfile.TemporaryDirectory(prefix="agent_bench_") as workdir:
+        agent, monitor, start, expected = (run_npm if args.agent == "npm" else run_ffmpeg)(args, sink, workdir)
+        cpu_seconds = monitor.stop()
+        agent.terminate()
+        agent.wait(10)
+
+    received = sink.received()
+    elapsed = max(sink.last_arrival - start, 1e-9)
+    lat = sink.latencies()
+    result = {
+        "agent": name, "protocol": args.protocol, "format": args.format, "offered_rate": args.rate,
+        "written": expected, "received": received, "lost": expected - received, "duplicates": sink.duplicates,
+        "lines_per_sec": round(received / elapsed, 1),
+        "latency_p50_ms": round(percentile(lat, 0.5) * 1000, 2), "latency_p99_ms": round(percentile(lat, 0.99) * 1000, 2),
+        "latency_max_ms": round(lat[-1] * 1000, 2) if lat else 0.0,
+        "cpu_percent": round(100 * cpu_seconds / elapsed, 1),
+        "cpu_ms_per_1k_lines": round(1e6 * cpu_seconds / received, 2) if received else 0.0,
+        "rss_peak_mb": round(monitor.peak_rss / 1048576, 1),
+    }
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(f"{name} {args.protocol}/{args.format}, offered {args.rate:,.0f} lines/sec for {args.seconds:g}s")
+        print(f"  delivered  {received:,} of {expected:,} lines ({result['lost']:,} lost, {sink.duplicates} duplicates), "
+              f"{result['lines_per_sec']:,.0f} lines/sec end to end")
+        print(f"  latency    p50={result['latency_p50_ms']}ms p99={result['latency_p99_ms']}ms max={result['latency_max_ms']}ms "
+              f"(line written -> received by the sink)")
+        print(f"  agent      CPU {result['cpu_percent']}% of one core ({result['cpu_ms_per_1k_lines']}ms per 1k lines), "
+              f"peak RSS {result['rss_peak_mb']} MB")
+        if result["lost"]:
+            print("  lost lines were not delivered within --drain-timeout; past the agent's capacity that is usually the "
+                  "send queue overflow policy (enable [metrics] with --set to see queue_dropped_total)")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Checks the FFmpeg GPU monitor against a fake NVML: two devices, per-process utilization, a process with compute
+and graphics contexts, one spread over both GPUs and a query one board does not support; asserts
+GpuSampler.sample(), the gpu_stats events and the per-TID GPU summary"""
+import argparse, collections, datetime, threading, time
+from _agents import load_agent
+
+MB = 1024 * 1024
+Utilization = collections.namedtuple("Utilization", "gpu memory")
+Memory = collections.namedtuple("Memory", "total free used")
+RunningProcess = collections.namedtuple("RunningProcess", "pid usedGpuMemory")
+ProcessSample = collections.namedtuple("ProcessSample", "pid timeStamp smUtil memUtil encUtil decUtil")
+
+class FakeNvml:
+    """The slice of the pynvml API the agent uses. Device 1 has no NVDEC counter, like some boards and drivers.
+    pid 101 has compute and graphics contexts ("C+G"), which NVML lists twice with the same memory; pid 301
+    runs on both devices."""
+    class NVMLError(Exception):
+        pass
+
+    def __init__(self):
+        self.clock = 1000   # NVML timestamps are microseconds
+        self.devices = [
+            {"util": Utilization(70, 30), "mem": Memory(8192 * MB, 2048 * MB, 6144 * MB), "enc": 40, "dec": 25,
+             "compute": [RunningProcess(101, 512 * MB), RunningProcess(301, 100 * MB)],
+             "graphics": [RunningProcess(101, 512 * MB), RunningProcess(102, None)], "samples": []},
+            {"util": Utilization(15, 5), "mem": Memory(16384 * MB, 15360 * MB, 1024 * MB), "enc": 10, "dec": None,
+             "compute": [RunningProcess(201, 1024 * MB), RunningProcess(301, 300 * MB)], "graphics": [], "samples": []},
+        ]
+
+    def tick(self, samples):
+        """New per-process samples ([(pid, device, sm, enc, dec)]), stamped after everything so far"""
+        self.clock += 1000
+        for pid, idx, sm, enc, dec in samples:
+            self.devices[idx]["samples"].append(ProcessSample(pid, self.clock, sm, 0, enc, dec))
+        for device in self.devices:
+            del device["samples"][:-16]   # the driver's sample buffer is small too
+
+    def nvmlInit(self): pass
+    def nvmlDeviceGetCount(self): return len(self.devices)
+    def nvmlDeviceGetHandleByIndex(self, i): return self.devices[i]
+    def nvmlDeviceGetUtilizationRates(self, h): return h["util"]
+    def nvmlDeviceGetMemoryInfo(self, h): return h["mem"]
+    def nvmlDeviceGetEncoderUtilization(self, h): return (h["enc"], 167000)
+    def nvmlDeviceGetComputeRunningProcesses(self, h): return list(h["compute"])
+    def nvmlDeviceGetGraphicsRunningProcesses(self, h): return list(h["graphics"])
+
+    def nvmlDeviceGetDecoderUtilization(self, h):
+        if h["dec"] is None: raise self.NVMLError("Not Supported")
+        return (h["dec"], 167000)
+
+    def nvmlDeviceGetProcessUtilization(self, h, last_seen):
+        # Like NVML: only samples newer than last_seen, and an error when there are none
+        fresh = [s for s in h["samples"] if s.timeStamp > last_seen]
+        if not fresh: raise self.NVMLError("Not Found")
+        return fresh
+
+def check_sampler(agent):
+    nvml = FakeNvml()
+    sampler = agent.GpuSampler(nvml)
+    nvml.tick([(101, 0, 60, 35, 20), (201, 1, 10, 8, 0), (301, 0, 20, 5, 5), (301, 1, 70, 30, 15)])
+    devices, procs = sampler.sample()
+
+    assert devices == [
+        {"gpu_index": 0, "gpu_util_percent": 70, "mem_used_mb": 6144, "mem_total_mb": 8192,
+         "encoder_util_percent": 40, "decoder_util_percent": 25},
+        {"gpu_index": 1, "gpu_util_percent": 15, "mem_used_mb": 1024, "mem_total_mb": 16384,
+         "encoder_util_percent": 10, "decoder_util_percent": None},   # unsupported query, not an error
+    ], devices
+    assert procs == {
+        101: {"gpu_index": 0, "gpu_mem_mb": 512, "gpu_sm_percent": 60, "gpu_enc_percent": 35, "gpu_dec_percent": 20},
+        102: {"gpu_index": 0, "gpu_mem_mb": 0},   # usedGpuMemory unavailable, no utilization sample yet
+        201: {"gpu_index": 1, "gpu_mem_mb": 1024, "gpu_sm_percent": 10, "gpu_enc_percent": 8, "gpu_dec_percent": 0},
+        # Memory over both GPUs; index and utilization both from the busier one
+        301: {"gpu_index": 1, "gpu_mem_mb": 400, "gpu_sm_percent": 70, "gpu_enc_percent": 30, "gpu_dec_percent": 15},
+    }, procs
+
+    # Only samples newer than the last tick count; no new samples leaves the utilization fields out
+    nvml.tick([(101, 0, 80, 45, 30)])
+    _, procs = sampler.sample()
+    assert procs[101]["gpu_sm_percent"] == 80 and "gpu_sm_percent" not in procs[201], procs
+    _, procs = sampler.sample()
+    assert "gpu_sm_percent" not in procs[101], procs
+    return nvml
+
+def check_loop_and_summary(agent, nvml, interval):
+    """gpu_loop publishes per-PID samples and gpu_stats events; the per-TID stats carry them into the summary"""
+    events = []
+    agent.send_to_graylog = events.append
+    agent.GPU_INTERVAL = interval
+    threading.Thread(target=agent.gpu_loop, args=(nvml,), daemon=True).start()
+
+    stats = {"pid": 101, "start_time": datetime.datetime.now(agent.tz),
+             "cpu": agent.StreamingStats(), "ram": agent.StreamingStats()}
+    for sm in (50, 70, 90):
+        nvml.tick([(101, 0, sm, sm // 2, 10)])
+        deadline = time.monotonic() + 5
+        while True:
+            gpu = agent.gpu_sample_for(101)
+            if gpu and gpu.get("gpu_sm_percent") == sm: break
+            assert time.monotonic() < deadline, f"gpu_loop never published the sm={sm} sample: {gpu}"
+            time.sleep(interval / 5)
+        agent.record_gpu_sample(stats, gpu)
+    assert agent.gpu_sample_for(999) is None
+
+    summary = agent.gpu_summary(stats)
+    assert summary["gpu_index"] == 0, summary
+    assert summary["gpu_sm_avg_percent"] == 70 and summary["gpu_sm_max_percent"] == 90, summary
+    assert summary["gpu_enc_avg_percent"] == 35 and summary["gpu_enc_max_percent"] == 45, summary
+    assert summary["gpu_dec_avg_percent"] == 10 and summary["gpu_mem_max_mb"] == 512, summary
+    assert agent.gpu_summary({}) == {}
+
+    stats_events = [e for e in events if e.get("event") == "gpu_stats"]
+    assert stats_events and {e["gpu_index"] for e in stats_events} == {0, 1}, events
+    assert all(e["decoder_util_percent"] is None for e in stats_events if e["gpu_index"] == 1)
+    return summary, len(stats_events)
+
+def time_sample(agent, rounds):
+    nvml = FakeNvml()
+    sampler = agent.GpuSampler(nvml)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        nvml.tick([(101, 0, 50, 20, 10), (201, 1, 30, 10, 0)])
+        sampler.sample()
+    return (time.perf_counter() - start) / rounds
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--interval", type=float, default=0.05, help="gpu_loop interval while checking (seconds)")
+    ap.add_argument("--rounds", type=int, default=2000, help="sample() calls to time against the fake")
+    args = ap.parse_args()
+
+    agent = load_agent("ffmpeg_monitor")
+    per_sample = time_sample(agent, args.rounds)
+    nvml = check_sampler(agent)
+    summary, events = check_loop_and_summary(agent, nvml, args.interval)
+    print(f"GpuSampler OK: 2 devices, per-process utilization, C+G and multi-GPU processes, unsupported NVDEC "
+          f"reported as None; {events} gpu_stats events; TID summary sm avg/max {summary['gpu_sm_avg_percent']:g}/{summary['gpu_sm_max_percent']}%, "
+          f"mem max {summary['gpu_mem_max_mb']}MB; sample() {per_sample * 1e6:.1f}us per tick (fake NVML)")
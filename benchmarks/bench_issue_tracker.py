@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Stress test: NPM IssueTracker under concurrent writers, checking expiry correctness and measuring lateness"""
+import argparse, random, threading, time
+from _agents import load_agent
+
+def run(agent, writers, hosts, seconds, timeout):
+    finalized = []
+    lock = threading.Lock()
+    def on_expire(proxy_host, issue):
+        with lock:
+            finalized.append((time.monotonic(), proxy_host, issue))
+
+    # Every third host gets its own timeout to exercise the per-host table
+    timeouts = {str(h): timeout * 2 for h in range(0, hosts, 3)}
+    tracker = agent.IssueTracker(timeout, timeouts, on_expire)
+    tracker.start()
+    opened, counts = [], []
+    stop = time.monotonic() + seconds
+
+    def writer(seed):
+        rng = random.Random(seed)
+        mine, records = [], 0
+        while time.monotonic() < stop:
+            host = str(rng.randrange(hosts))
+            tid, new = tracker.record(host, f"error {records}")
+            records += 1
+            if new: mine.append(tid)
+            if rng.random() < 0.001: time.sleep(timeout * rng.random() * 3)   # let some issues lapse
+        with lock:
+            opened.extend(mine)
+            counts.append(records)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+    start = time.monotonic()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.monotonic() - start
+    time.sleep(timeout * 2 + 0.5)   # let everything still open expire
+    tracker.stop()
+
+    tids = [issue["tid"] for _, _, issue in finalized]
+    lateness = sorted(at - (issue["last_mono"] + tracker.timeout_for(ph)) for at, ph, issue in finalized)
+    assert len(tids) == len(set(tids)), "an issue was finalized twice"
+    assert set(tids) == set(opened), f"{len(set(opened) - set(tids))} issues never finalized"
+    assert lateness[0] >= 0, f"an issue expired {-lateness[0]:.3f}s before its timeout"
+    assert len(tracker) == 0
+    total = sum(counts)
+    p99 = lateness[int(len(lateness) * 0.99)] if lateness else 0.0
+    print(f"{writers} writers x {hosts} hosts: {total / elapsed:,.0f} records/sec, {len(tids)} issues opened and "
+          f"finalized once each, expiry lateness p50={lateness[len(lateness) // 2] * 1000:.1f}ms "
+          f"p99={p99 * 1000:.1f}ms max={lateness[-1] * 1000:.1f}ms")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--writers", type=int, default=8)
+    ap.add_argument("--hosts", type=int, default=500)
+    ap.add_argument("--seconds", type=float, default=5.0)
+    ap.add_argument("--timeout", type=float, default=0.2, help="default issue timeout (seconds)")
+    args = ap.parse_args()
+    run(load_agent("npm_monitor"), args.writers, args.hosts, args.seconds, args.timeout)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Throughput benchmark: NPM access-log parsing + problem classification over a synthetic multi-GB proxy-host log"""
+import argparse, os, random, tempfile, time
+from _agents import load_agent
+
+HOSTS = ["example.com", "api.example.com", "media.example.net", "cloud.example.org"]
+URIS = ["/", "/index.html", "/api/v1/items?page={n}", "/static/app.{n}.js", "/video/segment{n}.ts", "/login"]
+AGENTS = ["Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36", "curl/8.5.0", "Jellyfin-Android/2.6.1"]
+STATUSES = [200] * 80 + [204, 206, 301, 302, 304, 304, 404, 404, 403, 499, 500, 502, 503, 504]
+
+def synthetic_block(lines, seed):
+    rng = random.Random(seed)
+    out = []
+    for n in range(lines):
+        status = rng.choice(STATUSES)
+        upstream = "-" if status == 499 else str(status)
+        cache = rng.choice(["-", "-", "HIT", "MISS"])
+        out.append(
+            f'[17/Oct/2026:10:{n // 60 % 60:02d}:{n % 60:02d} +0000] {cache} {upstream} {status} - '
+            f'{rng.choice(["GET", "GET", "GET", "POST"])} https {rng.choice(HOSTS)} "{rng.choice(URIS).format(n=n)}" '
+            f'[Client 10.0.{rng.randint(0, 255)}.{rng.randint(1, 254)}] [Length {rng.randint(0, 2000000)}] '
+            f'[Gzip {rng.choice(["-", "2.91", "3.40"])}] [Sent-to 172.18.0.{rng.randint(2, 20)}] '
+            f'"{rng.choice(AGENTS)}" "-" {rng.expovariate(8):.3f}\n'
+        )
+    return "".join(out).encode()
+
+def ensure_log(path, size_mb, seed):
+    target = size_mb * 1024 * 1024
+    if os.path.exists(path) and os.path.getsize(path) >= target:
+        return
+    block = synthetic_block(20000, seed)
+    with open(path, "wb") as f:
+        written = 0
+        while written < target:
+            f.write(block)
+            written += len(block)
+
+def legacy_is_problem(log_type, line):
+    if log_type == "error":
+        return True
+    return log_type == "access" and " 5" in line[:5]
+
+def run(label, tailer_cls, path, classify):
+    tailer = tailer_cls(os.path.join(tempfile.gettempdir(), "npm_bench_offsets.json"))   # never saved
+    lines = problems = 0
+    start = time.perf_counter()
+    for line in tailer.iter_new_lines(path):
+        lines += 1
+        if classify(line): problems += 1
+    elapsed = time.perf_counter() - start
+    size_mb = os.path.getsize(path) / 1048576
+    print(f"{label:<14} {lines / elapsed:>12,.0f} lines/sec {size_mb / elapsed:>8.1f} MB/s  ({problems} problems, {elapsed:.1f}s)")
+    return lines / elapsed
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--size-mb", type=int, default=2048, help="synthetic log size")
+    ap.add_argument("--path", default=os.path.join(tempfile.gettempdir(), "npm_bench_proxy-host-1_access.log"),
+                    help="log file to generate (reused if already large enough)")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    agent = load_agent("npm_monitor")
+    ensure_log(args.path, args.size_mb, args.seed)
+
+    def structured(line):
+        return agent.problem_reason("access", agent.parse_line("access", line))
+
+    before = run("substring", agent.FileTailer, args.path, lambda line: legacy_is_problem("access", line))
+    after = run("parse+classify", agent.FileTailer, args.path, structured)
+    print(f"structured parsing costs {before / after:.1f}x the substring check")
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Benchmark: cost of one FFmpeg discovery pass, full scan vs incremental /proc diff, at several process counts"""
+import argparse, os, random, shutil, tempfile, time
+import psutil
+from _agents import load_agent
+
+def make_proc(root, pid, comm):
+    os.makedirs(os.path.join(root, str(pid)))
+    with open(os.path.join(root, str(pid), "comm"), "w") as f:
+        f.write(comm + "\n")
+    with open(os.path.join(root, str(pid), "stat"), "w") as f:
+        f.write(f"{pid} ({comm}) S 1 {pid} {pid} 0 -1\n")
+
+def build_tree(root, count, ffmpeg_share, rng):
+    pids = rng.sample(range(100, count * 10), count)
+    for pid in pids:
+        make_proc(root, pid, "ffmpeg" if rng.random() < ffmpeg_share else rng.choice(["bash", "nginx", "python3", "kworker/0:1"]))
+    return pids
+
+def churn(root, pids, share, rng):
+    """Replace a share of the fake processes, like short-lived jobs on a busy host"""
+    for _ in range(max(1, int(len(pids) * share))):
+        old = pids.pop(rng.randrange(len(pids)))
+        shutil.rmtree(os.path.join(root, str(old)))
+        pid = old
+        while os.path.exists(os.path.join(root, str(pid))):
+            pid = rng.randrange(100, len(pids) * 20)
+        make_proc(root, pid, "ffmpeg" if rng.random() < 0.01 else "bash")
+        pids.append(pid)
+
+def time_scans(discovery, root, pids, ticks, churn_share, rng):
+    discovery.scan()   # warm-up: the first pass is always a full scan
+    total = 0.0
+    for _ in range(ticks):
+        churn(root, pids, churn_share, rng)
+        start = time.perf_counter()
+        discovery.scan()
+        total += time.perf_counter() - start
+    return total / ticks
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--sizes", default="1000,10000,50000", help="comma-separated fake process counts")
+    ap.add_argument("--ticks", type=int, default=10, help="scans timed per size")
+    ap.add_argument("--churn", type=float, default=0.005, help="share of processes replaced between scans")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    agent = load_agent("ffmpeg_monitor")
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    live = sum(1 for p in psutil.process_iter(['name']) if p.info['name'] == "ffmpeg")
+    print(f"live host: psutil.process_iter over {len(psutil.pids())} processes took "
+          f"{(time.perf_counter() - start) * 1000:.1f}ms ({live} ffmpeg)")
+    print(f"{'processes':>10} {'full scan':>12} {'incremental':>12} {'speedup':>8}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        root = tempfile.mkdtemp(prefix="fakeproc-")
+        try:
+            pids = build_tree(root, size, 0.01, rng)
+            results = []
+            for full_every in (1, 0):
+                discovery = agent.ProcessDiscovery(method="proc", full_scan_every=full_every,
+                                                   proc_root=root, process_factory=lambda pid: pid)
+                results.append(time_scans(discovery, root, pids, args.ticks, args.churn, rng))
+            print(f"{size:>10} {results[0] * 1000:>10.1f}ms {results[1] * 1000:>10.1f}ms {results[0] / results[1]:>7.1f}x")
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Micro-benchmark: NPM message build + syslog encoding, per-message datetime/json.dumps vs the cached serializer"""
+import argparse, datetime, json, time
+from _agents import load_agent
+
+def legacy_encode(agent, proxy_host, line):
+    message = {
+        "timestamp": datetime.datetime.now(agent.tz).isoformat(),
+        "source": agent.SOURCE_NAME,
+        "proxy_host": proxy_host,
+        "log_type": "access",
+        "message": line
+    }
+    timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    return f"<134>{timestamp} {agent.SOURCE_NAME} npm-monitor: {json.dumps(message)}\n".encode("utf-8")
+
+def cached_encode(agent, proxy_host, line):
+    message = {
+        "timestamp": agent.now_iso(),
+        "source": agent.SOURCE_NAME,
+        "proxy_host": proxy_host,
+        "log_type": "access",
+        "message": line
+    }
+    return agent.encode_syslog(message)
+
+def run(label, encode, agent, count):
+    line = '[17/Oct/2026:10:00:00 +0000] - 200 200 - GET https example.com "/api/v1/items?page=3" [Client 10.0.0.7] ' \
+           '[Length 5123] [Gzip 2.91] [Sent-to 172.18.0.4] "Mozilla/5.0 (X11; Linux x86_64)" "-"'
+    start = time.perf_counter()
+    size = 0
+    for n in range(count):
+        size += len(encode(agent, f"proxy-host-{n % 8}", line))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} {count / elapsed:>12,.0f} messages/sec  ({size / count:.0f} bytes/message, {elapsed:.3f}s)")
+    return count / elapsed
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--messages", type=int, default=300000)
+    args = ap.parse_args()
+
+    agent = load_agent("npm_monitor")
+    print(f"serializer: {'orjson' if agent.orjson else 'json (stdlib)'}")
+    before = run("legacy", legacy_encode, agent, args.messages)
+    after = run("cached", cached_encode, agent, args.messages)
+    print(f"speedup: {after / before:.1f}x")
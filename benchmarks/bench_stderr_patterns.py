@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Micro-benchmark: FFmpeg stderr classification, per-pattern re.search vs the compiled PatternEngine"""
+import argparse, random, re, time
+from _agents import load_agent
+
+SYNTHETIC_LINES = [
+    "frame= {n} fps= 30 q=28.0 size=   {k}kB time=00:01:{s:02d}.12 bitrate=2200.5kbits/s speed=1.01x",
+    "frame= {n} fps= 29 q=27.0 size=   {k}kB time=00:02:{s:02d}.40 bitrate=2198.1kbits/s dup=0 drop=0 speed=0.99x",
+    "[hls @ 0x55d5c2a3c0] Opening 'segment{n}.ts' for writing",
+    "[h264 @ 0x55d5c2b1c0] concealing {k} DC, {k} AC, {k} MV errors in P frame",
+    "Input #0, matroska,webm, from 'input.mkv':",
+    "    Stream #0:1(eng): Audio: aac (LC), 48000 Hz, stereo, fltp (default)",
+    "[aac @ 0x55d5c2c800] Queue input is backward in time",
+    "    Stream #0:0: Video: h264 (High), yuv420p(progressive), 1920x1080, 23.98 fps",
+    "[hls @ 0x55d5c2a3c0] buffer underflow i={n} bufi={k} size={k}",
+    "[matroska,webm @ 0x55d5c29e40] Failed to read subtitle packet",
+    "[tcp @ 0x55d5c2d100] Connection reset by peer",
+    # Two event types in one line: the higher-priority one (subtitles) must win
+    "    Stream #0:2: Video: subtitle burn-in, yuv420p, 1920x1080",
+]
+
+def legacy_classify(patterns, line):
+    for event_type, pats in patterns.items():
+        for pat in pats:
+            if re.search(pat, line, re.IGNORECASE):
+                return event_type
+    return None
+
+def synthetic_corpus(count, match_ratio, seed):
+    rng = random.Random(seed)
+    quiet, noisy = SYNTHETIC_LINES[:7], SYNTHETIC_LINES[7:]
+    lines = []
+    for n in range(count):
+        tpl = rng.choice(noisy) if rng.random() < match_ratio else rng.choice(quiet)
+        lines.append(tpl.format(n=n, k=rng.randint(1, 99999), s=n % 60))
+    return lines
+
+def run(label, classify, lines):
+    start = time.perf_counter()
+    hits = sum(1 for line in lines if classify(line))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<16} {len(lines) / elapsed:>14,.0f} lines/sec  ({hits} classified, {elapsed:.3f}s)")
+    return len(lines) / elapsed
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--corpus", help="captured ffmpeg stderr file (default: synthetic corpus)")
+    ap.add_argument("--lines", type=int, default=500000, help="synthetic corpus size")
+    ap.add_argument("--match-ratio", type=float, default=0.01, help="share of synthetic lines that match a pattern")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    agent = load_agent("ffmpeg_monitor")
+    patterns = agent.load_error_patterns()
+    if args.corpus:
+        with open(args.corpus, errors="ignore") as f:
+            lines = f.read().splitlines()
+    else:
+        lines = synthetic_corpus(args.lines, args.match_ratio, args.seed)
+
+    mismatches = sum(1 for line in lines[:50000] if legacy_classify(patterns, line) != agent.pattern_engine.classify(line))
+    print(f"corpus: {len(lines)} lines, {mismatches} classification differences in the first 50000")
+    before = run("per-pattern", lambda line: legacy_classify(patterns, line), lines)
+    after = run("PatternEngine", agent.pattern_engine.classify, lines)
+    print(f"speedup: {after / before:.1f}x")
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Update-check cost against a local HTTP stand-in for GitHub: requests, 304s and bytes per check"""
+import argparse, hashlib, os, tempfile, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StandIn(BaseHTTPRequestHandler):
+    """Serves <folder>/<agent>.VERSION with an ETag and Last-Modified, answering conditional requests with 304"""
+    version = "1.0.1"
+    requests = not_modified = body_bytes = 0
+
+    def do_GET(self):
+        cls = type(self)
+        cls.requests += 1
+        body = f"{cls.version}\n".encode()
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            cls.not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        cls.body_bytes += len(body)
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", "Fri, 17 Oct 2026 00:00:00 GMT")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--checks", type=int, default=50)
+    args = ap.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    work = tempfile.mkdtemp(prefix="updater_bench_")
+    agent_path = os.path.join(work, "ffmpeg_monitor.py")
+    with open(agent_path, "w") as f:
+        f.write('#!/usr/bin/env python3\nAGENT_VERSION = "1.0.1"\n' + "# filler\n" * 5000)
+    conf = os.path.join(work, "agent_updater.conf")
+    with open(conf, "w") as f:
+        f.write(f"[general]\ncheck_interval = 300\ncache_file = {work}/http_cache.json\n\n"
+                f"[agent]\nname = ffmpeg_monitor\nlocal_path = {agent_path}\nrepo_folder = ffmpeg\n\n"
+                f"[github]\nbase_url = http://127.0.0.1:{server.server_port}\n")
+    os.environ["AGENT_UPDATER_CONFIG"] = conf
+    os.environ["AGENT_UPDATER_LOG"] = os.path.join(work, "agent_updater.log")
+    from _agents import load_agent
+    updater = load_agent("agent_updater")
+
+    start = time.perf_counter()
+    for _ in range(args.checks):
+        assert updater.check_agent()
+    elapsed = time.perf_counter() - start
+    print(f"{args.checks} checks: {StandIn.requests} requests, {StandIn.not_modified} answered 304, "
+          f"{StandIn.body_bytes} body bytes, {elapsed / args.checks * 1000:.2f} ms/check")
+    # A restarted updater keeps using the persisted ETag, and keeps skipping a rolled-back version
+    updater.bad_versions.add("9.9.9")
+    updater.save_cache()
+    updater.http_cache, updater.bad_versions = updater.load_cache()
+    assert updater.bad_versions == {"9.9.9"}
+    before = StandIn.not_modified
+    updater.check_agent()
+    print(f"after reloading the cache from disk: {'304' if StandIn.not_modified > before else '200'}, "
+          f"rolled-back versions {sorted(updater.bad_versions)}")
+    delays = sorted(updater.next_delay(f) for f in (0, 0, 0, 1, 2, 8))
+    print("next_delay samples (s): " + ", ".join(f"{d:.0f}" for d in delays))
+    server.shutdown()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""Synthetic ffmpeg: writes stderr lines that match the agent's stutter pattern (plus non-matching progress noise)
+at a fixed rate. Start it through a symlink named ffmpeg so process discovery picks it up."""
+import argparse, os, sys, time
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--stream", type=int, default=0, help="id embedded in each marker, unique per process")
+    ap.add_argument("--rate", type=float, default=100, help="matching lines/sec")
+    ap.add_argument("--noise", type=int, default=4, help="non-matching progress lines per matching line")
+    ap.add_argument("--seconds", type=float, default=30)
+    ap.add_argument("--go-file", help="write probe lines until this file exists, then start the measured run")
+    ap.add_argument("--linger", type=float, default=0, help="seconds to stay alive after the run")
+    args = ap.parse_args()
+    err = sys.stderr
+
+    if args.go_file:
+        while not os.path.exists(args.go_file):
+            err.write(f"[hls @ 0x55d0c8] Buffer underflow bench-probe stream={args.stream}\n")
+            err.flush()
+            time.sleep(0.1)
+
+    written = 0
+    start = time.monotonic()
+    while time.monotonic() - start < args.seconds:
+        due = int((time.monotonic() - start) * args.rate)
+        for seq in range(written, due):
+            for n in range(args.noise):
+                err.write(f"frame={seq * (args.noise + 1) + n:6d} fps= 60 q=28.0 size=   10240kB time=00:01:23.45 "
+                          f"bitrate=1003.2kbits/s speed=2.01x\n")
+            err.write(f"[hls @ 0x55d0c8] Buffer underflow bench={args.stream}-{seq}-{time.time_ns()}\n")
+        if due > written:
+            err.flush()
+            written = due
+        time.sleep(0.01)
+    print(written, flush=True)   # the benchmark reads the count from stdout
+    time.sleep(args.linger)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Fake Graylog input: accepts syslog/GELF over TCP or UDP, counts messages and timestamps benchmark markers"""
+import argparse, re, socket, threading, time
+
+# Load generators embed bench=<stream>-<seq>-<unix ns when written> in each line they produce
+MARKER_RE = re.compile(rb"bench=(\d+)-(\d+)-(\d+)")
+PROBE_RE = re.compile(rb"bench-probe(?: stream=(\d+))?")
+# ffmpeg issue summaries/progress repeat earlier stderr lines, markers included
+REPEAT_RE = re.compile(rb'"_?event":\s*"issue_(?:summary|progress)"')
+
+class FakeGraylog:
+    def __init__(self, protocol="tcp", host="127.0.0.1", port=0):
+        self.protocol = protocol
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.bytes = 0
+        self.probes = set()   # streams whose probe lines arrived
+        self.seen = {}   # (stream, seq) -> latency in seconds, first arrival only
+        self.duplicates = 0
+        self.last_arrival = 0.0
+        if protocol == "tcp":
+            self.sock = socket.create_server((host, port))
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+            self.sock.bind((host, port))
+        self.port = self.sock.getsockname()[1]
+
+    def _record(self, frames):
+        now_ns = time.time_ns()
+        with self.lock:
+            for frame in frames:
+                if not frame: continue
+                self.messages += 1
+                self.bytes += len(frame)
+                probe = PROBE_RE.search(frame)
+                if probe:
+                    self.probes.add(int(probe.group(1) or 0))
+                    continue
+                if REPEAT_RE.search(frame): continue
+                m = MARKER_RE.search(frame)
+                if not m: continue
+                key = (int(m.group(1)), int(m.group(2)))
+                if key in self.seen:
+                    self.duplicates += 1
+                else:
+                    self.seen[key] = (now_ns - int(m.group(3))) / 1e9
+            self.last_arrival = time.monotonic()
+
+    def _serve_conn(self, conn):
+        # Syslog lines end in \n, GELF TCP frames in \0; a frame can straddle recv() calls
+        pending = b""
+        with conn:
+            while True:
+                data = conn.recv(262144)
+                if not data: break
+                data = pending + data
+                cut = max(data.rfind(b"\n"), data.rfind(b"\0")) + 1
+                pending = data[cut:]
+                self._record(re.split(rb"[\n\0]", data[:cut]))
+
+    def _serve(self):
+        if self.protocol == "tcp":
+            while True:
+                conn, _ = self.sock.accept()
+                threading.Thread(target=self._serve_conn, args=(conn,), daemon=True).start()
+        while True:
+            self._record([self.sock.recv(65535)])
+
+    def start(self):
+        threading.Thread(target=self._serve, daemon=True).start()
+        return self
+
+    def received(self):
+        with self.lock:
+            return len(self.seen)
+
+    def latencies(self):
+        with self.lock:
+            return sorted(self.seen.values())
+
+def percentile(values, q):
+    return values[min(int(len(values) * q), len(values) - 1)] if values else 0.0
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--protocol", choices=["tcp", "udp"], default="tcp")
+    ap.add_argument("--port", type=int, default=5140)
+    args = ap.parse_args()
+    sink = FakeGraylog(args.protocol, port=args.port).start()
+    print(f"listening on {args.protocol}/{sink.port}, Ctrl-C to stop")
+    last = 0
+    try:
+        while True:
+            time.sleep(1)
+            lat = sink.latencies()
+            print(f"{sink.messages - last:>8,} msg/s  total={sink.messages:,} marked={len(lat):,} dup={sink.duplicates} "
+                  f"p50={percentile(lat, 0.5) * 1000:.1f}ms p99={percentile(lat, 0.99) * 1000:.1f}ms")
+            last = sink.messages
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Load generator: appends NPM proxy-host access and error log lines at a fixed rate into a watched directory"""
+import argparse, os, random, threading, time
+
+HOSTS = ["example.com", "api.example.com", "media.example.net", "cloud.example.org"]
+STATUSES = [200] * 90 + [204, 301, 304, 404, 404, 499, 500, 502, 503, 504]
+
+def access_line(rng, uri, ts):
+    status = rng.choice(STATUSES)
+    upstream = "-" if status == 499 else str(status)
+    return (f'[{ts}] - {upstream} {status} - GET https {rng.choice(HOSTS)} "{uri}" '
+            f'[Client 10.0.{rng.randint(0, 255)}.{rng.randint(1, 254)}] [Length {rng.randint(0, 200000)}] [Gzip -] '
+            f'[Sent-to 172.18.0.{rng.randint(2, 20)}] "Mozilla/5.0 (X11; Linux x86_64)" "-" {rng.expovariate(8):.3f}\n')
+
+def error_line(rng, uri, ts):
+    return (f'{ts} [error] 211#211: *{rng.randint(1, 99999)} upstream timed out (110: Connection timed out) while '
+            f'reading response header from upstream, client: 10.0.0.{rng.randint(1, 254)}, server: {rng.choice(HOSTS)}, '
+            f'request: "GET {uri} HTTP/1.1", upstream: "http://172.18.0.4:8080{uri}", host: "{rng.choice(HOSTS)}"\n')
+
+class NpmLoadGenerator:
+    """Writes rate lines/sec spread over hosts proxy hosts; error_ratio of them go to the error logs"""
+    TICK = 0.01
+
+    def __init__(self, log_dir, rate, hosts=4, error_ratio=0.05, seed=1):
+        self.log_dir = log_dir
+        self.rate = rate
+        self.error_ratio = error_ratio
+        self.rng = random.Random(seed)
+        self.files = [(open(os.path.join(log_dir, f"proxy-host-{h}_access.log"), "a"),
+                       open(os.path.join(log_dir, f"proxy-host-{h}_error.log"), "a")) for h in range(1, hosts + 1)]
+        self.written = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _run(self, seconds):
+        start = time.monotonic()
+        deadline = start + seconds
+        while not self.stop_event.is_set() and time.monotonic() < deadline:
+            due = int((time.monotonic() - start) * self.rate)
+            if due > self.written:
+                now = time.time()
+                access_ts = time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(now))
+                error_ts = time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(now))
+                touched = set()
+                for seq in range(self.written, due):
+                    access, error = self.files[seq % len(self.files)]
+                    uri = f"/bench=0-{seq}-{time.time_ns()}"
+                    if self.rng.random() < self.error_ratio:
+                        error.write(error_line(self.rng, uri, error_ts))
+                        touched.add(error)
+                    else:
+                        access.write(access_line(self.rng, uri, access_ts))
+                        touched.add(access)
+                for f in touched: f.flush()
+                self.written = due
+            time.sleep(self.TICK)
+
+    def start(self, seconds):
+        self.thread = threading.Thread(target=self._run, args=(seconds,), daemon=True)
+        self.thread.start()
+        return self
+
+    def join(self):
+        self.thread.join()
+
+    def close(self):
+        for access, error in self.files:
+            access.close()
+            error.close()
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("log_dir")
+    ap.add_argument("--rate", type=float, default=1000, help="lines/sec across all files")
+    ap.add_argument("--hosts", type=int, default=4, help="proxy hosts (one access + one error log each)")
+    ap.add_argument("--error-ratio", type=float, default=0.05)
+    ap.add_argument("--seconds", type=float, default=60)
+    args = ap.parse_args()
+    os.makedirs(args.log_dir, exist_ok=True)
+    gen = NpmLoadGenerator(args.log_dir, args.rate, args.hosts, args.error_ratio).start(args.seconds)
+    gen.join()
+    gen.close()
+    print(f"{gen.written} lines written to {args.log_dir}", flush=True)   # bench_e2e.py reads the count
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
-import os, sys, time, configparser, requests, subprocess, logging, re
+import os, sys, time, json, glob, random, shutil, hashlib, py_compile, configparser, requests, subprocess, logging, re
 
-CONFIG_FILE = "/etc/agent_updater.conf"
-LOG_FILE    = "/var/log/agent_updater.log"
+CONFIG_FILE = os.environ.get("AGENT_UPDATER_CONFIG", "/etc/agent_updater.conf")
+LOG_FILE    = os.environ.get("AGENT_UPDATER_LOG", "/var/log/agent_updater.log")
 
 logging.basicConfig(
     level=logging.INFO,
@@ -15,87 +15,313 @@ config = configparser.ConfigParser(inline_comment_prefixes=("#",";"))
 config.read(CONFIG_FILE)
 
 INTERVAL    = config.getint("general", "check_interval", fallback=3600)
+JITTER      = config.getfloat("general", "jitter", fallback=0.2)             # +/- share of the interval
+BACKOFF_MAX = config.getint("general", "max_backoff", fallback=6 * 3600)     # cap for the delay after failures
+CACHE_FILE  = config.get("general", "cache_file", fallback="/var/lib/agent_updater/http_cache.json")
+STAGING_DIR = config.get("general", "staging_dir", fallback="/var/lib/agent_updater/staging")
+HEALTH_WAIT = config.getint("general", "health_wait", fallback=15)        # seconds the new version must stay up
+KEEP_BACKUPS = config.getint("general", "keep_backups", fallback=3)
 AGENT_NAME  = config.get("agent", "name")
 LOCAL_PATH  = config.get("agent", "local_path")
+CONFIG_PATH = config.get("agent", "config_path", fallback=f"/etc/{AGENT_NAME}.conf")
 REPO_FOLDER = config.get("agent", "repo_folder")
 BASE_URL    = config.get("github", "base_url")
 
+VERSION_RE = re.compile(r'^\s*AGENT_VERSION\s*=\s*["\'](.+?)["\']')
+
+session = requests.Session()   # keeps the TLS connection to the remote alive between checks
+session.headers["User-Agent"] = f"agent-updater/{AGENT_NAME}"
+local_versions = {}            # path -> ((mtime_ns, size), version)
+retry_after = 0                # seconds the remote asked us to wait (429/503 Retry-After)
+SERVICE = f"{AGENT_NAME.replace('_','-')}.service"
+
+# --- HTTP Cache ---
+def load_cache():
+    """The per-URL HTTP cache and the rolled-back versions, both kept in CACHE_FILE across restarts"""
+    try:
+        with open(CACHE_FILE) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        cache = {}
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable cache {CACHE_FILE}: {e}")
+        cache = {}
+    if "urls" not in cache:
+        cache = {"urls": cache}   # older files held only the per-URL entries
+    return cache["urls"], set(cache.get("bad_versions", []))
+
+def save_cache():
+    try:
+        tmp = CACHE_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"urls": http_cache, "bad_versions": sorted(bad_versions)}, f)
+        os.replace(tmp, CACHE_FILE)
+    except OSError as e:
+        logging.warning(f"Failed to write cache {CACHE_FILE}: {e}")
+
+# url -> {"etag", "last_modified", "body"}; versions rolled back after failing the health check, not retried
+http_cache, bad_versions = load_cache()
+
+def conditional_get(url):
+    """GET with If-None-Match/If-Modified-Since from the persisted cache; 304 answers with the cached body"""
+    global retry_after
+    entry = http_cache.get(url, {})
+    headers = {}
+    if entry.get("etag"): headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"): headers["If-Modified-Since"] = entry["last_modified"]
+    r = session.get(url, headers=headers, timeout=10)
+    if r.status_code == 304 and "body" in entry:
+        return entry["body"]
+    if r.status_code == 200:
+        http_cache[url] = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified"), "body": r.text}
+        save_cache()
+        return r.text
+    if r.status_code in (429, 503) and r.headers.get("Retry-After", "").isdigit():
+        retry_after = int(r.headers["Retry-After"])
+    logging.warning(f"{url} returned HTTP {r.status_code}")
+    return None
+
 # --- Helpers ---
 def read_local_version(path):
-    """Extract AGENT_VERSION from local script"""
+    """Extract AGENT_VERSION from local script, re-reading it only when its mtime or size changes"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        logging.warning(f"Agent file missing: {path}")
+        return None
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = local_versions.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    version = None
     try:
         with open(path, "r") as f:
             for line in f:
-                match = re.match(r'^\s*AGENT_VERSION\s*=\s*["\'](.+?)["\']', line)
+                match = VERSION_RE.match(line)
                 if match:
-                    return match.group(1)
+                    version = match.group(1)
+                    break
     except FileNotFoundError:
         logging.warning(f"Agent file missing: {path}")
-    return None
+        return None
+    local_versions[path] = (stamp, version)
+    return version
 
 def get_remote_version():
-    """Fetch VERSION file from GitHub"""
+    """Fetch VERSION file from GitHub (conditional request, usually a body-less 304)"""
     url = f"{BASE_URL}/{REPO_FOLDER}/{AGENT_NAME}.VERSION"
     try:
-        r = requests.get(url, timeout=10)
-        if r.status_code == 200:
-            return r.text.strip()
+        body = conditional_get(url)
+        if body is not None:
+            return body.strip()
     except Exception as e:
         logging.error(f"Remote version fetch failed: {e}")
     return None
 
-def update_agent():
-    """Download latest agent file and replace"""
-    url = f"{BASE_URL}/{REPO_FOLDER}/{AGENT_NAME}.py"
+# --- Bundle Install ---
+def bundle_files():
+    """Everything published per agent besides the manifest: script, VERSION and default config"""
+    return [f"{AGENT_NAME}.py", f"{AGENT_NAME}.VERSION", f"{AGENT_NAME}.conf"]
+
+def parse_manifest(text):
+    """sha256sum output, one '<hex digest>  <file name>' per line"""
+    sums = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            sums[parts[1].lstrip("*")] = parts[0].lower()
+    return sums
+
+def fetch_bundle(expected_version):
+    """Download the bundle into a fresh staging dir and verify it against the manifest; False if anything is off"""
+    shutil.rmtree(STAGING_DIR, ignore_errors=True)
+    os.makedirs(STAGING_DIR)
+    base = f"{BASE_URL}/{REPO_FOLDER}"
+    r = session.get(f"{base}/{AGENT_NAME}.SHA256SUMS", timeout=10)
+    if r.status_code != 200:
+        logging.error(f"Manifest download returned HTTP {r.status_code}")
+        return False
+    sums = parse_manifest(r.text)
+    for name in bundle_files():
+        if name not in sums:
+            logging.error(f"Manifest has no checksum for {name}")
+            return False
+        r = session.get(f"{base}/{name}", timeout=30)
+        if r.status_code != 200:
+            logging.error(f"{name} download returned HTTP {r.status_code}")
+            return False
+        digest = hashlib.sha256(r.content).hexdigest()
+        if digest != sums[name]:
+            logging.error(f"Checksum mismatch for {name} ({len(r.content)} bytes, sha256 {digest})")
+            return False
+        with open(os.path.join(STAGING_DIR, name), "wb") as f:
+            f.write(r.content)
+    script = os.path.join(STAGING_DIR, f"{AGENT_NAME}.py")
     try:
-        r = requests.get(url, timeout=10)
-        if r.status_code == 200:
-            backup = f"{LOCAL_PATH}.{int(time.time())}.bak"
-            if os.path.exists(LOCAL_PATH):
-                os.rename(LOCAL_PATH, backup)
-            with open(LOCAL_PATH, "wb") as f:
-                f.write(r.content)
-            logging.info(f"Updated {AGENT_NAME} at {LOCAL_PATH} (backup at {backup})")
-            return True
+        py_compile.compile(script, cfile=script + "c", doraise=True)
+    except py_compile.PyCompileError as e:
+        logging.error(f"Downloaded {AGENT_NAME}.py does not compile: {e.msg}")
+        return False
+    with open(os.path.join(STAGING_DIR, f"{AGENT_NAME}.VERSION")) as f:
+        bundle_ver = f.read().strip()
+    script_ver = read_local_version(script)
+    if not bundle_ver == script_ver == expected_version:
+        logging.error(f"Bundle is inconsistent: VERSION {bundle_ver}, script {script_ver}, expected {expected_version}")
+        return False
+    return True
+
+def install_file(src, dest):
+    """Write next to dest and rename over it, so dest is always either the complete old or the complete new file"""
+    tmp = f"{dest}.new"
+    with open(src, "rb") as f:
+        data = f.read()
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    if os.path.exists(dest):
+        shutil.copymode(dest, tmp)
+    os.replace(tmp, dest)
+
+def backup_agent():
+    """Copy the running script to a timestamped .bak, keeping the newest keep_backups"""
+    backup = f"{LOCAL_PATH}.{int(time.time())}.bak"
+    shutil.copy2(LOCAL_PATH, backup)
+    for old in sorted(glob.glob(f"{LOCAL_PATH}.*.bak"))[:-KEEP_BACKUPS]:
+        os.remove(old)
+    return backup
+
+def install_config(src):
+    """The default config only goes live where none exists; otherwise it is left next to the live one for review"""
+    if not os.path.exists(CONFIG_PATH):
+        install_file(src, CONFIG_PATH)
+        logging.info(f"Installed default config at {CONFIG_PATH}")
+        return
+    default = f"{CONFIG_PATH}.default"
+    with open(src, "rb") as f:
+        new = f.read()
+    try:
+        with open(default, "rb") as f:
+            if f.read() == new: return
+    except FileNotFoundError:
+        pass
+    install_file(src, default)
+    logging.info(f"New default config at {default}, compare it with {CONFIG_PATH} for new settings")
+
+def update_agent(remote_ver):
+    """Stage, verify and swap in the new bundle; the running script is only touched once everything checked out"""
+    try:
+        if not fetch_bundle(remote_ver):
+            return False
+        backup = backup_agent()
+        install_file(os.path.join(STAGING_DIR, f"{AGENT_NAME}.py"), LOCAL_PATH)
+        install_config(os.path.join(STAGING_DIR, f"{AGENT_NAME}.conf"))
+        logging.info(f"Updated {AGENT_NAME} at {LOCAL_PATH} (backup at {backup})")
+        return True
     except Exception as e:
         logging.error(f"Update failed: {e}")
     return False
 
-def restart_service():
-    """Restart systemd service"""
-    svc = f"{AGENT_NAME.replace('_','-')}.service"
+def rollback():
+    """Put the newest .bak back and restart on it"""
+    backups = sorted(glob.glob(f"{LOCAL_PATH}.*.bak"))
+    if not backups:
+        logging.error(f"No backup of {LOCAL_PATH} to roll back to")
+        return
+    try:
+        install_file(backups[-1], LOCAL_PATH)
+    except OSError as e:
+        logging.error(f"Rollback from {backups[-1]} failed: {e}")
+        return
+    logging.warning(f"Rolled back {LOCAL_PATH} to {backups[-1]} ({read_local_version(LOCAL_PATH)})")
+    restart_service(reload=False)   # the failed version may not be able to hand over
+
+# --- Service ---
+def restart_service(reload=True):
+    """Reload the systemd service so the agent hands its state to the new version; restart if it cannot reload"""
+    if reload:
+        try:
+            subprocess.run(["systemctl", "reload", SERVICE], check=True)
+            logging.info(f"Reloaded {SERVICE}")
+            return
+        except Exception as e:
+            logging.warning(f"Reload of {SERVICE} failed ({e}), restarting instead")
     try:
-        subprocess.run(["systemctl", "restart", svc], check=True)
-        logging.info(f"Restarted {svc}")
+        subprocess.run(["systemctl", "restart", SERVICE], check=True)
+        logging.info(f"Restarted {SERVICE}")
     except Exception as e:
-        logging.error(f"Failed restarting {svc}: {e}")
+        logging.error(f"Failed restarting {SERVICE}: {e}")
+
+def service_restarts():
+    """systemd's NRestarts, which moves when Restart=always has to bring a crashed agent back"""
+    try:
+        out = subprocess.run(["systemctl", "show", "-p", "NRestarts", "--value", SERVICE],
+                             capture_output=True, text=True, check=True).stdout
+        return int(out.strip())
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+def service_healthy(restarts_before):
+    """Still active health_wait seconds after the update, without systemd having restarted it in between"""
+    time.sleep(HEALTH_WAIT)
+    try:
+        state = subprocess.run(["systemctl", "is-active", SERVICE], capture_output=True, text=True).stdout.strip()
+    except OSError as e:
+        state = str(e)
+    if state != "active":
+        logging.error(f"{SERVICE} is {state or 'unknown'} after the update")
+        return False
+    restarts = service_restarts()
+    if restarts is not None and restarts_before is not None and restarts > restarts_before:
+        logging.error(f"{SERVICE} crashed and was restarted {restarts - restarts_before} times after the update")
+        return False
+    return True
 
 def check_agent():
+    """One update check; False when the remote could not be reached so the next one backs off"""
     local_ver  = read_local_version(LOCAL_PATH)
     remote_ver = get_remote_version()
 
     if not local_ver:
         logging.warning("No local version found")
-        return
+        return remote_ver is not None
     if not remote_ver:
         logging.warning("No remote version found")
-        return
+        return False
 
     if local_ver != remote_ver:
+        if remote_ver in bad_versions:
+            logging.info(f"Skipping {remote_ver}, it was rolled back; staying on {local_ver}")
+            return True
         logging.info(f"Update available: {local_ver} → {remote_ver}")
-        if update_agent():
-            restart_service()
-            new_ver = read_local_version(LOCAL_PATH)
-            if new_ver == remote_ver:
-                logging.info(f"Update verified: now running {new_ver}")
-            else:
-                logging.warning(f"Update verification failed (expected {remote_ver}, got {new_ver})")
+        restarts = service_restarts()
+        if not update_agent(remote_ver):
+            return False
+        restart_service()
+        if service_healthy(restarts):
+            logging.info(f"Update verified: {SERVICE} is up on {read_local_version(LOCAL_PATH)}")
+        else:
+            bad_versions.add(remote_ver)
+            save_cache()
+            rollback()
     else:
         logging.info(f"{AGENT_NAME} is up-to-date ({local_ver})")
+    return True
+
+def next_delay(failures):
+    """Interval, doubled per consecutive failure up to max_backoff, spread by +/- jitter so a fleet drifts apart"""
+    global retry_after
+    delay = min(INTERVAL * 2 ** failures, max(BACKOFF_MAX, INTERVAL))
+    delay = max(delay, retry_after)
+    retry_after = 0
+    return delay * random.uniform(1 - JITTER, 1 + JITTER)
 
 # --- Main Loop ---
 if __name__ == "__main__":
     logging.info(f"Starting updater for {AGENT_NAME}")
+    # Hosts booted together (or restarted by the same deploy) start their schedules at different points
+    time.sleep(random.uniform(0, INTERVAL * JITTER))
+    failures = 0
     while True:
-        check_agent()
-        time.sleep(INTERVAL)
+        failures = 0 if check_agent() else failures + 1
+        time.sleep(next_delay(failures))
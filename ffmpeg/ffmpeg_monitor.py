@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
 AGENT_VERSION = "1.0.1"
-import psutil, socket, json, time, datetime, pytz, configparser, logging, sys, uuid, re, threading
+import os, math, stat, bisect, fcntl, termios, selectors, signal, base64, zlib, gzip, psutil, socket, select, struct, collections, json, time, datetime, pytz, configparser, logging, sys, uuid, re, threading, http.server
 try:
-    from pynvml import *
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import pynvml
     NVML_AVAILABLE = True
 except ImportError:
+    pynvml = None
     NVML_AVAILABLE = False
 
-CONFIG_FILE = "/etc/ffmpeg_monitor.conf"
-LOG_FILE    = "/var/log/ffmpeg_monitor.log"
-AGENT_VERSION = "1.0.0"
+CONFIG_FILE = os.environ.get("FFMPEG_MONITOR_CONFIG", "/etc/ffmpeg_monitor.conf")
+LOG_FILE    = os.environ.get("FFMPEG_MONITOR_LOG", "/var/log/ffmpeg_monitor.log")
 
 
 # --- Setup logging ---
@@ -27,9 +31,26 @@ GRAYLOG_HOST = config.get("graylog", "host", fallback="127.0.0.1")
 GRAYLOG_PORT = config.getint("graylog", "port", fallback=5140)
 PROTOCOL     = config.get("graylog", "protocol", fallback="tcp").lower()
 SOURCE_NAME  = config.get("graylog", "source", fallback="FFMPEG-Monitor")
+OUTPUT_FORMAT   = config.get("graylog", "format", fallback="syslog").lower()
+COMPRESSION     = config.get("graylog", "compression", fallback="none").lower()
+GELF_CHUNK_SIZE = config.getint("graylog", "gelf_chunk_size", fallback=1420)
+BATCH_MAX_BYTES = config.getint("graylog", "batch_max_bytes", fallback=65536)
+FLUSH_INTERVAL  = config.getfloat("graylog", "flush_interval", fallback=1.0)
+RECONNECT_MAX   = config.getfloat("graylog", "reconnect_max_backoff", fallback=30.0)
+CONNECT_TIMEOUT = config.getfloat("graylog", "connect_timeout", fallback=1.0)
+STATS_INTERVAL  = config.getint("graylog", "stats_interval", fallback=60)
+QUEUE_SIZE      = config.getint("graylog", "queue_size", fallback=10000)
+OVERFLOW_POLICY = config.get("graylog", "overflow_policy", fallback="drop_oldest").lower()
+
+METRICS_ENABLED  = config.getboolean("metrics", "enabled", fallback=True)
+METRICS_LISTEN   = config.get("metrics", "listen", fallback="127.0.0.1")
+METRICS_PORT     = config.getint("metrics", "port", fallback=9721)
+METRICS_INTERVAL = config.getint("metrics", "stats_interval", fallback=60)
+METRICS_PREFIX   = "ffmpeg_monitor"
 
 TIMEZONE     = config.get("general", "timezone", fallback="UTC")
 INTERVAL     = config.getint("general", "interval", fallback=5)
+HANDOFF_FILE = config.get("general", "handoff_file", fallback="/var/lib/ffmpeg_monitor/handoff.json")
 
 USE_STDERR   = config.getboolean("modules", "stderr_monitor", fallback=False)
 USE_GPU      = config.getboolean("modules", "gpu_monitor", fallback=False)
@@ -37,6 +58,29 @@ USE_ISSUES   = config.getboolean("modules", "issue_tracker", fallback=True)
 
 GPU_INTERVAL = config.getint("gpu", "interval", fallback=10)
 
+ISSUE_MAX_EVENTS       = max(config.getint("issues", "max_events", fallback=100), 0)   # 0 keeps counters only
+ISSUE_PROGRESS_INTERVAL = config.getint("issues", "progress_interval", fallback=300)
+
+SAMPLING_MODE      = config.get("sampling", "mode", fallback="fixed").lower()
+SAMPLE_MAX_INTERVAL = config.getfloat("sampling", "max_interval", fallback=60)
+SAMPLE_BACKOFF     = config.getfloat("sampling", "backoff", fallback=2.0)
+SAMPLE_CPU_DELTA   = config.getfloat("sampling", "cpu_delta", fallback=10.0)
+SAMPLE_RAM_DELTA   = config.getfloat("sampling", "ram_delta_mb", fallback=50.0)
+HEARTBEAT_INTERVAL = config.getfloat("sampling", "heartbeat_interval", fallback=60)
+REPEAT_COMMAND     = config.getboolean("sampling", "repeat_command", fallback=True)
+
+DISCOVERY_METHOD = config.get("discovery", "method", fallback="auto").lower()
+PROCESS_NAME     = config.get("discovery", "process_name", fallback="ffmpeg")
+MATCH_CGROUP     = config.get("discovery", "match_cgroup", fallback="")
+MATCH_PARENT     = config.get("discovery", "match_parent", fallback="")
+FULL_SCAN_EVERY  = config.getint("discovery", "full_scan_every", fallback=60)
+
+SPOOL_ENABLED     = config.getboolean("spool", "enabled", fallback=True)
+SPOOL_DIR         = config.get("spool", "dir", fallback="/var/lib/ffmpeg_monitor/spool")
+SPOOL_MAX_MB      = config.getint("spool", "max_mb", fallback=256)
+SPOOL_SEGMENT_MB  = config.getint("spool", "segment_mb", fallback=8)
+SPOOL_REPLAY_RATE = config.getint("spool", "replay_rate", fallback=500)
+
 # --- Setup Timezone ---
 try: tz = pytz.timezone(TIMEZONE)
 except Exception: tz = pytz.UTC
@@ -45,52 +89,778 @@ except Exception: tz = pytz.UTC
 tracking_map = {}   # pid -> tid
 stats_map    = {}   # tid -> stats
 issues_map   = {}   # iid -> issue data
+issue_index  = {}   # (pid, tid) -> iid of the open issue
+proc_handles = {}   # tid -> psutil.Process, reused so cpu_percent has a baseline between samples
+issues_lock  = threading.RLock()   # stderr readers and the collector mutate issues concurrently
 
-# --- Logging Helper ---
-def send_to_graylog(message: dict):
+# --- Self Metrics ---
+LATENCY_BOUNDS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+class Counter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+class Histogram:
+    """Fixed buckets (seconds), cheap enough to observe on per-message paths"""
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation (the last bound for the overflow bucket)"""
+        counts, _, count = self.snapshot()
+        rank, seen = q * count, 0
+        for i, c in enumerate(counts):
+            seen += c
+            if c and seen >= rank:
+                return self.bounds[min(i, len(self.bounds) - 1)]
+        return 0.0
+
+class MetricsRegistry:
+    """Counters and histograms fed by the hot paths plus gauges read on demand, rendered in the Prometheus
+    text format for the local endpoint and flattened into the periodic agent_stats event"""
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.families = {}   # name -> {"type", "help", "children": {labels: Counter/Histogram} or "fn", "event"}
+
+    def _child(self, name, kind, help, labels, child):
+        family = self.families.setdefault(name, {"type": kind, "help": help, "children": {}, "event": True})
+        family["children"][tuple(labels.items())] = child
+        return child
+
+    def counter(self, name, help, **labels):
+        return self._child(name, "counter", help, labels, Counter())
+
+    def histogram(self, name, help, **labels):
+        return self._child(name, "histogram", help, labels, Histogram())
+
+    def gauge(self, name, help, fn, kind="gauge", event=True):
+        """fn returns a number, or {((label, value), ...): number} for a labelled family; kind="counter" for
+        totals the agent already keeps. event=False keeps high-cardinality families off agent_stats."""
+        self.families[name] = {"type": kind, "help": help, "fn": fn, "event": event}
+
+    def _samples(self, family):
+        if "fn" not in family:
+            return family["children"].items()
+        value = family["fn"]()
+        return value.items() if isinstance(value, dict) else [((), value)]
+
+    @staticmethod
+    def _labels(labels):
+        if not labels: return ""
+        escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+    def render(self):
+        out = []
+        for name, family in list(self.families.items()):
+            full = f"{self.prefix}_{name}"
+            try:
+                samples = list(self._samples(family))
+            except Exception as e:
+                logging.debug(f"Metric {full} unavailable: {e}")
+                continue
+            out.append(f"# HELP {full} {family['help']}")
+            out.append(f"# TYPE {full} {family['type']}")
+            for labels, value in samples:
+                if family["type"] != "histogram":
+                    out.append(f"{full}{self._labels(labels)} {getattr(value, 'value', value)}")
+                    continue
+                counts, total, count = value.snapshot()
+                cumulative = 0
+                for bound, c in zip(value.bounds + ["+Inf"], counts):
+                    cumulative += c
+                    out.append(f"{full}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+                out.append(f"{full}_sum{self._labels(labels)} {total}")
+                out.append(f"{full}_count{self._labels(labels)} {count}")
+        return "\n".join(out) + "\n"
+
+    def event_fields(self):
+        """Flat fields for agent_stats; histograms become count/avg/p50/p99 in milliseconds"""
+        fields = {}
+        for name, family in list(self.families.items()):
+            if not family["event"]: continue
+            try:
+                samples = list(self._samples(family))
+            except Exception:
+                continue
+            for labels, value in samples:
+                key = re.sub(r"\W", "_", "_".join([name] + [str(v) for _, v in labels]))
+                if family["type"] != "histogram":
+                    fields[key] = getattr(value, "value", value)
+                    continue
+                _, total, count = value.snapshot()
+                fields[f"{key}_count"] = count
+                fields[f"{key}_avg_ms"] = round(1000 * total / count, 3) if count else 0.0
+                fields[f"{key}_p50_ms"] = 1000 * value.quantile(0.5)
+                fields[f"{key}_p99_ms"] = 1000 * value.quantile(0.99)
+        return fields
+
+def rss_bytes():
     try:
-        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-        pri = "<134>"
-        syslog_msg = f"{pri}{timestamp} {SOURCE_NAME} ffmpeg-monitor: {json.dumps(message)}\n"
-
-        if PROTOCOL == "tcp":
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((GRAYLOG_HOST, GRAYLOG_PORT))
-            sock.sendall(syslog_msg.encode("utf-8"))
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return 0
+
+metrics = MetricsRegistry(METRICS_PREFIX)
+metrics.gauge("process_cpu_seconds_total", "CPU time used by the agent", time.process_time, kind="counter")
+metrics.gauge("process_resident_memory_bytes", "Resident memory of the agent", rss_bytes)
+metrics.gauge("threads", "Live threads in the agent", threading.active_count)
+send_latency = metrics.histogram("send_seconds", "Time to write one batch to Graylog")
+queue_delay = metrics.histogram("queue_delay_seconds", "Time a message waited in the send queue")
+send_failures = metrics.counter("send_failures_total", "Batch writes to Graylog that failed")
+collect_latency = metrics.histogram("collect_seconds", "Duration of one collect_metrics pass")
+stderr_lines = metrics.counter("stderr_lines_total", "ffmpeg stderr lines read")
+stderr_events = metrics.counter("stderr_events_total", "ffmpeg stderr lines matching an error pattern")
+metrics.gauge("tracked_processes", "ffmpeg processes with a TID", lambda: len(tracking_map))
+metrics.gauge("open_issues", "Entries in issues_map", lambda: len(issues_map))
+
+# --- Graylog Transport ---
+class GraylogTransport:
+    """Long-lived Graylog connection that coalesces messages into batched writes"""
+    GELF_MAGIC = b"\x1e\x0f"
+    GELF_MAX_CHUNKS = 128
+
+    def __init__(self, host, port, protocol, batch_max_bytes=65536, flush_interval=1.0, backoff_max=30.0,
+                 gelf_chunk_size=None, connect_timeout=1.0):
+        self.addr = (host, port)
+        self.protocol = protocol
+        self.gelf_chunk_size = gelf_chunk_size   # set for GELF over UDP: split big datagrams into GELF chunks
+        self.batch_max_bytes = batch_max_bytes
+        self.flush_interval = flush_interval
+        self.backoff_max = backoff_max
+        # The shipper holds the lock while connecting: a black-holed Graylog must not stall it for long
+        self.connect_timeout = connect_timeout
+        self.lock = threading.Lock()
+        self.sock = None
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.buffer_started = 0.0
+        self.backoff = 0.0
+        self.next_connect = 0.0
+        self.connected_once = False
+        self.failing = False
+        self.on_failure = None   # called with an unsent batch; returns True if it was kept (spooled)
+        self.sent = self.dropped = self.reconnects = 0
+
+    def _connect(self):
+        if self.protocol == "tcp":
+            sock = socket.create_connection(self.addr, timeout=self.connect_timeout)
+            sock.settimeout(10)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         else:
             sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.sendto(syslog_msg.encode("utf-8"), (GRAYLOG_HOST, GRAYLOG_PORT))
-        sock.close()
+        if self.connected_once:
+            self.reconnects += 1
+            logging.info(f"Reconnected to Graylog {self.addr[0]}:{self.addr[1]}")
+        self.connected_once = True
+        self.failing = False
+        self.backoff = 0.0
+        self.sock = sock
+
+    def _peer_closed(self):
+        # Graylog never writes on a syslog/GELF input, so a readable socket means EOF or reset
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            return bool(readable) and not self.sock.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+    def _close(self):
+        if self.sock:
+            try: self.sock.close()
+            except OSError: pass
+        self.sock = None
+
+    def _disconnect(self):
+        self._close()
+        self.backoff = min(max(self.backoff * 2, 0.5), self.backoff_max)
+        self.next_connect = time.monotonic() + self.backoff
+
+    def _write(self, payload):
+        if self.sock and self.protocol == "tcp" and self._peer_closed():
+            self._close()
+        if not self.sock:
+            self._connect()
+        if self.protocol == "tcp":
+            self.sock.sendall(payload)
+        else:
+            self.sock.sendto(payload, self.addr)
+
+    def _datagrams(self, data):
+        size = self.gelf_chunk_size
+        if not size or len(data) <= size:
+            return [data]
+        body = size - 12   # magic(2) + message id(8) + sequence number(1) + sequence count(1)
+        count = -(-len(data) // body)
+        if count > self.GELF_MAX_CHUNKS:
+            logging.error(f"GELF message of {len(data)} bytes needs {count} chunks (max {self.GELF_MAX_CHUNKS}), dropped")
+            self.dropped += 1
+            return []
+        msg_id = os.urandom(8)
+        return [self.GELF_MAGIC + msg_id + bytes((i, count)) + data[i * body:(i + 1) * body] for i in range(count)]
+
+    def _write_batch(self, batch):
+        start = time.monotonic()
+        if self.protocol == "tcp":
+            self._write(b"".join(batch))
+            self.sent += len(batch)
+        else:
+            for data in batch:
+                dgrams = self._datagrams(data)
+                for dgram in dgrams: self._write(dgram)
+                if dgrams: self.sent += 1
+        send_latency.observe(time.monotonic() - start)
+
+    def _shed(self, batch, reason):
+        """Hand an unsent batch to on_failure (the spool), or count it as dropped"""
+        kept = bool(self.on_failure and self.on_failure(batch))
+        if not kept:
+            self.dropped += len(batch)
+        # Only the first failure of an outage is worth an error line
+        log = logging.debug if self.failing else logging.error
+        log(f"Graylog send failed ({len(batch)} messages {'spooled' if kept else 'dropped'}): {reason}")
+        self.failing = True
+
+    def _failed(self, batch, e):
+        # Only a real connect/send error grows the backoff
+        send_failures.inc()
+        self._disconnect()
+        self._shed(batch, e)
+
+    def _flush_locked(self):
+        if not self.buffer: return
+        batch, self.buffer, self.buffer_bytes = self.buffer, [], 0
+        if not self.available():
+            self._shed(batch, "reconnect backoff in effect")
+            return
+        try:
+            self._write_batch(batch)
+        except OSError as e:
+            self._failed(batch, e)
+
+    def available(self):
+        return self.sock is not None or time.monotonic() >= self.next_connect
+
+    def send_now(self, batch):
+        """Write a batch immediately; on failure return False and leave it to the caller"""
+        with self.lock:
+            self._flush_locked()
+            if not self.available(): return False
+            try:
+                self._write_batch(batch)
+                return True
+            except OSError as e:
+                send_failures.inc()
+                self._disconnect()
+                logging.debug(f"Graylog replay failed: {e}")
+                self.failing = True
+                return False
+
+    def send(self, data: bytes):
+        with self.lock:
+            if not self.buffer:
+                self.buffer_started = time.monotonic()
+            self.buffer.append(data)
+            self.buffer_bytes += len(data)
+            # UDP goes out one datagram per message, TCP waits for a full batch or the flush timer
+            if self.protocol != "tcp" or self.buffer_bytes >= self.batch_max_bytes:
+                self._flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def due(self):
+        return bool(self.buffer) and time.monotonic() - self.buffer_started >= self.flush_interval
+
+    def stats(self):
+        return {"sent": self.sent, "dropped": self.dropped, "reconnects": self.reconnects}
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self._close()
+
+transport = GraylogTransport(GRAYLOG_HOST, GRAYLOG_PORT, PROTOCOL, BATCH_MAX_BYTES, FLUSH_INTERVAL, RECONNECT_MAX,
+                             GELF_CHUNK_SIZE if OUTPUT_FORMAT == "gelf" and PROTOCOL != "tcp" else None,
+                             connect_timeout=CONNECT_TIMEOUT)
+metrics.gauge("sent_total", "Messages written to Graylog", lambda: transport.sent, kind="counter")
+metrics.gauge("dropped_total", "Messages lost because Graylog was unreachable and the spool could not keep them",
+              lambda: transport.dropped, kind="counter")
+metrics.gauge("reconnects_total", "Reconnects to Graylog", lambda: transport.reconnects, kind="counter")
+
+# --- Disk Spool ---
+class DiskSpool:
+    """Append-only, segment-rotated on-disk buffer for messages Graylog could not take"""
+    HEADER = struct.Struct(">I")
+
+    def __init__(self, directory, max_bytes, segment_bytes):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.cursor_file = os.path.join(directory, "cursor.json")
+        self.segments = sorted(int(n[:-4]) for n in os.listdir(directory) if n.endswith(".seg") and n[:-4].isdigit())
+        self.sizes = {seg: os.path.getsize(self._path(seg)) for seg in self.segments}
+        # Segments left by a previous run are closed; new writes always start a fresh segment
+        self.write_seg = max(self.segments, default=-1) + 1
+        self.writer = None
+        self.read_seg, self.read_off = self._load_cursor()
+        for seg in [s for s in self.segments if s < self.read_seg]:
+            self._remove(seg)
+        if self.read_seg not in self.sizes:
+            self.read_seg, self.read_off = (self.segments[0] if self.segments else self.write_seg), 0
+        self.total_bytes = sum(self.sizes.values())
+        self.unread = self.total_bytes - self.read_off
+        self.spooled = self.replayed = self.dropped_bytes = 0
+        self.cursor_saved = time.monotonic()
+        if self.unread:
+            logging.info(f"Spool {directory} holds {self.unread} bytes to replay")
+
+    def _path(self, seg):
+        return os.path.join(self.directory, f"{seg:012d}.seg")
+
+    def _load_cursor(self):
+        try:
+            with open(self.cursor_file) as f:
+                cursor = json.load(f)
+            return int(cursor["segment"]), int(cursor["offset"])
+        except (OSError, ValueError, KeyError):
+            return 0, 0
+
+    def _save_cursor(self):
+        tmp = self.cursor_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"segment": self.read_seg, "offset": self.read_off}, f)
+        os.replace(tmp, self.cursor_file)
+        self.cursor_saved = time.monotonic()
+
+    def _remove(self, seg):
+        self.segments.remove(seg)
+        self.sizes.pop(seg, None)
+        try: os.remove(self._path(seg))
+        except OSError: pass
+
+    def _rotate(self):
+        if self.writer:
+            self.writer.close()
+            self.write_seg += 1
+        self.writer = open(self._path(self.write_seg), "ab")
+        self.segments.append(self.write_seg)
+        self.sizes[self.write_seg] = 0
+
+    def _enforce_cap(self):
+        while self.total_bytes > self.max_bytes and len(self.segments) > 1:
+            seg = self.segments[0]
+            size = self.sizes[seg]
+            lost = size - self.read_off if seg == self.read_seg else size
+            self._remove(seg)
+            self.total_bytes -= size
+            self.unread -= lost
+            self.dropped_bytes += lost
+            if seg == self.read_seg:
+                self.read_seg, self.read_off = self.segments[0], 0
+            logging.warning(f"Spool over {self.max_bytes} bytes, discarded oldest segment ({lost} unsent bytes)")
+
+    def append(self, batch):
+        data = b"".join(self.HEADER.pack(len(m)) + m for m in batch)
+        with self.lock:
+            try:
+                if self.writer is None or self.sizes[self.write_seg] >= self.segment_bytes:
+                    self._rotate()
+                self.writer.write(data)
+                self.writer.flush()
+            except OSError as e:
+                logging.error(f"Spool write failed: {e}")
+                return False
+            self.sizes[self.write_seg] += len(data)
+            self.total_bytes += len(data)
+            self.unread += len(data)
+            self.spooled += len(batch)
+            self._enforce_cap()
+            return True
+
+    def read(self, max_items):
+        """Return up to max_items spooled messages and the cursor just past them"""
+        records = []
+        with self.lock:
+            seg, off = self.read_seg, self.read_off
+            while len(records) < max_items and seg in self.sizes:
+                with open(self._path(seg), "rb") as f:
+                    f.seek(off)
+                    while len(records) < max_items:
+                        header = f.read(self.HEADER.size)
+                        if len(header) < self.HEADER.size: break
+                        size = self.HEADER.unpack(header)[0]
+                        payload = f.read(size)
+                        if len(payload) < size: break
+                        records.append(payload)
+                        off += self.HEADER.size + len(payload)
+                if len(records) >= max_items or seg == self.write_seg:
+                    break
+                # End of a closed segment (a torn tail from a crash is skipped too)
+                idx = self.segments.index(seg) + 1
+                if idx >= len(self.segments): break
+                seg, off = self.segments[idx], 0
+        return records, (seg, off)
+
+    def commit(self, cursor, count):
+        with self.lock:
+            seg, off = cursor
+            if seg not in self.sizes: return   # discarded by the size cap meanwhile
+            for old in [s for s in self.segments if s < seg]:
+                self.total_bytes -= self.sizes[old]
+                self._remove(old)
+            self.read_seg, self.read_off = seg, off
+            self.unread = self.total_bytes - off
+            self.replayed += count
+            if self.unread == 0 and seg != self.write_seg:
+                # Fully replayed segment from an earlier run
+                self.total_bytes -= self.sizes[seg]
+                self._remove(seg)
+                self.read_seg, self.read_off = self.write_seg, 0
+            if time.monotonic() - self.cursor_saved >= 1:
+                self._save_cursor()
+
+    def stats(self):
+        return {"spool_bytes": self.unread, "spooled": self.spooled,
+                "replayed": self.replayed, "spool_dropped_bytes": self.dropped_bytes}
+
+    def close(self):
+        with self.lock:
+            if self.writer:
+                self.writer.close()
+                self.writer = None
+            self._save_cursor()
+
+spool = None
+if SPOOL_ENABLED:
+    try:
+        spool = DiskSpool(SPOOL_DIR, SPOOL_MAX_MB * 1024 * 1024, SPOOL_SEGMENT_MB * 1024 * 1024)
+    except OSError as e:
+        logging.error(f"Spool disabled, cannot use {SPOOL_DIR}: {e}")
+if spool:
+    transport.on_failure = spool.append
+    metrics.gauge("spool_bytes", "Spooled bytes not yet replayed", lambda: spool.unread)
+    metrics.gauge("spooled_total", "Messages written to the spool", lambda: spool.spooled, kind="counter")
+
+# --- Send Queue ---
+class SendQueue:
+    """Bounded queue between the hot paths and the Graylog shipper thread"""
+    def __init__(self, maxsize=10000, policy="drop_oldest"):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = collections.deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.enqueued = self.dequeued = self.dropped = 0
+        self._reset_window()
+
+    def _reset_window(self):
+        self.max_depth = 0
+        self.enqueue_wait_sum = self.enqueue_wait_max = 0.0
+        self.queue_delay_sum = self.queue_delay_max = 0.0
+        self.window_enqueued = self.window_dequeued = 0
+
+    def put(self, data):
+        start = time.monotonic()
+        with self.lock:
+            if len(self.items) >= self.maxsize:
+                if self.policy == "drop_newest":
+                    self.dropped += 1
+                    return False
+                if self.policy == "block":
+                    while len(self.items) >= self.maxsize:
+                        self.not_full.wait()
+                else:
+                    self.items.popleft()
+                    self.dropped += 1
+            now = time.monotonic()
+            self.items.append((now, data))
+            self.enqueued += 1
+            self.window_enqueued += 1
+            self.max_depth = max(self.max_depth, len(self.items))
+            wait = now - start
+            self.enqueue_wait_sum += wait
+            self.enqueue_wait_max = max(self.enqueue_wait_max, wait)
+            self.not_empty.notify()
+        return True
+
+    def get_batch(self, max_items, timeout):
+        with self.lock:
+            if not self.items:
+                self.not_empty.wait(timeout)
+            batch = []
+            now = time.monotonic()
+            while self.items and len(batch) < max_items:
+                queued_at, data = self.items.popleft()
+                delay = now - queued_at
+                queue_delay.observe(delay)
+                self.queue_delay_sum += delay
+                self.queue_delay_max = max(self.queue_delay_max, delay)
+                batch.append(data)
+            self.dequeued += len(batch)
+            self.window_dequeued += len(batch)
+            if batch:
+                self.not_full.notify_all()
+            return batch
+
+    def take_all(self):
+        """Remove and return everything queued, oldest first"""
+        with self.lock:
+            items, self.items = self.items, collections.deque()
+            self.dequeued += len(items)
+            self.not_full.notify_all()
+        return [data for _, data in items]
+
+    def stats(self, reset=True):
+        with self.lock:
+            s = {
+                "depth": len(self.items), "max_depth": self.max_depth,
+                "enqueued": self.enqueued, "dequeued": self.dequeued, "dropped": self.dropped,
+                "enqueue_wait_avg_ms": 1000 * self.enqueue_wait_sum / self.window_enqueued if self.window_enqueued else 0.0,
+                "enqueue_wait_max_ms": 1000 * self.enqueue_wait_max,
+                "queue_delay_avg_ms": 1000 * self.queue_delay_sum / self.window_dequeued if self.window_dequeued else 0.0,
+                "queue_delay_max_ms": 1000 * self.queue_delay_max
+            }
+            if reset: self._reset_window()
+            return s
+
+send_queue = SendQueue(QUEUE_SIZE, OVERFLOW_POLICY)
+metrics.gauge("messages_total", "Messages handed to the send queue", lambda: send_queue.enqueued, kind="counter")
+metrics.gauge("queue_depth", "Messages waiting in the send queue", lambda: len(send_queue.items))
+metrics.gauge("queue_dropped_total", "Messages dropped by the send queue overflow policy", lambda: send_queue.dropped,
+              kind="counter")
+
+def replay_spool(budget):
+    """Replay up to budget spooled messages; live traffic always goes first"""
+    if len(send_queue.items) >= 1024: return 0
+    records, cursor = spool.read(budget)
+    if records and transport.send_now(records):
+        spool.commit(cursor, len(records))
+        return len(records)
+    return 0
+
+shipper_stop = threading.Event()
+shipper_thread = None
+
+def shipper_loop():
+    last_stats = last_refill = time.monotonic()
+    replay_tokens = 0.0
+    while not shipper_stop.is_set():
+        replaying = spool is not None and spool.unread > 0 and transport.available()
+        timeout = FLUSH_INTERVAL
+        if transport.buffer:
+            timeout = max(transport.buffer_started + FLUSH_INTERVAL - time.monotonic(), 0)
+        if replaying:
+            timeout = min(timeout, 0.1)
+        for data in send_queue.get_batch(1024, timeout):
+            transport.send(data)
+        if transport.due():
+            transport.flush()
+        now = time.monotonic()
+        if replaying:
+            replay_tokens = min(replay_tokens + (now - last_refill) * SPOOL_REPLAY_RATE, SPOOL_REPLAY_RATE)
+            if replay_tokens >= 1:
+                replay_tokens -= replay_spool(int(replay_tokens))
+        last_refill = now
+        if STATS_INTERVAL and now - last_stats >= STATS_INTERVAL:
+            last_stats = now
+            t, q = transport.stats(), send_queue.stats()
+            sp = spool.stats() if spool else {}
+            logging.info(f"Graylog transport: sent={t['sent']} dropped={t['dropped']} reconnects={t['reconnects']} "
+                         f"queue_depth={q['depth']} queue_max_depth={q['max_depth']} queue_dropped={q['dropped']} "
+                         f"enqueue_wait_avg={q['enqueue_wait_avg_ms']:.2f}ms enqueue_wait_max={q['enqueue_wait_max_ms']:.2f}ms "
+                         f"queue_delay_avg={q['queue_delay_avg_ms']:.2f}ms queue_delay_max={q['queue_delay_max_ms']:.2f}ms"
+                         + "".join(f" {k}={v}" for k, v in sp.items()))
+
+def start_shipper_thread():
+    global shipper_thread
+    shipper_thread = threading.Thread(target=shipper_loop, daemon=True)
+    shipper_thread.start()
+
+def stop_shipper_thread():
+    """Let the shipper finish its current batch and exit, leaving the queue to the caller"""
+    shipper_stop.set()
+    if shipper_thread: shipper_thread.join(timeout=FLUSH_INTERVAL + 5)
+
+def drain_sender():
+    """Ship everything still queued and close the connection"""
+    stop_shipper_thread()
+    while True:
+        batch = send_queue.get_batch(1024, 0)
+        if not batch: break
+        for data in batch:
+            transport.send(data)
+    transport.close()
+    if spool: spool.close()
+
+# --- Serialization ---
+if orjson:
+    def dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+else:
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+class Clock:
+    """Timestamp strings formatted once per wall-clock second and reused until the second changes"""
+    def __init__(self, tz, syslog_tag):
+        self.tz = tz
+        self.syslog_tag = syslog_tag
+        self.cached = (None, "", "", b"")   # (second, local iso up to seconds, utc offset, syslog header)
+
+    def _refresh(self, second):
+        local = datetime.datetime.fromtimestamp(second, self.tz).isoformat()
+        utc = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(second))
+        self.cached = (second, local[:19], local[19:], f"<134>{utc} {self.syslog_tag}: ".encode("utf-8"))
+        return self.cached
+
+    def now_iso(self):
+        now = time.time()
+        second = int(now)
+        cached = self.cached
+        if cached[0] != second: cached = self._refresh(second)
+        micros = int((now - second) * 1000000)
+        # Same shape as datetime.isoformat(): microseconds only when non-zero
+        return f"{cached[1]}.{micros:06d}{cached[2]}" if micros else cached[1] + cached[2]
+
+    def syslog_header(self):
+        second = int(time.time())
+        cached = self.cached
+        if cached[0] != second: cached = self._refresh(second)
+        return cached[3]
+
+clock = Clock(tz, f"{SOURCE_NAME} ffmpeg-monitor")
+now_iso = clock.now_iso
+
+# --- Wire Formats ---
+def encode_syslog(message):
+    return clock.syslog_header() + dumps(message) + b"\n"
+
+GELF_WARNING_EVENTS = {"failure", "stutter", "issue_summary", "issue_progress"}
+
+def encode_gelf(message):
+    gelf = {
+        "version": "1.1",
+        "host": SOURCE_NAME,
+        "short_message": message.get("log_line") or message.get("event") or "metrics",
+        "timestamp": time.time(),
+        "level": 4 if message.get("event") in GELF_WARNING_EVENTS else 6,
+        "_agent": "ffmpeg-monitor"
+    }
+    for key, value in message.items():
+        if key == "source": continue
+        # GELF additional fields must be strings or numbers; nested data travels as JSON text
+        if value is not None and not isinstance(value, (str, int, float)):
+            value = dumps(value).decode("utf-8")
+        gelf["_local_time" if key == "timestamp" else f"_{key}"] = value
+    payload = dumps(gelf)
+    if PROTOCOL == "tcp":
+        return payload + b"\0"   # GELF TCP frames are null-terminated and cannot be compressed
+    if COMPRESSION == "zlib":
+        return zlib.compress(payload)
+    if COMPRESSION == "gzip":
+        return gzip.compress(payload)
+    return payload
+
+encode_message = encode_gelf if OUTPUT_FORMAT == "gelf" else encode_syslog
+
+# --- Logging Helper ---
+def send_to_graylog(message: dict):
+    try:
+        send_queue.put(encode_message(message))
     except Exception as e:
         logging.error(f"Graylog send failed: {e}")
 
 # --- Issue Tracker ---
+# Issues keep only the last ISSUE_MAX_EVENTS lines plus per-type counters, so memory and the
+# issue_summary size stay constant however long a stream keeps stuttering.
+def new_issue_event(event_type, line):
+    return {
+        "timestamp": now_iso(),
+        "type": event_type,
+        "log_line": line.strip()
+    }
+
+def count_issue_event(issue, event):
+    issue["total_events"] += 1
+    counts = issue["event_counts"].get(event["type"])
+    if counts is None:
+        issue["event_counts"][event["type"]] = {"count": 1, "first": event["timestamp"], "last": event["timestamp"]}
+    else:
+        counts["count"] += 1
+        counts["last"] = event["timestamp"]
+
 def start_issue(pid, tid, event_type, line):
     iid = str(uuid.uuid4())
-    issues_map[iid] = {
-        "iid": iid,
-        "pid": pid,
-        "tid": tid,
-        "start_time": datetime.datetime.now(tz),
-        "events": [{
-            "timestamp": datetime.datetime.now(tz).isoformat(),
-            "type": event_type,
-            "log_line": line.strip()
-        }]
-    }
+    event = new_issue_event(event_type, line)
+    with issues_lock:
+        issues_map[iid] = {
+            "iid": iid,
+            "pid": pid,
+            "tid": tid,
+            "start_time": datetime.datetime.now(tz),
+            "events": collections.deque([event], maxlen=ISSUE_MAX_EVENTS),
+            "event_counts": {},
+            "total_events": 0,
+            "last_progress": time.monotonic()
+        }
+        count_issue_event(issues_map[iid], event)
+        issue_index[(pid, tid)] = iid
     logging.info(f"Issue started IID={iid} PID={pid} TID={tid} ({event_type})")
     return iid
 
 def append_issue(iid, event_type, line):
-    issues_map[iid]["events"].append({
-        "timestamp": datetime.datetime.now(tz).isoformat(),
-        "type": event_type,
-        "log_line": line.strip()
-    })
+    event = new_issue_event(event_type, line)
+    with issues_lock:
+        issue = issues_map[iid]
+        issue["events"].append(event)
+        count_issue_event(issue, event)
+
+def record_issue(pid, tid, event_type, line):
+    """Append to the open issue of (pid, tid), starting one if there is none; returns its IID"""
+    with issues_lock:
+        iid = issue_index.get((pid, tid))
+        if iid is None:
+            return start_issue(pid, tid, event_type, line)
+        append_issue(iid, event_type, line)
+        return iid
+
+def finalize_process_issue(pid, tid):
+    iid = issue_index.get((pid, tid))
+    if iid: finalize_issue(iid)
 
 def finalize_issue(iid):
-    issue = issues_map.pop(iid, None)
-    if not issue: return
+    with issues_lock:
+        issue = issues_map.pop(iid, None)
+        if not issue: return
+        if issue_index.get((issue["pid"], issue["tid"])) == iid:
+            del issue_index[(issue["pid"], issue["tid"])]
     end_time = datetime.datetime.now(tz)
     issue["end_time"] = end_time.isoformat()
     issue["duration_sec"] = (end_time - issue["start_time"]).total_seconds()
@@ -102,10 +872,36 @@ def finalize_issue(iid):
         "start_time": issue["start_time"].isoformat(),
         "end_time": issue["end_time"],
         "duration_sec": issue["duration_sec"],
-        "events": issue["events"]
+        "total_events": issue["total_events"],
+        "event_counts": issue["event_counts"],
+        "events_omitted": issue["total_events"] - len(issue["events"]),
+        "events": list(issue["events"])
     })
     logging.info(f"Issue IID={iid} finalized and sent")
 
+def emit_issue_progress():
+    """Periodic issue_progress for long-running issues, so dashboards see them before they end"""
+    if not ISSUE_PROGRESS_INTERVAL: return
+    now = time.monotonic()
+    due = []
+    with issues_lock:
+        for issue in issues_map.values():
+            if now - issue["last_progress"] >= ISSUE_PROGRESS_INTERVAL:
+                issue["last_progress"] = now
+                due.append({
+                    "timestamp": now_iso(),
+                    "source": SOURCE_NAME,
+                    "event": "issue_progress",
+                    "iid": issue["iid"], "pid": issue["pid"], "tid": issue["tid"],
+                    "start_time": issue["start_time"].isoformat(),
+                    "duration_sec": (datetime.datetime.now(tz) - issue["start_time"]).total_seconds(),
+                    "total_events": issue["total_events"],
+                    "event_counts": {k: dict(v) for k, v in issue["event_counts"].items()},
+                    "last_event": dict(issue["events"][-1]) if issue["events"] else None
+                })
+    for msg in due:
+        send_to_graylog(msg)
+
 # --- stderr Monitor ---
 ERROR_PATTERNS = {
     "stutter": [r"buffer underflow", r"frame drop", r"too slow"],
@@ -114,146 +910,889 @@ ERROR_PATTERNS = {
     "failure": [r"Connection reset", r"error while decoding", r"Server returned 404"]
 }
 
+def fold_case(pattern):
+    """Lower-case the literal parts of a regex, leaving escapes such as \\D or \\S untouched"""
+    out, i = [], 0
+    while i < len(pattern):
+        if pattern[i] == "\\":
+            out.append(pattern[i:i + 2])
+            i += 2
+        else:
+            out.append(pattern[i].lower())
+            i += 1
+    return "".join(out)
+
+class PatternEngine:
+    """Classifies a stderr line: one combined prefilter pass, then the event types in priority order"""
+    def __init__(self, patterns):
+        self.event_types = [event for event, pats in patterns.items() if pats]
+        # Patterns are case-folded up front and matched against line.lower(): re.IGNORECASE and
+        # capture groups both disable the literal-prefix scan, which makes a large alternation
+        # several times slower. The flat prefilter rejects the (vast majority of) quiet lines;
+        # only hits are checked per event type, first match wins. A single grouped alternation
+        # cannot do that: its matches do not overlap, so an earlier, lower-priority match can
+        # swallow the text a higher-priority pattern needs.
+        folded = {event: [f"(?:{fold_case(p)})" for p in patterns[event]] for event in self.event_types}
+        self.prefilter = re.compile("|".join(p for event in self.event_types for p in folded[event]))
+        self.prefilter_bytes = re.compile(self.prefilter.pattern.encode())
+        self.regexes = [(event, re.compile("|".join(folded[event]))) for event in self.event_types]
+
+    def classify(self, line):
+        line = line.lower()
+        if not self.prefilter.search(line):
+            return None
+        for event, regex in self.regexes:
+            if regex.search(line):
+                return event
+        return None
+
+def load_error_patterns():
+    """[stderr_patterns] replaces the built-in patterns: one event type per key, one regex per line"""
+    if not config.has_section("stderr_patterns"):
+        return ERROR_PATTERNS
+    patterns = {event: [p.strip() for p in value.splitlines() if p.strip()]
+                for event, value in config.items("stderr_patterns")}
+    try:
+        PatternEngine(patterns)
+    except re.error as e:
+        logging.error(f"Invalid [stderr_patterns] in {CONFIG_FILE}, using built-in patterns: {e}")
+        return ERROR_PATTERNS
+    return patterns
+
+pattern_engine = PatternEngine(load_error_patterns())
+
 def parse_stderr_line(line, pid, tid):
-    for event_type, pats in ERROR_PATTERNS.items():
-        for pat in pats:
-            if re.search(pat, line, re.IGNORECASE):
-                active_iid = None
-                if USE_ISSUES:
-                    for iid, issue in issues_map.items():
-                        if issue["pid"] == pid and issue["tid"] == tid:
-                            active_iid = iid
-                            break
-                    if not active_iid:
-                        active_iid = start_issue(pid, tid, event_type, line)
-                    else:
-                        append_issue(active_iid, event_type, line)
-                send_to_graylog({
-                    "timestamp": datetime.datetime.now(tz).isoformat(),
-                    "source": SOURCE_NAME,
-                    "pid": pid, "tid": tid,
-                    "iid": active_iid,
-                    "event": event_type,
-                    "log_line": line.strip()
-                })
+    event_type = pattern_engine.classify(line)
+    if not event_type:
+        return
+    stderr_events.inc()
+    active_iid = record_issue(pid, tid, event_type, line) if USE_ISSUES else None
+    send_to_graylog({
+        "timestamp": now_iso(),
+        "source": SOURCE_NAME,
+        "pid": pid, "tid": tid,
+        "iid": active_iid,
+        "event": event_type,
+        "log_line": line.strip()
+    })
+
+class StderrMux:
+    """Single thread multiplexing the stderr of every tracked ffmpeg process through one selector"""
+    MAX_LINE = 64 * 1024
+    READS_PER_ROUND = 4   # chunks per source per wakeup, so one chatty process cannot starve the rest
+    READS_PER_POLL = 64   # polled files are only visited every poll_interval, so they get a bigger share
+
+    def __init__(self, chunk_size=65536, poll_interval=0.5):
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.pending = []   # ("add", pid, tid, resume) / ("remove", pid, None, on_drained) applied by the mux thread
+        self.sources = {}   # pid -> {"fd", "tid", "partial", "polled", "bytes"}
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+        self.stopping = False
+        self.thread = None
+
+    def _wake(self):
+        try: os.write(self.wakeup_w, b"x")
+        except BlockingIOError: pass
+
+    def add(self, pid, tid, resume=None):
+        """Start reading pid's stderr; resume is a snapshot() entry of a previous agent process"""
+        with self.lock:
+            self.pending.append(("add", pid, tid, resume))
+        self._wake()
+
+    def remove(self, pid, on_drained=None):
+        """Stop reading pid's stderr after reading what is left; on_drained then runs on the mux thread"""
+        with self.lock:
+            self.pending.append(("remove", pid, None, on_drained))
+        self._wake()
+
+    def _open(self, pid, tid, resume=None):
+        try:
+            fd = os.open(f"/proc/{pid}/fd/2", os.O_RDONLY | os.O_NONBLOCK)
+        except OSError as e:
+            logging.debug(f"stderr monitor not started PID={pid}: {e}")
+            return
+        # epoll cannot watch regular files, so stderr redirected to a file is polled instead
+        polled = stat.S_ISREG(os.fstat(fd).st_mode)
+        src = {"fd": fd, "pid": pid, "tid": tid, "partial": b"", "polled": polled, "bytes": 0}
+        if resume:
+            # A reopened file starts at offset 0, a pipe continues where the previous reader stopped
+            if polled and resume["offset"] is not None: os.lseek(fd, resume["offset"], os.SEEK_SET)
+            src["partial"] = base64.b64decode(resume["partial"])
+        if not polled:
+            self.selector.register(fd, selectors.EVENT_READ, src)
+        self.sources[pid] = src
+
+    def _close(self, src):
+        if src["partial"]:
+            self._lines(src, src["partial"])
+            src["partial"] = b""
+        if not src["polled"]:
+            self.selector.unregister(src["fd"])
+        os.close(src["fd"])
+        self.sources.pop(src["pid"], None)
+
+    def _apply_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for op, pid, tid, arg in pending:
+            src = self.sources.get(pid)
+            if op == "add" and not src:
+                self._open(pid, tid, arg)
+            elif op == "remove":
+                if src:
+                    self._read(src, drain=True)
+                    if pid in self.sources: self._close(src)
+                if arg: arg()
+
+    def _lines(self, src, block):
+        # Scan the whole block at once; only lines containing a prefilter hit are cut out and decoded
+        end = 0
+        for m in pattern_engine.prefilter_bytes.finditer(block.lower()):
+            if m.start() < end: continue   # another hit on a line already handled
+            start = max(block.rfind(b"\n", 0, m.start()), block.rfind(b"\r", 0, m.start())) + 1
+            ends = [i for i in (block.find(b"\n", m.start()), block.find(b"\r", m.start())) if i >= 0]
+            end = min(ends) if ends else len(block)
+            parse_stderr_line(block[start:end].decode(errors="ignore"), src["pid"], src["tid"])
+
+    def _read(self, src, drain=False):
+        rounds = 1 << 30 if drain else self.READS_PER_POLL if src["polled"] else self.READS_PER_ROUND
+        for _ in range(rounds):
+            try:
+                data = os.read(src["fd"], self.chunk_size)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logging.debug(f"stderr monitor stopped PID={src['pid']}: {e}")
+                self._close(src)
+                return
+            if not data:
+                if not src["polled"]:   # writer side gone, the process has exited
+                    self._close(src)
                 return
+            src["bytes"] += len(data)
+            buf = src["partial"] + data if src["partial"] else data
+            # ffmpeg ends progress lines with \r, everything else with \n
+            cut = max(buf.rfind(b"\n"), buf.rfind(b"\r")) + 1
+            if not cut and len(buf) < self.MAX_LINE:
+                src["partial"] = buf
+                continue
+            cut = cut or len(buf)
+            src["partial"] = buf[cut:]
+            block = buf[:cut]
+            # Counted here rather than per parsed line: only prefilter hits reach parse_stderr_line
+            stderr_lines.inc(block.count(b"\n") + block.count(b"\r") - block.count(b"\r\n")
+                             + (block[-1:] not in (b"\n", b"\r")))
+            self._lines(src, block)
 
-def watch_stderr(pid, tid):
-    try:
-        with open(f"/proc/{pid}/fd/2", "r", errors="ignore") as fd:
-            for line in fd:
-                parse_stderr_line(line, pid, tid)
-    except Exception as e:
-        logging.debug(f"stderr monitor stopped PID={pid}: {e}")
+    def backlog(self):
+        """Unread bytes per PID: kernel pipe buffer (or unread file tail) plus our partial line"""
+        out = {}
+        for pid, src in list(self.sources.items()):
+            try:
+                if src["polled"]:
+                    pending = os.fstat(src["fd"]).st_size - os.lseek(src["fd"], 0, os.SEEK_CUR)
+                else:
+                    pending = struct.unpack("i", fcntl.ioctl(src["fd"], termios.FIONREAD, b"\0\0\0\0"))[0]
+            except OSError:
+                pending = 0
+            out[pid] = max(pending, 0) + len(src["partial"])
+        return out
 
-def start_stderr_thread(pid, tid):
-    t = threading.Thread(target=watch_stderr, args=(pid, tid), daemon=True)
-    t.start()
+    def run(self):
+        last_poll = last_stats = time.monotonic()
+        while not self.stopping:
+            for key, _ in self.selector.select(self.poll_interval):
+                if key.data is None:
+                    try: os.read(self.wakeup_r, 4096)
+                    except BlockingIOError: pass
+                    self._apply_pending()
+                elif key.data["pid"] in self.sources:
+                    self._read(key.data)
+            now = time.monotonic()
+            if now - last_poll >= self.poll_interval:
+                last_poll = now
+                for src in [s for s in self.sources.values() if s["polled"]]:
+                    self._read(src)
+            if STATS_INTERVAL and now - last_stats >= STATS_INTERVAL:
+                last_stats = now
+                backlog = self.backlog()
+                worst = max(backlog, key=backlog.get, default=None)
+                logging.info(f"stderr monitor: sources={len(backlog)} backlog_bytes={sum(backlog.values())}"
+                             + (f" max_backlog_pid={worst} max_backlog_bytes={backlog[worst]}" if worst else ""))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self._wake()
+        if self.thread: self.thread.join(timeout=5)
+
+    def snapshot(self):
+        """Read position of every source after stop(), for the next agent process to resume from"""
+        out = []
+        for pid, src in self.sources.items():
+            offset, partial = None, src["partial"]
+            if src["polled"]:
+                try:
+                    offset, partial = os.lseek(src["fd"], 0, os.SEEK_CUR) - len(partial), b""
+                except OSError:
+                    pass
+            out.append({"pid": pid, "offset": offset, "partial": base64.b64encode(partial).decode("ascii")})
+        return out
+
+stderr_mux = StderrMux()
+metrics.gauge("stderr_sources", "stderr streams read by the mux thread", lambda: len(stderr_mux.sources))
 
 # --- GPU Monitor ---
-def gpu_loop():
-    if not NVML_AVAILABLE:
+gpu_lock      = threading.Lock()
+gpu_proc_map  = {}   # pid -> latest per-process GPU sample, replaced every GPU tick
+
+class GpuSampler:
+    """Queries every NVML device once per tick; nvml is the pynvml module or any stand-in with the same API"""
+    def __init__(self, nvml):
+        self.nvml = nvml
+        nvml.nvmlInit()
+        self.handles = [nvml.nvmlDeviceGetHandleByIndex(i) for i in range(nvml.nvmlDeviceGetCount())]
+        self.last_seen = [0] * len(self.handles)   # newest sample timestamp per device, in microseconds
+
+    def _query(self, fn, *args, default=None):
+        # Per-process accounting and encoder/decoder stats are not supported on every board or driver
+        try:
+            return fn(*args)
+        except self.nvml.NVMLError:
+            return default
+
+    def sample(self):
+        """Return ([per-device stats], {pid: per-process stats})"""
+        nvml = self.nvml
+        devices, procs = [], {}
+        for idx, handle in enumerate(self.handles):
+            util = nvml.nvmlDeviceGetUtilizationRates(handle)
+            mem = nvml.nvmlDeviceGetMemoryInfo(handle)
+            enc = self._query(nvml.nvmlDeviceGetEncoderUtilization, handle, default=(None, 0))[0]
+            dec = self._query(nvml.nvmlDeviceGetDecoderUtilization, handle, default=(None, 0))[0]
+            devices.append({
+                "gpu_index": idx,
+                "gpu_util_percent": util.gpu,
+                "mem_used_mb": mem.used // (1024*1024),
+                "mem_total_mb": mem.total // (1024*1024),
+                "encoder_util_percent": enc,
+                "decoder_util_percent": dec
+            })
+            running = (self._query(nvml.nvmlDeviceGetComputeRunningProcesses, handle, default=[])
+                       + self._query(nvml.nvmlDeviceGetGraphicsRunningProcesses, handle, default=[]))
+            on_device = {}
+            for p in running:
+                # A process with both context types ("C+G") is listed twice with the same memory, so take the max
+                entry = on_device.setdefault(p.pid, {"gpu_index": idx, "gpu_mem_mb": 0})
+                entry["gpu_mem_mb"] = max(entry["gpu_mem_mb"], (p.usedGpuMemory or 0) // (1024*1024))
+            latest = {}
+            for s in self._query(nvml.nvmlDeviceGetProcessUtilization, handle, self.last_seen[idx], default=[]):
+                self.last_seen[idx] = max(self.last_seen[idx], s.timeStamp)
+                if s.pid not in latest or s.timeStamp >= latest[s.pid].timeStamp: latest[s.pid] = s
+            for pid, s in latest.items():
+                entry = on_device.setdefault(pid, {"gpu_index": idx, "gpu_mem_mb": 0})
+                entry.update(gpu_sm_percent=s.smUtil, gpu_enc_percent=s.encUtil, gpu_dec_percent=s.decUtil)
+            for pid, entry in on_device.items():
+                procs[pid] = self._merge(procs[pid], entry) if pid in procs else entry
+        return devices, procs
+
+    @staticmethod
+    def _merge(a, b):
+        """One entry for a process on several GPUs: memory summed over them, gpu_index and the utilization
+        fields from the busiest one (highest SM), so they always describe the same device"""
+        busiest = max((a, b), key=lambda e: (e.get("gpu_sm_percent", -1), -e["gpu_index"]))
+        return {**busiest, "gpu_mem_mb": a["gpu_mem_mb"] + b["gpu_mem_mb"]}
+
+def gpu_loop(nvml=None):
+    nvml = nvml or pynvml
+    if not nvml:
         logging.warning("GPU monitor requested but pynvml not installed.")
         return
     try:
-        nvmlInit()
-        handle = nvmlDeviceGetHandleByIndex(0)
+        sampler = GpuSampler(nvml)
     except Exception as e:
         logging.error(f"GPU init failed: {e}")
         return
+    logging.info(f"GPU monitor watching {len(sampler.handles)} device(s)")
+    global gpu_proc_map
     while True:
         try:
-            util = nvmlDeviceGetUtilizationRates(handle)
-            mem = nvmlDeviceGetMemoryInfo(handle)
-            send_to_graylog({
-                "timestamp": datetime.datetime.now(tz).isoformat(),
-                "source": SOURCE_NAME,
-                "event": "gpu_stats",
-                "gpu_util_percent": util.gpu,
-                "mem_used_mb": mem.used // (1024*1024),
-                "mem_total_mb": mem.total // (1024*1024)
-            })
+            devices, procs = sampler.sample()
+            with gpu_lock:
+                gpu_proc_map = procs
+            for device in devices:
+                send_to_graylog({
+                    "timestamp": now_iso(),
+                    "source": SOURCE_NAME,
+                    "event": "gpu_stats",
+                    **device
+                })
         except Exception as e:
             logging.error(f"GPU query error: {e}")
         time.sleep(GPU_INTERVAL)
 
+def gpu_sample_for(pid):
+    with gpu_lock:
+        return gpu_proc_map.get(pid)
+
 def start_gpu_thread():
     t = threading.Thread(target=gpu_loop, daemon=True)
     t.start()
 
+# --- Process Discovery ---
+class ExecListener:
+    """Kernel proc connector subscription (netlink) reporting every exec(); needs CAP_NET_ADMIN"""
+    NETLINK_CONNECTOR, CN_IDX_PROC, PROC_CN_MCAST_LISTEN, PROC_EVENT_EXEC = 11, 1, 1, 0x2
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_CONNECTOR)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.sock.bind((0, self.CN_IDX_PROC))
+        # nlmsghdr + cn_msg + PROC_CN_MCAST_LISTEN
+        self.sock.send(struct.pack("=IHHII", 40, 3, 0, 0, self.sock.getsockname()[0])
+                       + struct.pack("=IIIIHH", self.CN_IDX_PROC, 1, 0, 0, 4, 0)
+                       + struct.pack("=I", self.PROC_CN_MCAST_LISTEN))
+        self.sock.setblocking(False)
+
+    def drain(self):
+        """PIDs that exec'd since the last call, or None if events were lost"""
+        pids = set()
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                return pids
+            except OSError:   # ENOBUFS: the kernel dropped events, caller must rescan
+                return None
+            if len(data) >= 60 and struct.unpack_from("=I", data, 36)[0] == self.PROC_EVENT_EXEC:
+                pids.add(struct.unpack_from("=II", data, 52)[1])
+
+class ProcessDiscovery:
+    """Finds ffmpeg processes by looking only at PIDs that are new since the last scan"""
+    def __init__(self, name="ffmpeg", method="auto", match_cgroup="", match_parent="",
+                 full_scan_every=60, proc_root="/proc", process_factory=None):
+        self.name = name
+        self.method = method
+        self.match_cgroup = match_cgroup
+        self.match_parent = match_parent
+        self.full_scan_every = full_scan_every
+        self.proc_root = proc_root
+        self.process_factory = process_factory or psutil.Process
+        self.known = set()     # every PID present at the last scan, matching or not
+        self.matches = {}      # pid -> psutil.Process handle of a matching process
+        self.recheck = set()   # PIDs first seen last scan; a fresh fork may exec ffmpeg right after
+        self.since_full = None   # scans since the last full pass; None until the first scan
+        self.exec_listener = None
+        if method in ("auto", "netlink"):
+            try:
+                self.exec_listener = ExecListener()
+                logging.info("Process discovery: netlink proc connector")
+            except OSError as e:
+                logging.info(f"Process discovery: netlink unavailable ({e}), using /proc diff")
+
+    def _read(self, pid, name):
+        with open(f"{self.proc_root}/{pid}/{name}") as f:
+            return f.read()
+
+    def _is_match(self, pid):
+        try:
+            if self._read(pid, "comm").strip() != self.name:
+                return False
+            if self.match_cgroup and self.match_cgroup not in self._read(pid, "cgroup"):
+                return False
+            if self.match_parent:
+                ppid = self._read(pid, "stat").rsplit(")", 1)[1].split()[1]
+                if self._read(ppid, "comm").strip() != self.match_parent:
+                    return False
+            return True
+        except (OSError, IndexError):
+            return False
+
+    def _add(self, pid):
+        try:
+            self.matches[pid] = self.process_factory(pid)
+        except psutil.Error:
+            pass
+
+    def _legacy_scan(self):
+        self.matches = {}
+        for proc in psutil.process_iter(['name']):
+            if proc.info['name'] == self.name and (not (self.match_cgroup or self.match_parent) or self._is_match(proc.pid)):
+                self.matches[proc.pid] = proc
+        return self.matches
+
+    def scan(self):
+        """Return {pid: psutil.Process} for every matching process currently running"""
+        if self.method == "scan":
+            return self._legacy_scan()
+        execs = self.exec_listener.drain() if self.exec_listener else set()
+        first = self.since_full is None
+        self.since_full = (self.since_full or 0) + 1
+        full = first or execs is None or (self.full_scan_every and self.since_full >= self.full_scan_every)
+        if full: self.since_full = 0
+        if self.exec_listener and not full:
+            # Event driven: only PIDs that exec'd are candidates, exits are checked on the matches alone
+            for pid in [p for p in self.matches if not os.path.exists(f"{self.proc_root}/{p}")]:
+                del self.matches[pid]
+            for pid in execs:
+                if pid not in self.matches and self._is_match(pid):
+                    self._add(pid)
+            return self.matches
+        pids = {int(n) for n in os.listdir(self.proc_root) if n.isdigit()}
+        for pid in self.known - pids:
+            self.matches.pop(pid, None)
+        new = pids - self.known
+        candidates = pids if full else new | (self.recheck & pids)
+        for pid in candidates:
+            if pid in self.matches:
+                continue
+            if self._is_match(pid):
+                self._add(pid)
+        # A fork seen before its exec is looked at once more on the next scan;
+        # anything slower is caught by the periodic full scan
+        self.recheck = set() if first else new
+        self.known = pids
+        return self.matches
+
+discovery = ProcessDiscovery(PROCESS_NAME, DISCOVERY_METHOD, MATCH_CGROUP, MATCH_PARENT, FULL_SCAN_EVERY)
+
+# --- Streaming Aggregates ---
+class QuantileSketch:
+    """Fixed-memory quantile estimate with bounded relative error (log-spaced buckets, DDSketch style)"""
+    def __init__(self, relative_accuracy=0.01, max_buckets=512):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.buckets = {}   # k -> count of values in (gamma^(k-1), gamma^k]
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+            return
+        k = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[k] = self.buckets.get(k, 0) + 1
+        if len(self.buckets) > self.max_buckets:
+            # Collapse the two lowest buckets; accuracy is only lost at the bottom of the range
+            lowest = sorted(self.buckets)[:2]
+            self.buckets[lowest[1]] += self.buckets.pop(lowest[0])
+
+    def quantile(self, q):
+        if not self.count: return 0.0
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen: return 0.0
+        for k in sorted(self.buckets):
+            seen += self.buckets[k]
+            if seen > rank:
+                return 2 * self.gamma ** k / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def to_dict(self):
+        return {"gamma": self.gamma, "max_buckets": self.max_buckets, "zeros": self.zeros, "count": self.count,
+                "buckets": {str(k): v for k, v in self.buckets.items()}}
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(max_buckets=d["max_buckets"])
+        sketch.gamma = d["gamma"]
+        sketch.log_gamma = math.log(sketch.gamma)
+        sketch.zeros, sketch.count = d["zeros"], d["count"]
+        sketch.buckets = {int(k): v for k, v in d["buckets"].items()}
+        return sketch
+
+class StreamingStats:
+    """Count, mean, min, max and variance (Welford) plus a quantile sketch, in constant memory"""
+    def __init__(self):
+        self.count = 0
+        self.mean = self.m2 = 0.0
+        self.min = self.max = None
+        self.sketch = QuantileSketch()
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.sketch.add(value)
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def to_dict(self):
+        return {"count": self.count, "mean": self.mean, "m2": self.m2, "min": self.min, "max": self.max,
+                "sketch": self.sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls()
+        stats.count, stats.mean, stats.m2, stats.min, stats.max = d["count"], d["mean"], d["m2"], d["min"], d["max"]
+        stats.sketch = QuantileSketch.from_dict(d["sketch"])
+        return stats
+
+    def summary(self, prefix, unit):
+        return {
+            f"{prefix}_avg_{unit}": self.mean, f"{prefix}_min_{unit}": self.min or 0,
+            f"{prefix}_max_{unit}": self.max or 0, f"{prefix}_stddev_{unit}": self.stddev,
+            f"{prefix}_p50_{unit}": self.sketch.quantile(0.50),
+            f"{prefix}_p95_{unit}": self.sketch.quantile(0.95),
+            f"{prefix}_p99_{unit}": self.sketch.quantile(0.99)
+        }
+
 # --- Metrics Collector ---
+GPU_PROC_FIELDS = (("gpu_mem_mb", "gpu_mem", "mb"), ("gpu_sm_percent", "gpu_sm", "percent"),
+                   ("gpu_enc_percent", "gpu_enc", "percent"), ("gpu_dec_percent", "gpu_dec", "percent"))
+
+def record_gpu_sample(stats, gpu):
+    agg = stats.setdefault("gpu", {})
+    agg["gpu_index"] = gpu["gpu_index"]
+    for field, prefix, _ in GPU_PROC_FIELDS:
+        if gpu.get(field) is not None:
+            agg.setdefault(prefix, StreamingStats()).add(gpu[field])
+
+def gpu_summary(stats):
+    agg = stats.get("gpu")
+    if not agg: return {}
+    out = {"gpu_index": agg["gpu_index"]}
+    for _, prefix, unit in GPU_PROC_FIELDS:
+        if prefix in agg:
+            out[f"{prefix}_avg_{unit}"] = agg[prefix].mean
+            out[f"{prefix}_max_{unit}"] = agg[prefix].max
+    return out
+
+def adapt_sampling(stats, cpu, mem, now):
+    """Schedule the next sample of a TID and say whether this one is sent: "change", "heartbeat" or None"""
+    last = stats.get("last_sent")
+    changed = (last is None or abs(cpu - last["cpu"]) >= SAMPLE_CPU_DELTA
+               or abs(mem - last["ram"]) >= SAMPLE_RAM_DELTA)
+    # Sample at INTERVAL while a process is new or swinging, back off towards max_interval while steady
+    interval = stats.get("sample_interval", INTERVAL)
+    stats["sample_interval"] = INTERVAL if changed else min(interval * SAMPLE_BACKOFF, SAMPLE_MAX_INTERVAL)
+    stats["next_sample"] = now + stats["sample_interval"]
+    if changed:
+        stats["last_sent"] = {"cpu": cpu, "ram": mem, "time": now}
+        return "change"
+    if now - last["time"] >= HEARTBEAT_INTERVAL:
+        last["time"] = now
+        return "heartbeat"
+    return None
+
+def sample_process(proc):
+    """CPU, RSS and I/O of one process, with the /proc reads batched by oneshot()"""
+    with proc.oneshot():
+        return proc.cpu_percent(interval=None), proc.memory_info().rss / (1024*1024), proc.io_counters()
+
+def send_summary(pid, tid, stats):
+    end_time = datetime.datetime.now(tz)
+    send_to_graylog({
+        "timestamp": end_time.isoformat(),
+        "source": SOURCE_NAME,
+        "pid": pid, "tid": tid,
+        "command": stats.get("command"),
+        "event": "summary",
+        "duration_sec": (end_time - stats["start_time"]).total_seconds(),
+        "samples": stats["cpu"].count,
+        **stats["cpu"].summary("cpu", "percent"),
+        **stats["ram"].summary("ram", "mb"),
+        **gpu_summary(stats),
+        "bytes_read_total": stats.get("last_read_bytes",0),
+        "bytes_written_total": stats.get("last_write_bytes",0)
+    })
+
 def collect_metrics():
     global tracking_map, stats_map
     current_pids = set()
-    for proc in psutil.process_iter(['pid','name','cmdline']):
-        if proc.info['name'] == "ffmpeg":
-            pid = proc.pid
-            current_pids.add(pid)
-            if pid not in tracking_map:
-                tid = str(uuid.uuid4())
-                tracking_map[pid] = tid
-                stats_map[tid] = {
-                    "pid": pid, "command": " ".join(proc.info['cmdline']),
-                    "start_time": datetime.datetime.now(tz),
-                    "cpu_samples": [], "ram_samples": [],
-                    "last_read_bytes": 0, "last_write_bytes": 0
-                }
-                logging.info(f"New FFmpeg PID={pid}, TID={tid}")
-                if USE_STDERR: start_stderr_thread(pid, tid)
-
-            tid = tracking_map[pid]
-            stats = stats_map[tid]
+    for pid, proc in list(discovery.scan().items()):
+        current_pids.add(pid)
+        if pid not in tracking_map:
             try:
-                cpu = proc.cpu_percent(interval=None)
-                mem = proc.memory_info().rss / (1024*1024)
-                io  = proc.io_counters()
-                stats["cpu_samples"].append(cpu)
-                stats["ram_samples"].append(mem)
-                stats["last_read_bytes"] = io.read_bytes
-                stats["last_write_bytes"] = io.write_bytes
-                send_to_graylog({
-                    "timestamp": datetime.datetime.now(tz).isoformat(),
-                    "source": SOURCE_NAME,
-                    "pid": pid, "tid": tid,
-                    "command": stats["command"],
-                    "cpu_percent": cpu, "ram_mb": mem,
-                    "read_bytes": io.read_bytes,
-                    "write_bytes": io.write_bytes
-                })
-            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                cmdline = proc.cmdline()
+            except psutil.Error:
+                continue
+            tid = str(uuid.uuid4())
+            tracking_map[pid] = tid
+            proc_handles[tid] = proc
+            stats_map[tid] = {
+                "pid": pid, "command": " ".join(cmdline),
+                "start_time": datetime.datetime.now(tz),
+                "cpu": StreamingStats(), "ram": StreamingStats(),
+                "last_read_bytes": 0, "last_write_bytes": 0
+            }
+            logging.info(f"New FFmpeg PID={pid}, TID={tid}")
+            if USE_STDERR: stderr_mux.add(pid, tid)
+            try:
+                # The first cpu_percent() call only sets the baseline, real samples start next interval
+                proc.cpu_percent(interval=None)
+            except psutil.Error:
                 pass
+            continue
+
+        tid = tracking_map[pid]
+        stats = stats_map[tid]
+        now = time.monotonic()
+        if SAMPLING_MODE == "adaptive" and now < stats.get("next_sample", 0):
+            continue
+        try:
+            cpu, mem, io = sample_process(proc_handles[tid])
+            stats["cpu"].add(cpu)
+            stats["ram"].add(mem)
+            stats["last_read_bytes"] = io.read_bytes
+            stats["last_write_bytes"] = io.write_bytes
+            gpu = gpu_sample_for(pid) if USE_GPU else None
+            if gpu:
+                record_gpu_sample(stats, gpu)
+            reason = adapt_sampling(stats, cpu, mem, now) if SAMPLING_MODE == "adaptive" else "interval"
+            if not reason:
+                continue
+            msg = {
+                "timestamp": now_iso(),
+                "source": SOURCE_NAME,
+                "pid": pid, "tid": tid,
+                "cpu_percent": cpu, "ram_mb": mem,
+                "read_bytes": io.read_bytes,
+                "write_bytes": io.write_bytes,
+                **(gpu or {})
+            }
+            if REPEAT_COMMAND or not stats.get("command_sent"):
+                msg["command"] = stats["command"]
+                stats["command_sent"] = True
+            if reason == "heartbeat":
+                msg["heartbeat"] = True
+            send_to_graylog(msg)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
 
     # Cleanup
     for pid in set(tracking_map.keys()) - current_pids:
         tid = tracking_map.pop(pid)
         stats = stats_map.pop(tid, {})
-        end_time = datetime.datetime.now(tz)
-        if stats:
-            send_to_graylog({
-                "timestamp": end_time.isoformat(),
-                "source": SOURCE_NAME,
-                "pid": pid, "tid": tid,
-                "command": stats.get("command"),
-                "event": "summary",
-                "duration_sec": (end_time - stats["start_time"]).total_seconds(),
-                "cpu_avg_percent": sum(stats["cpu_samples"])/len(stats["cpu_samples"]) if stats["cpu_samples"] else 0,
-                "cpu_max_percent": max(stats["cpu_samples"]) if stats["cpu_samples"] else 0,
-                "ram_max_mb": max(stats["ram_samples"]) if stats["ram_samples"] else 0,
-                "bytes_read_total": stats.get("last_read_bytes",0),
-                "bytes_written_total": stats.get("last_write_bytes",0)
-            })
-        # finalize issues for this PID
-        for iid, issue in list(issues_map.items()):
-            if issue["pid"] == pid and issue["tid"] == tid:
-                finalize_issue(iid)
+        proc_handles.pop(tid, None)
+        if stats: send_summary(pid, tid, stats)
+        # finalize the open issue for this PID, after the rest of its stderr has been read into it
+        if USE_STDERR:
+            stderr_mux.remove(pid, lambda pid=pid, tid=tid: finalize_process_issue(pid, tid))
+        else:
+            finalize_process_issue(pid, tid)
+
+# --- Metrics Endpoint ---
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass   # one line per scrape would drown the agent log
+
+def start_metrics_server():
+    try:
+        server = http.server.ThreadingHTTPServer((METRICS_LISTEN, METRICS_PORT), MetricsHandler)
+    except OSError as e:
+        logging.error(f"Metrics endpoint disabled, cannot listen on {METRICS_LISTEN}:{METRICS_PORT}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Serving metrics on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    return server
+
+def emit_agent_stats():
+    send_to_graylog({
+        "timestamp": now_iso(),
+        "source": SOURCE_NAME,
+        "event": "agent_stats",
+        "agent_version": AGENT_VERSION,
+        **metrics.event_fields()
+    })
+
+# --- Hot Reload ---
+# `systemctl reload` (ExecReload=kill -HUP) makes the agent write its state and unsent messages to
+# HANDOFF_FILE and exec the script on disk, usually just replaced by the updater; the new process
+# resumes from the file, so IDs, summaries and queued messages carry over instead of being reset.
+HANDOFF_VERSION = 1
+reload_requested = False
+stop_requested = False   # SIGTERM, as sent by `systemctl stop/restart`: same shutdown path as Ctrl-C
+signal_r, signal_w = os.pipe()
+os.set_blocking(signal_r, False)
+os.set_blocking(signal_w, False)
+
+def on_sighup(signum, frame):
+    global reload_requested
+    reload_requested = True
+
+def on_sigterm(signum, frame):
+    global stop_requested
+    stop_requested = True
+
+def install_signal_handlers():
+    signal.set_wakeup_fd(signal_w)   # wakes sleep_unless_signalled() as soon as the signal lands
+    signal.signal(signal.SIGHUP, on_sighup)
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+def sleep_unless_signalled(seconds):
+    """time.sleep() that returns early, True, once a reload or a stop has been requested"""
+    if not (reload_requested or stop_requested):
+        select.select([signal_r], [], [], seconds)
+        try: os.read(signal_r, 4096)
+        except BlockingIOError: pass
+    return reload_requested or stop_requested
+
+def boot_id():
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def read_handoff():
+    """State left by the previous process, or None; queued messages go straight back on the send queue"""
+    try:
+        with open(HANDOFF_FILE) as f:
+            payload = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable handoff {HANDOFF_FILE}: {e}")
+        payload = None
+    try: os.remove(HANDOFF_FILE)   # consumed once, a crash loop must not replay it
+    except OSError: pass
+    if not payload or payload.get("handoff_version") != HANDOFF_VERSION: return None
+    for data in payload["queued"]:
+        send_queue.put(base64.b64decode(data))
+    # Monotonic deadlines and PIDs only mean something within the same boot
+    if payload["boot_id"] != boot_id():
+        logging.warning(f"Handoff predates a reboot, kept {len(payload['queued'])} queued messages only")
+        return None
+    logging.info(f"Resuming from {payload['agent_version']} handoff with {len(payload['queued'])} queued messages")
+    return payload["state"]
+
+def hand_over(state):
+    """Write state and everything not yet sent to HANDOFF_FILE, then exec the script on disk in our place"""
+    stop_shipper_thread()
+    queued = send_queue.take_all()
+    transport.close()   # flushes what the shipper had already batched
+    if spool: spool.close()
+    try:
+        payload = {"handoff_version": HANDOFF_VERSION, "agent_version": AGENT_VERSION, "boot_id": boot_id(),
+                   "written": time.time(), "state": state,
+                   "queued": [base64.b64encode(data).decode("ascii") for data in queued]}
+        tmp = HANDOFF_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(payload, f)
+        os.replace(tmp, HANDOFF_FILE)
+    except (OSError, TypeError, ValueError) as e:
+        logging.error(f"Handoff to {HANDOFF_FILE} failed ({e}), sending queued messages and reloading cold")
+        for data in queued:
+            transport.send(data)
+        transport.close()
+    logging.info(f"Reloading {sys.argv[0]} ({len(queued)} queued messages handed over)")
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+def snapshot_state():
+    """Tracked processes, their running aggregates and open issues, as JSON-ready data"""
+    processes = []
+    for pid, tid in tracking_map.items():
+        stats = stats_map.get(tid)
+        if not stats: continue
+        try:
+            create_time = proc_handles[tid].create_time()
+        except (KeyError, psutil.Error):
+            create_time = None   # already gone: the next process sends its summary
+        entry = dict(stats, start_time=stats["start_time"].isoformat(),
+                     cpu=stats["cpu"].to_dict(), ram=stats["ram"].to_dict())
+        if "gpu" in stats:
+            entry["gpu"] = {k: v.to_dict() if isinstance(v, StreamingStats) else v for k, v in stats["gpu"].items()}
+        processes.append({"pid": pid, "tid": tid, "create_time": create_time, "stats": entry})
+    with issues_lock:
+        issues = [dict(issue, start_time=issue["start_time"].isoformat(), events=list(issue["events"]))
+                  for issue in issues_map.values()]
+    return {"processes": processes, "issues": issues,
+            "stderr": stderr_mux.snapshot() if USE_STDERR else []}
+
+def restore_state(state):
+    resume = {src["pid"]: src for src in state["stderr"]}
+    for entry in state["processes"]:
+        pid, tid, stats = entry["pid"], entry["tid"], entry["stats"]
+        stats.update(start_time=datetime.datetime.fromisoformat(stats["start_time"]),
+                     cpu=StreamingStats.from_dict(stats["cpu"]), ram=StreamingStats.from_dict(stats["ram"]))
+        if "gpu" in stats:
+            stats["gpu"] = {k: v if k == "gpu_index" else StreamingStats.from_dict(v) for k, v in stats["gpu"].items()}
+        try:
+            proc = psutil.Process(pid)
+            # Same PID is not enough: it may have been reused while we were reloading
+            alive = entry["create_time"] is not None and abs(proc.create_time() - entry["create_time"]) < 0.01
+            if alive: proc.cpu_percent(interval=None)
+        except psutil.Error:
+            alive = False
+        if not alive:
+            logging.info(f"FFmpeg PID={pid}, TID={tid} ended during reload, sending its summary")
+            send_summary(pid, tid, stats)
+            continue
+        tracking_map[pid] = tid
+        proc_handles[tid] = proc
+        stats_map[tid] = stats
+        if USE_STDERR: stderr_mux.add(pid, tid, resume.get(pid))
+    with issues_lock:
+        for issue in state["issues"]:
+            issue.update(start_time=datetime.datetime.fromisoformat(issue["start_time"]),
+                         events=collections.deque(issue["events"], maxlen=ISSUE_MAX_EVENTS))
+            issues_map[issue["iid"]] = issue
+            issue_index[(issue["pid"], issue["tid"])] = issue["iid"]
+    for iid in [iid for iid, issue in issues_map.items() if tracking_map.get(issue["pid"]) != issue["tid"]]:
+        finalize_issue(iid)
+    logging.info(f"Restored {len(tracking_map)} FFmpeg processes and {len(issues_map)} open issues")
 
 # --- Main ---
 if __name__ == "__main__":
     logging.info(f"Starting FFmpeg Monitor interval={INTERVAL}s Graylog={GRAYLOG_HOST}:{GRAYLOG_PORT} proto={PROTOCOL}")
+    install_signal_handlers()
+    state = read_handoff()
+    if state: restore_state(state)
+    start_shipper_thread()
+    if USE_STDERR: stderr_mux.start()
     if USE_GPU: start_gpu_thread()
+    if METRICS_ENABLED: start_metrics_server()
+    last_agent_stats = time.monotonic()
     try:
-        while True:
-            collect_metrics()
-            time.sleep(INTERVAL)
+        # Restored processes just got a fresh cpu_percent baseline, their next sample is one interval away
+        if not (state and sleep_unless_signalled(INTERVAL)):
+            while True:
+                start = time.monotonic()
+                collect_metrics()
+                collect_latency.observe(time.monotonic() - start)
+                if USE_ISSUES: emit_issue_progress()
+                if METRICS_INTERVAL and time.monotonic() - last_agent_stats >= METRICS_INTERVAL:
+                    last_agent_stats = time.monotonic()
+                    emit_agent_stats()
+                if sleep_unless_signalled(INTERVAL): break
     except KeyboardInterrupt:
         logging.info("Monitor stopped by user.")
+    finally:
+        if stop_requested and not reload_requested:
+            logging.info("Monitor stopped (SIGTERM), shipping queued messages")
+        if reload_requested:
+            if USE_STDERR: stderr_mux.stop()
+            hand_over(snapshot_state())
+        drain_sender()
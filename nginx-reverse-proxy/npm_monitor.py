@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
-import os, time, socket, json, datetime, pytz, configparser, logging, sys, uuid
+import os, re, time, signal, base64, heapq, bisect, fnmatch, zlib, gzip, socket, select, struct, collections, json, datetime, pytz, configparser, logging, sys, uuid, threading, http.server
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-CONFIG_FILE = "/etc/npm_monitor.conf"
-LOG_FILE = "/var/log/npm_monitor.log"
+CONFIG_FILE = os.environ.get("NPM_MONITOR_CONFIG", "/etc/npm_monitor.conf")
+LOG_FILE = os.environ.get("NPM_MONITOR_LOG", "/var/log/npm_monitor.log")
 AGENT_VERSION = "1.0.1"
 
 
@@ -23,133 +27,1756 @@ GRAYLOG_HOST = config.get("graylog", "host", fallback="127.0.0.1")
 GRAYLOG_PORT = config.getint("graylog", "port", fallback=5140)
 PROTOCOL = config.get("graylog", "protocol", fallback="tcp").lower()
 SOURCE_NAME = config.get("graylog", "source", fallback="NPM-Monitor")
+OUTPUT_FORMAT = config.get("graylog", "format", fallback="syslog").lower()
+COMPRESSION = config.get("graylog", "compression", fallback="none").lower()
+GELF_CHUNK_SIZE = config.getint("graylog", "gelf_chunk_size", fallback=1420)
+BATCH_MAX_BYTES = config.getint("graylog", "batch_max_bytes", fallback=65536)
+FLUSH_INTERVAL = config.getfloat("graylog", "flush_interval", fallback=1.0)
+RECONNECT_MAX = config.getfloat("graylog", "reconnect_max_backoff", fallback=30.0)
+CONNECT_TIMEOUT = config.getfloat("graylog", "connect_timeout", fallback=1.0)
+STATS_INTERVAL = config.getint("graylog", "stats_interval", fallback=60)
+QUEUE_SIZE = config.getint("graylog", "queue_size", fallback=10000)
+OVERFLOW_POLICY = config.get("graylog", "overflow_policy", fallback="drop_oldest").lower()
+METRICS_ENABLED = config.getboolean("metrics", "enabled", fallback=True)
+METRICS_LISTEN = config.get("metrics", "listen", fallback="127.0.0.1")
+METRICS_PORT = config.getint("metrics", "port", fallback=9722)
+METRICS_INTERVAL = config.getint("metrics", "stats_interval", fallback=60)
+METRICS_PREFIX = "npm_monitor"
 LOG_DIR = config.get("general", "log_dir", fallback="/var/log/npm")
+RECURSIVE = config.getboolean("general", "recursive", fallback=False)
+INCLUDE = config.get("general", "include", fallback="*.log").split()
+EXCLUDE = config.get("general", "exclude", fallback="").split()
+WATCH_MODE = config.get("general", "watch_mode", fallback="auto").lower()
+POLL_INTERVAL = config.getfloat("general", "poll_interval", fallback=1.0)
+CHECKPOINT_FILE = config.get("general", "checkpoint_file", fallback="/var/lib/npm_monitor/offsets.json")
+READ_CHUNK = config.getint("general", "read_chunk_kb", fallback=1024) * 1024
+HANDOFF_FILE = config.get("general", "handoff_file", fallback="/var/lib/npm_monitor/handoff.json")
+TAIL_WORKERS = config.getint("tailer", "workers", fallback=4)
+TAIL_SLICE = config.getint("tailer", "slice_kb", fallback=1024) * 1024
+TAIL_MAX_INFLIGHT = config.getint("tailer", "max_inflight_mb", fallback=16) * 1024 * 1024
 TIMEZONE = config.get("general", "timezone", fallback="UTC")
+SPOOL_ENABLED = config.getboolean("spool", "enabled", fallback=True)
+SPOOL_DIR = config.get("spool", "dir", fallback="/var/lib/npm_monitor/spool")
+SPOOL_MAX_MB = config.getint("spool", "max_mb", fallback=256)
+SPOOL_SEGMENT_MB = config.getint("spool", "segment_mb", fallback=8)
+SPOOL_REPLAY_RATE = config.getint("spool", "replay_rate", fallback=500)
+PROBLEM_STATUS = config.get("classification", "problem_status", fallback="500-599")
+SLOW_REQUEST_SEC = config.getfloat("classification", "slow_request_sec", fallback=0)
+AGGREGATE = config.getboolean("aggregation", "enabled", fallback=False)
+AGGREGATE_INTERVAL = config.getint("aggregation", "interval", fallback=60)
+SAMPLE_RATE = config.getfloat("aggregation", "sample_rate", fallback=0.01)
+LATENCY_BUCKETS_MS = config.get("aggregation", "latency_buckets_ms", fallback="5,10,25,50,100,250,500,1000,2500,5000,10000")
+ISSUE_TIMEOUT = config.getfloat("issues", "timeout", fallback=60)
+# [issue_timeouts] <proxy host id> = seconds, for hosts whose errors come in slower bursts
+ISSUE_TIMEOUTS = {k: float(v) for k, v in config.items("issue_timeouts")} if config.has_section("issue_timeouts") else {}
+ERROR_LEVELS = {l.strip().lower() for l in config.get("classification", "error_levels", fallback="warn,error,crit,alert,emerg").split(",") if l.strip()}
 
 try:
     tz = pytz.timezone(TIMEZONE)
 except Exception:
     tz = pytz.UTC
 
-# --- State tracking ---
-active_issues = {}  # proxy_host -> {"tid": str, "start": dt, "last_seen": dt, "count": int, "last_error": str}
+# --- Self Metrics ---
+LATENCY_BOUNDS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+class Counter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+class Histogram:
+    """Fixed buckets (seconds), cheap enough to observe on per-message paths"""
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation (the last bound for the overflow bucket)"""
+        counts, _, count = self.snapshot()
+        rank, seen = q * count, 0
+        for i, c in enumerate(counts):
+            seen += c
+            if c and seen >= rank:
+                return self.bounds[min(i, len(self.bounds) - 1)]
+        return 0.0
+
+class MetricsRegistry:
+    """Counters and histograms fed by the hot paths plus gauges read on demand, rendered in the Prometheus
+    text format for the local endpoint and flattened into the periodic agent_stats event"""
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.families = {}   # name -> {"type", "help", "children": {labels: Counter/Histogram} or "fn", "event"}
+
+    def _child(self, name, kind, help, labels, child):
+        family = self.families.setdefault(name, {"type": kind, "help": help, "children": {}, "event": True})
+        family["children"][tuple(labels.items())] = child
+        return child
+
+    def counter(self, name, help, **labels):
+        return self._child(name, "counter", help, labels, Counter())
+
+    def histogram(self, name, help, **labels):
+        return self._child(name, "histogram", help, labels, Histogram())
+
+    def gauge(self, name, help, fn, kind="gauge", event=True):
+        """fn returns a number, or {((label, value), ...): number} for a labelled family; kind="counter" for
+        totals the agent already keeps. event=False keeps high-cardinality families off agent_stats."""
+        self.families[name] = {"type": kind, "help": help, "fn": fn, "event": event}
+
+    def _samples(self, family):
+        if "fn" not in family:
+            return family["children"].items()
+        value = family["fn"]()
+        return value.items() if isinstance(value, dict) else [((), value)]
+
+    @staticmethod
+    def _labels(labels):
+        if not labels: return ""
+        escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+    def render(self):
+        out = []
+        for name, family in list(self.families.items()):
+            full = f"{self.prefix}_{name}"
+            try:
+                samples = list(self._samples(family))
+            except Exception as e:
+                logging.debug(f"Metric {full} unavailable: {e}")
+                continue
+            out.append(f"# HELP {full} {family['help']}")
+            out.append(f"# TYPE {full} {family['type']}")
+            for labels, value in samples:
+                if family["type"] != "histogram":
+                    out.append(f"{full}{self._labels(labels)} {getattr(value, 'value', value)}")
+                    continue
+                counts, total, count = value.snapshot()
+                cumulative = 0
+                for bound, c in zip(value.bounds + ["+Inf"], counts):
+                    cumulative += c
+                    out.append(f"{full}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+                out.append(f"{full}_sum{self._labels(labels)} {total}")
+                out.append(f"{full}_count{self._labels(labels)} {count}")
+        return "\n".join(out) + "\n"
+
+    def event_fields(self):
+        """Flat fields for agent_stats; histograms become count/avg/p50/p99 in milliseconds"""
+        fields = {}
+        for name, family in list(self.families.items()):
+            if not family["event"]: continue
+            try:
+                samples = list(self._samples(family))
+            except Exception:
+                continue
+            for labels, value in samples:
+                key = re.sub(r"\W", "_", "_".join([name] + [str(v) for _, v in labels]))
+                if family["type"] != "histogram":
+                    fields[key] = getattr(value, "value", value)
+                    continue
+                _, total, count = value.snapshot()
+                fields[f"{key}_count"] = count
+                fields[f"{key}_avg_ms"] = round(1000 * total / count, 3) if count else 0.0
+                fields[f"{key}_p50_ms"] = 1000 * value.quantile(0.5)
+                fields[f"{key}_p99_ms"] = 1000 * value.quantile(0.99)
+        return fields
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return 0
+
+metrics = MetricsRegistry(METRICS_PREFIX)
+metrics.gauge("process_cpu_seconds_total", "CPU time used by the agent", time.process_time, kind="counter")
+metrics.gauge("process_resident_memory_bytes", "Resident memory of the agent", rss_bytes)
+metrics.gauge("threads", "Live threads in the agent", threading.active_count)
+send_latency = metrics.histogram("send_seconds", "Time to write one batch to Graylog")
+queue_delay = metrics.histogram("queue_delay_seconds", "Time a message waited in the send queue")
+send_failures = metrics.counter("send_failures_total", "Batch writes to Graylog that failed")
+line_counters = {t: metrics.counter("lines_total", "Log lines processed", log_type=t) for t in ("access", "error")}
+problem_lines = metrics.counter("problem_lines_total", "Log lines classified as problems")
+tail_latency = metrics.histogram("tail_seconds", "Duration of one tailer turn on a file")
+
+# --- Graylog Transport ---
+class GraylogTransport:
+    """Long-lived Graylog connection that coalesces messages into batched writes"""
+    GELF_MAGIC = b"\x1e\x0f"
+    GELF_MAX_CHUNKS = 128
+
+    def __init__(self, host, port, protocol, batch_max_bytes=65536, flush_interval=1.0, backoff_max=30.0,
+                 gelf_chunk_size=None, connect_timeout=1.0):
+        self.addr = (host, port)
+        self.protocol = protocol
+        self.gelf_chunk_size = gelf_chunk_size   # set for GELF over UDP: split big datagrams into GELF chunks
+        self.batch_max_bytes = batch_max_bytes
+        self.flush_interval = flush_interval
+        self.backoff_max = backoff_max
+        # The shipper holds the lock while connecting: a black-holed Graylog must not stall it for long
+        self.connect_timeout = connect_timeout
+        self.lock = threading.Lock()
+        self.sock = None
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.buffer_started = 0.0
+        self.backoff = 0.0
+        self.next_connect = 0.0
+        self.connected_once = False
+        self.failing = False
+        self.on_failure = None   # called with an unsent batch; returns True if it was kept (spooled)
+        self.sent = self.dropped = self.reconnects = 0
+
+    def _connect(self):
+        if self.protocol == "tcp":
+            sock = socket.create_connection(self.addr, timeout=self.connect_timeout)
+            sock.settimeout(10)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.connected_once:
+            self.reconnects += 1
+            logging.info(f"Reconnected to Graylog {self.addr[0]}:{self.addr[1]}")
+        self.connected_once = True
+        self.failing = False
+        self.backoff = 0.0
+        self.sock = sock
+
+    def _peer_closed(self):
+        # Graylog never writes on a syslog/GELF input, so a readable socket means EOF or reset
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            return bool(readable) and not self.sock.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+    def _close(self):
+        if self.sock:
+            try: self.sock.close()
+            except OSError: pass
+        self.sock = None
+
+    def _disconnect(self):
+        self._close()
+        self.backoff = min(max(self.backoff * 2, 0.5), self.backoff_max)
+        self.next_connect = time.monotonic() + self.backoff
+
+    def _write(self, payload):
+        if self.sock and self.protocol == "tcp" and self._peer_closed():
+            self._close()
+        if not self.sock:
+            self._connect()
+        if self.protocol == "tcp":
+            self.sock.sendall(payload)
+        else:
+            self.sock.sendto(payload, self.addr)
+
+    def _datagrams(self, data):
+        size = self.gelf_chunk_size
+        if not size or len(data) <= size:
+            return [data]
+        body = size - 12   # magic(2) + message id(8) + sequence number(1) + sequence count(1)
+        count = -(-len(data) // body)
+        if count > self.GELF_MAX_CHUNKS:
+            logging.error(f"GELF message of {len(data)} bytes needs {count} chunks (max {self.GELF_MAX_CHUNKS}), dropped")
+            self.dropped += 1
+            return []
+        msg_id = os.urandom(8)
+        return [self.GELF_MAGIC + msg_id + bytes((i, count)) + data[i * body:(i + 1) * body] for i in range(count)]
+
+    def _write_batch(self, batch):
+        start = time.monotonic()
+        if self.protocol == "tcp":
+            self._write(b"".join(batch))
+            self.sent += len(batch)
+        else:
+            for data in batch:
+                dgrams = self._datagrams(data)
+                for dgram in dgrams: self._write(dgram)
+                if dgrams: self.sent += 1
+        send_latency.observe(time.monotonic() - start)
+
+    def _shed(self, batch, reason):
+        """Hand an unsent batch to on_failure (the spool), or count it as dropped"""
+        kept = bool(self.on_failure and self.on_failure(batch))
+        if not kept:
+            self.dropped += len(batch)
+        # Only the first failure of an outage is worth an error line
+        log = logging.debug if self.failing else logging.error
+        log(f"Graylog send failed ({len(batch)} messages {'spooled' if kept else 'dropped'}): {reason}")
+        self.failing = True
+
+    def _failed(self, batch, e):
+        # Only a real connect/send error grows the backoff
+        send_failures.inc()
+        self._disconnect()
+        self._shed(batch, e)
+
+    def _flush_locked(self):
+        if not self.buffer: return
+        batch, self.buffer, self.buffer_bytes = self.buffer, [], 0
+        if not self.available():
+            self._shed(batch, "reconnect backoff in effect")
+            return
+        try:
+            self._write_batch(batch)
+        except OSError as e:
+            self._failed(batch, e)
+
+    def available(self):
+        return self.sock is not None or time.monotonic() >= self.next_connect
+
+    def send_now(self, batch):
+        """Write a batch immediately; on failure return False and leave it to the caller"""
+        with self.lock:
+            self._flush_locked()
+            if not self.available(): return False
+            try:
+                self._write_batch(batch)
+                return True
+            except OSError as e:
+                send_failures.inc()
+                self._disconnect()
+                logging.debug(f"Graylog replay failed: {e}")
+                self.failing = True
+                return False
+
+    def send(self, data: bytes):
+        with self.lock:
+            if not self.buffer:
+                self.buffer_started = time.monotonic()
+            self.buffer.append(data)
+            self.buffer_bytes += len(data)
+            # UDP goes out one datagram per message, TCP waits for a full batch or the flush timer
+            if self.protocol != "tcp" or self.buffer_bytes >= self.batch_max_bytes:
+                self._flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self._flush_locked()
+
+    def due(self):
+        return bool(self.buffer) and time.monotonic() - self.buffer_started >= self.flush_interval
+
+    def stats(self):
+        return {"sent": self.sent, "dropped": self.dropped, "reconnects": self.reconnects}
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self._close()
+
+transport = GraylogTransport(GRAYLOG_HOST, GRAYLOG_PORT, PROTOCOL, BATCH_MAX_BYTES, FLUSH_INTERVAL, RECONNECT_MAX,
+                             GELF_CHUNK_SIZE if OUTPUT_FORMAT == "gelf" and PROTOCOL != "tcp" else None,
+                             connect_timeout=CONNECT_TIMEOUT)
+metrics.gauge("sent_total", "Messages written to Graylog", lambda: transport.sent, kind="counter")
+metrics.gauge("dropped_total", "Messages lost because Graylog was unreachable and the spool could not keep them",
+              lambda: transport.dropped, kind="counter")
+metrics.gauge("reconnects_total", "Reconnects to Graylog", lambda: transport.reconnects, kind="counter")
+
+# --- Disk Spool ---
+class DiskSpool:
+    """Append-only, segment-rotated on-disk buffer for messages Graylog could not take"""
+    HEADER = struct.Struct(">I")
+
+    def __init__(self, directory, max_bytes, segment_bytes):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.cursor_file = os.path.join(directory, "cursor.json")
+        self.segments = sorted(int(n[:-4]) for n in os.listdir(directory) if n.endswith(".seg") and n[:-4].isdigit())
+        self.sizes = {seg: os.path.getsize(self._path(seg)) for seg in self.segments}
+        # Segments left by a previous run are closed; new writes always start a fresh segment
+        self.write_seg = max(self.segments, default=-1) + 1
+        self.writer = None
+        self.read_seg, self.read_off = self._load_cursor()
+        for seg in [s for s in self.segments if s < self.read_seg]:
+            self._remove(seg)
+        if self.read_seg not in self.sizes:
+            self.read_seg, self.read_off = (self.segments[0] if self.segments else self.write_seg), 0
+        self.total_bytes = sum(self.sizes.values())
+        self.unread = self.total_bytes - self.read_off
+        self.spooled = self.replayed = self.dropped_bytes = 0
+        self.cursor_saved = time.monotonic()
+        if self.unread:
+            logging.info(f"Spool {directory} holds {self.unread} bytes to replay")
+
+    def _path(self, seg):
+        return os.path.join(self.directory, f"{seg:012d}.seg")
+
+    def _load_cursor(self):
+        try:
+            with open(self.cursor_file) as f:
+                cursor = json.load(f)
+            return int(cursor["segment"]), int(cursor["offset"])
+        except (OSError, ValueError, KeyError):
+            return 0, 0
+
+    def _save_cursor(self):
+        tmp = self.cursor_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"segment": self.read_seg, "offset": self.read_off}, f)
+        os.replace(tmp, self.cursor_file)
+        self.cursor_saved = time.monotonic()
+
+    def _remove(self, seg):
+        self.segments.remove(seg)
+        self.sizes.pop(seg, None)
+        try: os.remove(self._path(seg))
+        except OSError: pass
+
+    def _rotate(self):
+        if self.writer:
+            self.writer.close()
+            self.write_seg += 1
+        self.writer = open(self._path(self.write_seg), "ab")
+        self.segments.append(self.write_seg)
+        self.sizes[self.write_seg] = 0
+
+    def _enforce_cap(self):
+        while self.total_bytes > self.max_bytes and len(self.segments) > 1:
+            seg = self.segments[0]
+            size = self.sizes[seg]
+            lost = size - self.read_off if seg == self.read_seg else size
+            self._remove(seg)
+            self.total_bytes -= size
+            self.unread -= lost
+            self.dropped_bytes += lost
+            if seg == self.read_seg:
+                self.read_seg, self.read_off = self.segments[0], 0
+            logging.warning(f"Spool over {self.max_bytes} bytes, discarded oldest segment ({lost} unsent bytes)")
+
+    def append(self, batch):
+        data = b"".join(self.HEADER.pack(len(m)) + m for m in batch)
+        with self.lock:
+            try:
+                if self.writer is None or self.sizes[self.write_seg] >= self.segment_bytes:
+                    self._rotate()
+                self.writer.write(data)
+                self.writer.flush()
+            except OSError as e:
+                logging.error(f"Spool write failed: {e}")
+                return False
+            self.sizes[self.write_seg] += len(data)
+            self.total_bytes += len(data)
+            self.unread += len(data)
+            self.spooled += len(batch)
+            self._enforce_cap()
+            return True
+
+    def read(self, max_items):
+        """Return up to max_items spooled messages and the cursor just past them"""
+        records = []
+        with self.lock:
+            seg, off = self.read_seg, self.read_off
+            while len(records) < max_items and seg in self.sizes:
+                with open(self._path(seg), "rb") as f:
+                    f.seek(off)
+                    while len(records) < max_items:
+                        header = f.read(self.HEADER.size)
+                        if len(header) < self.HEADER.size: break
+                        size = self.HEADER.unpack(header)[0]
+                        payload = f.read(size)
+                        if len(payload) < size: break
+                        records.append(payload)
+                        off += self.HEADER.size + len(payload)
+                if len(records) >= max_items or seg == self.write_seg:
+                    break
+                # End of a closed segment (a torn tail from a crash is skipped too)
+                idx = self.segments.index(seg) + 1
+                if idx >= len(self.segments): break
+                seg, off = self.segments[idx], 0
+        return records, (seg, off)
+
+    def commit(self, cursor, count):
+        with self.lock:
+            seg, off = cursor
+            if seg not in self.sizes: return   # discarded by the size cap meanwhile
+            for old in [s for s in self.segments if s < seg]:
+                self.total_bytes -= self.sizes[old]
+                self._remove(old)
+            self.read_seg, self.read_off = seg, off
+            self.unread = self.total_bytes - off
+            self.replayed += count
+            if self.unread == 0 and seg != self.write_seg:
+                # Fully replayed segment from an earlier run
+                self.total_bytes -= self.sizes[seg]
+                self._remove(seg)
+                self.read_seg, self.read_off = self.write_seg, 0
+            if time.monotonic() - self.cursor_saved >= 1:
+                self._save_cursor()
+
+    def stats(self):
+        return {"spool_bytes": self.unread, "spooled": self.spooled,
+                "replayed": self.replayed, "spool_dropped_bytes": self.dropped_bytes}
+
+    def close(self):
+        with self.lock:
+            if self.writer:
+                self.writer.close()
+                self.writer = None
+            self._save_cursor()
+
+spool = None
+if SPOOL_ENABLED:
+    try:
+        spool = DiskSpool(SPOOL_DIR, SPOOL_MAX_MB * 1024 * 1024, SPOOL_SEGMENT_MB * 1024 * 1024)
+    except OSError as e:
+        logging.error(f"Spool disabled, cannot use {SPOOL_DIR}: {e}")
+if spool:
+    transport.on_failure = spool.append
+    metrics.gauge("spool_bytes", "Spooled bytes not yet replayed", lambda: spool.unread)
+    metrics.gauge("spooled_total", "Messages written to the spool", lambda: spool.spooled, kind="counter")
+
+# --- Send Queue ---
+class SendQueue:
+    """Bounded queue between the hot paths and the Graylog shipper thread"""
+    def __init__(self, maxsize=10000, policy="drop_oldest"):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = collections.deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.enqueued = self.dequeued = self.dropped = 0
+        self._reset_window()
+
+    def _reset_window(self):
+        self.max_depth = 0
+        self.enqueue_wait_sum = self.enqueue_wait_max = 0.0
+        self.queue_delay_sum = self.queue_delay_max = 0.0
+        self.window_enqueued = self.window_dequeued = 0
+
+    def put(self, data):
+        start = time.monotonic()
+        with self.lock:
+            if len(self.items) >= self.maxsize:
+                if self.policy == "drop_newest":
+                    self.dropped += 1
+                    return False
+                if self.policy == "block":
+                    while len(self.items) >= self.maxsize:
+                        self.not_full.wait()
+                else:
+                    self.items.popleft()
+                    self.dropped += 1
+            now = time.monotonic()
+            self.items.append((now, data))
+            self.enqueued += 1
+            self.window_enqueued += 1
+            self.max_depth = max(self.max_depth, len(self.items))
+            wait = now - start
+            self.enqueue_wait_sum += wait
+            self.enqueue_wait_max = max(self.enqueue_wait_max, wait)
+            self.not_empty.notify()
+        return True
+
+    def get_batch(self, max_items, timeout):
+        with self.lock:
+            if not self.items:
+                self.not_empty.wait(timeout)
+            batch = []
+            now = time.monotonic()
+            while self.items and len(batch) < max_items:
+                queued_at, data = self.items.popleft()
+                delay = now - queued_at
+                queue_delay.observe(delay)
+                self.queue_delay_sum += delay
+                self.queue_delay_max = max(self.queue_delay_max, delay)
+                batch.append(data)
+            self.dequeued += len(batch)
+            self.window_dequeued += len(batch)
+            if batch:
+                self.not_full.notify_all()
+            return batch
+
+    def take_all(self):
+        """Remove and return everything queued, oldest first"""
+        with self.lock:
+            items, self.items = self.items, collections.deque()
+            self.dequeued += len(items)
+            self.not_full.notify_all()
+        return [data for _, data in items]
+
+    def stats(self, reset=True):
+        with self.lock:
+            s = {
+                "depth": len(self.items), "max_depth": self.max_depth,
+                "enqueued": self.enqueued, "dequeued": self.dequeued, "dropped": self.dropped,
+                "enqueue_wait_avg_ms": 1000 * self.enqueue_wait_sum / self.window_enqueued if self.window_enqueued else 0.0,
+                "enqueue_wait_max_ms": 1000 * self.enqueue_wait_max,
+                "queue_delay_avg_ms": 1000 * self.queue_delay_sum / self.window_dequeued if self.window_dequeued else 0.0,
+                "queue_delay_max_ms": 1000 * self.queue_delay_max
+            }
+            if reset: self._reset_window()
+            return s
+
+send_queue = SendQueue(QUEUE_SIZE, OVERFLOW_POLICY)
+metrics.gauge("messages_total", "Messages handed to the send queue", lambda: send_queue.enqueued, kind="counter")
+metrics.gauge("queue_depth", "Messages waiting in the send queue", lambda: len(send_queue.items))
+metrics.gauge("queue_dropped_total", "Messages dropped by the send queue overflow policy", lambda: send_queue.dropped,
+              kind="counter")
+
+def replay_spool(budget):
+    """Replay up to budget spooled messages; live traffic always goes first"""
+    if len(send_queue.items) >= 1024: return 0
+    records, cursor = spool.read(budget)
+    if records and transport.send_now(records):
+        spool.commit(cursor, len(records))
+        return len(records)
+    return 0
+
+shipper_stop = threading.Event()
+shipper_thread = None
+
+def shipper_loop():
+    last_stats = last_refill = time.monotonic()
+    replay_tokens = 0.0
+    while not shipper_stop.is_set():
+        replaying = spool is not None and spool.unread > 0 and transport.available()
+        timeout = FLUSH_INTERVAL
+        if transport.buffer:
+            timeout = max(transport.buffer_started + FLUSH_INTERVAL - time.monotonic(), 0)
+        if replaying:
+            timeout = min(timeout, 0.1)
+        for data in send_queue.get_batch(1024, timeout):
+            transport.send(data)
+        if transport.due():
+            transport.flush()
+        now = time.monotonic()
+        if replaying:
+            replay_tokens = min(replay_tokens + (now - last_refill) * SPOOL_REPLAY_RATE, SPOOL_REPLAY_RATE)
+            if replay_tokens >= 1:
+                replay_tokens -= replay_spool(int(replay_tokens))
+        last_refill = now
+        if STATS_INTERVAL and now - last_stats >= STATS_INTERVAL:
+            last_stats = now
+            t, q = transport.stats(), send_queue.stats()
+            sp = spool.stats() if spool else {}
+            logging.info(f"Graylog transport: sent={t['sent']} dropped={t['dropped']} reconnects={t['reconnects']} "
+                         f"queue_depth={q['depth']} queue_max_depth={q['max_depth']} queue_dropped={q['dropped']} "
+                         f"enqueue_wait_avg={q['enqueue_wait_avg_ms']:.2f}ms enqueue_wait_max={q['enqueue_wait_max_ms']:.2f}ms "
+                         f"queue_delay_avg={q['queue_delay_avg_ms']:.2f}ms queue_delay_max={q['queue_delay_max_ms']:.2f}ms"
+                         + "".join(f" {k}={v}" for k, v in sp.items()))
+
+def start_shipper_thread():
+    global shipper_thread
+    shipper_thread = threading.Thread(target=shipper_loop, daemon=True)
+    shipper_thread.start()
+
+def stop_shipper_thread():
+    """Let the shipper finish its current batch and exit, leaving the queue to the caller"""
+    shipper_stop.set()
+    if shipper_thread: shipper_thread.join(timeout=FLUSH_INTERVAL + 5)
+
+def drain_sender():
+    """Ship everything still queued and close the connection"""
+    stop_shipper_thread()
+    while True:
+        batch = send_queue.get_batch(1024, 0)
+        if not batch: break
+        for data in batch:
+            transport.send(data)
+    transport.close()
+    if spool: spool.close()
+
+# --- Serialization ---
+if orjson:
+    def dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+else:
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+class Clock:
+    """Timestamp strings formatted once per wall-clock second and reused until the second changes"""
+    def __init__(self, tz, syslog_tag):
+        self.tz = tz
+        self.syslog_tag = syslog_tag
+        self.cached = (None, "", "", b"")   # (second, local iso up to seconds, utc offset, syslog header)
+
+    def _refresh(self, second):
+        local = datetime.datetime.fromtimestamp(second, self.tz).isoformat()
+        utc = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(second))
+        self.cached = (second, local[:19], local[19:], f"<134>{utc} {self.syslog_tag}: ".encode("utf-8"))
+        return self.cached
+
+    def now_iso(self):
+        now = time.time()
+        second = int(now)
+        cached = self.cached
+        if cached[0] != second: cached = self._refresh(second)
+        micros = int((now - second) * 1000000)
+        # Same shape as datetime.isoformat(): microseconds only when non-zero
+        return f"{cached[1]}.{micros:06d}{cached[2]}" if micros else cached[1] + cached[2]
+
+    def syslog_header(self):
+        second = int(time.time())
+        cached = self.cached
+        if cached[0] != second: cached = self._refresh(second)
+        return cached[3]
+
+clock = Clock(tz, f"{SOURCE_NAME} npm-monitor")
+now_iso = clock.now_iso
+
+# --- Wire Formats ---
+def encode_syslog(message):
+    return clock.syslog_header() + dumps(message) + b"\n"
+
+def encode_gelf(message):
+    gelf = {
+        "version": "1.1",
+        "host": SOURCE_NAME,
+        "short_message": message.get("message") or message.get("event") or "npm-monitor",
+        "timestamp": time.time(),
+        "level": 3 if message.get("log_type") == "error" else 6,
+        "_agent": "npm-monitor"
+    }
+    for key, value in message.items():
+        if key in ("source", "message"): continue
+        # GELF additional fields must be strings or numbers; nested data travels as JSON text
+        if value is not None and not isinstance(value, (str, int, float)):
+            value = dumps(value).decode("utf-8")
+        gelf["_local_time" if key == "timestamp" else f"_{key}"] = value
+    payload = dumps(gelf)
+    if PROTOCOL == "tcp":
+        return payload + b"\0"   # GELF TCP frames are null-terminated and cannot be compressed
+    if COMPRESSION == "zlib":
+        return zlib.compress(payload)
+    if COMPRESSION == "gzip":
+        return gzip.compress(payload)
+    return payload
+
+encode_message = encode_gelf if OUTPUT_FORMAT == "gelf" else encode_syslog
 
 # --- Syslog Sender ---
 def send_to_graylog(message: dict):
     try:
-        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-        pri = "<134>"
-        syslog_msg = f"{pri}{timestamp} {SOURCE_NAME} npm-monitor: {json.dumps(message)}\n"
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM if PROTOCOL == "tcp" else socket.SOCK_DGRAM)
-        if PROTOCOL == "tcp":
-            sock.connect((GRAYLOG_HOST, GRAYLOG_PORT))
-            sock.sendall(syslog_msg.encode("utf-8"))
-        else:
-            sock.sendto(syslog_msg.encode("utf-8"), (GRAYLOG_HOST, GRAYLOG_PORT))
-        sock.close()
+        send_queue.put(encode_message(message))
     except Exception as e:
         logging.error(f"Error sending log: {e}")
 
+# --- Log Parsing ---
+# NPM proxy-host format, optionally followed by $request_time:
+# [$time_local] $upstream_cache_status $upstream_status $status - $request_method $scheme $host "$request_uri"
+#   [Client $remote_addr] [Length $body_bytes_sent] [Gzip $gzip_ratio] [Sent-to $server] "$http_user_agent" "$http_referer"
+# The "standard" format (default/dead hosts, fallback) has no cache/upstream status and no [Sent-to].
+ACCESS_RE = re.compile(
+    r'\[(?P<time_local>[^\]]+)\] (?:(?P<cache_status>\S+) (?P<upstream_status>\S+(?:, \S+)*) )?(?P<status>\d{3}) - '
+    r'(?P<method>\S+) (?P<scheme>\S+) (?P<host>\S+) "(?P<uri>[^"]*)" \[Client (?P<client_ip>[^\]]+)\] '
+    r'\[Length (?P<bytes_sent>\d+)\] \[Gzip (?P<gzip_ratio>[^\]]+)\](?: \[Sent-to (?P<upstream>[^\]]+)\])? '
+    r'"(?P<user_agent>[^"]*)" "(?P<referer>[^"]*)"(?: (?P<request_time>\d+(?:\.\d+)?))?\s*$'
+)
+# nginx error log: 2025/09/16 13:15:10 [error] 31#31: *4211 connect() failed ..., client: 1.2.3.4, server: x,
+#   request: "GET / HTTP/1.1", upstream: "http://...", host: "x"
+ERROR_RE = re.compile(
+    r'(?P<time_local>\d{4}/\d\d/\d\d \d\d:\d\d:\d\d) \[(?P<level>\w+)\] (?P<nginx_pid>\d+)#\d+: '
+    r'(?:\*(?P<connection_id>\d+) )?(?P<error>.*?)(?:, client: (?P<client_ip>[^,]+))?(?:, server: (?P<server>[^,]*))?'
+    r'(?:, request: "(?P<request>[^"]*)")?(?:, upstream: "(?P<upstream>[^"]*)")?(?:, host: "(?P<host>[^"]*)")?'
+    r'(?:, referrer: "(?P<referer>[^"]*)")?\s*$'
+)
+
+# Groups that may be absent or logged as "-"; only these are checked so the hot path skips a full dict scan
+ACCESS_OPTIONAL = ("cache_status", "upstream_status", "gzip_ratio", "upstream", "user_agent", "referer", "request_time")
+ERROR_OPTIONAL = ("connection_id", "client_ip", "server", "request", "upstream", "host", "referer")
+
+def parse_access(line):
+    m = ACCESS_RE.match(line)
+    if not m: return None
+    fields = m.groupdict()
+    for key in ACCESS_OPTIONAL:
+        value = fields[key]
+        if value is None or value == "-": del fields[key]
+    fields["status"] = int(fields["status"])
+    fields["bytes_sent"] = int(fields["bytes_sent"])
+    if "request_time" in fields: fields["request_time"] = float(fields["request_time"])
+    return fields
+
+def parse_error(line):
+    m = ERROR_RE.match(line)
+    if not m: return None
+    fields = m.groupdict()
+    for key in ERROR_OPTIONAL:
+        if fields[key] is None: del fields[key]
+    if "request" in fields: fields["method"] = fields["request"].split(" ", 1)[0]
+    return fields
+
+def parse_line(log_type, line):
+    """Structured fields for an access or error log line, None if it does not match the NPM formats"""
+    return parse_access(line) if log_type == "access" else parse_error(line)
+
 # --- Problem Detection ---
-def is_problem(log_type, line):
-    if log_type == "error":
-        return True
-    if log_type == "access" and " 5" in line[:5]:  # crude HTTP 5xx detection
-        return True
-    return False
+def parse_status_ranges(spec):
+    """'500-599,429' -> set of status codes"""
+    statuses = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part: continue
+        lo, _, hi = part.partition("-")
+        statuses.update(range(int(lo), int(hi or lo) + 1))
+    return frozenset(statuses)
+
+PROBLEM_STATUSES = parse_status_ranges(PROBLEM_STATUS)
+
+def problem_reason(log_type, fields):
+    """Why a line counts towards an issue ("status", "latency", "level", "unparsed") or None"""
+    if log_type == "access":
+        if fields is None: return None
+        if fields["status"] in PROBLEM_STATUSES: return "status"
+        if SLOW_REQUEST_SEC and fields.get("request_time", 0) >= SLOW_REQUEST_SEC: return "latency"
+        return None
+    if fields is None: return "unparsed"   # error log lines we cannot parse still count, as before
+    return "level" if fields["level"] in ERROR_LEVELS else None
+
+# --- Log Selection ---
+class LogSelector:
+    """Decides once per path whether it is tailed and as what (log type, proxy host); later events are a dict lookup"""
+    PROXY_HOST_RE = re.compile(r"proxy-host-([^_/]+)_")
+    MAX_CACHE = 10000
+
+    def __init__(self, root, include, exclude, recursive):
+        self.root = os.path.abspath(root)
+        self.include = include
+        self.exclude = exclude
+        self.recursive = recursive
+        self.cache = {}   # path -> (log_type, proxy_host), or None when the path is not tailed
+
+    def classify(self, path):
+        try:
+            return self.cache[path]
+        except KeyError:
+            pass
+        rel = os.path.relpath(path, self.root)
+        name = os.path.basename(path)
+        info = None
+        if not rel.startswith("..") and (self.recursive or os.sep not in rel) \
+                and any(fnmatch.fnmatch(rel, g) or fnmatch.fnmatch(name, g) for g in self.include) \
+                and not any(fnmatch.fnmatch(rel, g) or fnmatch.fnmatch(name, g) for g in self.exclude):
+            m = self.PROXY_HOST_RE.search(name)
+            info = ("access" if "access" in name else "error", m.group(1) if m else None)
+        if len(self.cache) >= self.MAX_CACHE: self.cache.clear()   # rotated names pile up otherwise
+        self.cache[path] = info
+        return info
+
+    def scan(self):
+        """Paths of all currently selected logs under the root"""
+        if self.recursive:
+            walk = ((d, names) for d, _, names in os.walk(self.root))
+        else:
+            walk = [(self.root, [e.name for e in os.scandir(self.root) if e.is_file()])]
+        for directory, names in walk:
+            for name in names:
+                path = os.path.join(directory, name)
+                if self.classify(path): yield path
+
+selector = LogSelector(LOG_DIR, INCLUDE, EXCLUDE, RECURSIVE)
+
+# --- File Tailer ---
+class FileTailer:
+    """Reads only the bytes appended to each log since the last read, tracking offset and inode per file"""
+    MAX_LINE = 1024 * 1024
+
+    def __init__(self, checkpoint_file, chunk_size=1024 * 1024):
+        self.checkpoint_file = checkpoint_file
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.files = {}   # path -> {"inode": int, "offset": int}
+        self.handles = {}   # path -> file object open on the inode in self.files
+        self.partial = {}   # path -> bytes of the unterminated last line, re-read until its newline arrives
+        self.dirty = False
+        try:
+            with open(checkpoint_file) as f:
+                self.files = {path: {"inode": int(st["inode"]), "offset": int(st["offset"])}
+                              for path, st in json.load(f).items()}
+            logging.info(f"Resuming {len(self.files)} log offsets from {checkpoint_file}")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            logging.warning(f"Ignoring unreadable checkpoint {checkpoint_file}: {e}")
+
+    def prime(self, paths):
+        """Start logs that already exist without a checkpoint at their end instead of replaying history"""
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            with self.lock:
+                state = self.files.get(path)
+                if not state or state["inode"] != st.st_ino:
+                    self.files[path] = {"inode": st.st_ino, "offset": st.st_size}
+                    self.dirty = True
+
+    def _open(self, path):
+        """Open path and match it to its saved offset; a different inode means that offset belongs to a file
+        that is no longer there"""
+        f = open(path, "rb")
+        st = os.fstat(f.fileno())
+        with self.lock:
+            state = self.files.get(path)
+            if state is None or state["inode"] != st.st_ino:
+                if state: logging.info(f"{path} rotated, reading new file from start")
+                state = self.files[path] = {"inode": st.st_ino, "offset": 0}
+                self.partial.pop(path, None)
+                self.dirty = True
+            self.handles[path] = f
+        return f, state
+
+    def _close(self, path):
+        with self.lock:
+            f = self.handles.pop(path, None)
+        if f: f.close()
+
+    def iter_new_lines(self, path, max_bytes=None):
+        """Yield complete lines appended since the last call; a partial trailing line waits for its newline.
+        With max_bytes, stop after roughly that much so other files get a turn. The file stays open between
+        calls, so once logrotate renames it the rest of the old inode is still read before the new file.
+        Returns the bytes consumed, i.e. how far the offset moved."""
+        with self.lock:
+            f, state = self.handles.get(path), self.files.get(path)
+        if f is not None and (state is None or os.fstat(f.fileno()).st_ino != state["inode"]):
+            self._close(path)   # offset was reset by prime()
+            f = None
+        if f is None:
+            f, state = self._open(path)
+        if os.fstat(f.fileno()).st_size < state["offset"]:
+            logging.info(f"{path} truncated, reading from start")
+            with self.lock:
+                state["offset"] = 0
+                self.partial.pop(path, None)
+        # nginx keeps appending to the renamed file until it reopens its logs, and only then writes to the new one
+        try:
+            current = os.stat(path)
+            moved = current.st_ino != state["inode"] and current.st_size > 0
+        except FileNotFoundError:
+            moved = True
+        offset = start = state["offset"]
+        f.seek(offset)
+        carry = b""
+        eof = False
+        # Past the budget, only keep reading to finish a line longer than the budget itself
+        while max_bytes is None or offset - start + len(carry) < max_bytes or (carry and offset == start):
+            chunk = f.read(self.chunk_size)
+            if not chunk:
+                eof = True
+                break
+            data = carry + chunk if carry else chunk
+            cut = data.rfind(b"\n") + 1
+            if not cut and len(data) < self.MAX_LINE:
+                carry = data
+                continue
+            if not cut: cut = len(data)   # runaway line without newline, emit what we have
+            carry = data[cut:]
+            offset += cut
+            with self.lock:
+                state["offset"] = offset
+                self.dirty = True
+            yield from data[:cut].decode(errors="ignore").splitlines()
+        with self.lock:
+            self.partial[path] = len(carry)
+        if moved and eof:
+            # The old file is finished: its unterminated last line will not get a newline any more
+            if carry:
+                yield carry.decode(errors="ignore")
+                offset += len(carry)
+            self._close(path)
+            with self.lock:
+                self.files.pop(path, None)
+                self.partial.pop(path, None)
+                self.dirty = True
+            if os.path.exists(path):
+                logging.info(f"{path} rotated, old file drained, reading new file from start")
+                budget = None if max_bytes is None else max(max_bytes - (offset - start), 0)
+                return offset - start + (yield from self.iter_new_lines(path, budget))
+        return offset - start
+
+    def lag(self, path):
+        """Bytes written to path that have not been read yet, including the rest of a rotated file; an
+        unterminated last line does not count until its newline arrives"""
+        with self.lock:
+            state, f, partial = self.files.get(path), self.handles.get(path), self.partial.get(path, 0)
+        held = None
+        if state and f is not None:
+            try:
+                held = os.fstat(f.fileno())
+            except (OSError, ValueError):   # closed by the worker reading it
+                pass
+        try:
+            current = os.stat(path)
+        except OSError:
+            current = None
+        if state is None:
+            return current.st_size if current else 0
+        tracked = held if held and held.st_ino == state["inode"] else \
+            current if current and current.st_ino == state["inode"] else None
+        unread = max(tracked.st_size - state["offset"] - partial, 0) if tracked else 0
+        if current and current.st_ino != state["inode"]:
+            unread += current.st_size
+        return unread
+
+    def save(self):
+        with self.lock:
+            # A deleted (not renamed) file has nothing left to drain; holding it open would pin its disk space
+            deleted = [p for p, f in self.handles.items() if not os.path.exists(p) and os.fstat(f.fileno()).st_nlink == 0]
+            for path in deleted:
+                self.handles.pop(path).close()
+                self.partial.pop(path, None)
+            if not self.dirty: return
+            self.files = {p: st for p, st in self.files.items() if p in self.handles or os.path.exists(p)}
+            snapshot = json.dumps(self.files)
+            self.dirty = False
+        try:
+            tmp = self.checkpoint_file + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(snapshot)
+            os.replace(tmp, self.checkpoint_file)
+        except OSError as e:
+            logging.error(f"Failed to write checkpoint {self.checkpoint_file}: {e}")
+
+tailer = FileTailer(CHECKPOINT_FILE, READ_CHUNK)
+
+# --- Access Aggregation ---
+class AccessAggregator:
+    """Rolls parsed access lines into per-(proxy host, status class) summaries for each interval"""
+    def __init__(self, interval, buckets_ms):
+        self.interval = interval
+        self.bounds = sorted(buckets_ms)
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.window_start = time.time() // interval * interval
+
+    def add(self, proxy_host, fields):
+        key = (proxy_host, fields["status"] // 100)
+        request_time = fields.get("request_time")
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = {"count": 0, "bytes": 0, "timed": 0, "latency_sum": 0.0, "latency_max": 0.0,
+                                            "buckets": [0] * (len(self.bounds) + 1)}
+            group["count"] += 1
+            group["bytes"] += fields["bytes_sent"]
+            if request_time is not None:
+                ms = request_time * 1000
+                group["timed"] += 1
+                group["latency_sum"] += ms
+                if ms > group["latency_max"]: group["latency_max"] = ms
+                group["buckets"][bisect.bisect_left(self.bounds, ms)] += 1
+
+    def due(self, now=None):
+        return (now or time.time()) >= self.window_start + self.interval
+
+    def percentile(self, group, q):
+        """Linear interpolation inside the histogram bucket holding the q-th request"""
+        rank = q * group["timed"]
+        seen = 0
+        for i, count in enumerate(group["buckets"]):
+            if count and seen + count >= rank:
+                if i == len(self.bounds): return group["latency_max"]   # overflow bucket has no upper bound
+                lower = self.bounds[i - 1] if i else 0.0
+                upper = min(self.bounds[i], group["latency_max"])
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return 0.0
+
+    def flush(self):
+        """Summary messages for the finished interval; the next interval starts empty"""
+        with self.lock:
+            groups, self.groups = self.groups, {}
+            window_start = self.window_start
+            self.window_start = time.time() // self.interval * self.interval
+        labels = [f"le_{b:g}" for b in self.bounds] + ["le_inf"]
+        summaries = []
+        for (proxy_host, status_class), group in groups.items():
+            summary = {
+                "timestamp": now_iso(),
+                "source": SOURCE_NAME,
+                "event": "access_summary",
+                "proxy_host": proxy_host,
+                "tid": issues.tid(proxy_host),
+                "status_class": f"{status_class}xx",
+                "interval_start": datetime.datetime.fromtimestamp(window_start, tz).isoformat(),
+                "interval_sec": self.interval,
+                "count": group["count"],
+                "bytes_sent": group["bytes"]
+            }
+            if group["timed"]:
+                summary.update({
+                    "latency_avg_ms": group["latency_sum"] / group["timed"],
+                    "latency_max_ms": group["latency_max"],
+                    "latency_p50_ms": self.percentile(group, 0.50),
+                    "latency_p95_ms": self.percentile(group, 0.95),
+                    "latency_p99_ms": self.percentile(group, 0.99),
+                    "latency_histogram_ms": dict(zip(labels, group["buckets"]))
+                })
+            summaries.append(summary)
+        return summaries
+
+    def snapshot(self):
+        with self.lock:
+            return {"bounds": self.bounds, "window_start": self.window_start,
+                    "groups": [[ph, status_class, group] for (ph, status_class), group in self.groups.items()]}
+
+    def restore(self, snapshot):
+        """Continue the interval in progress; with different buckets configured, send it as it was instead"""
+        if snapshot["bounds"] != self.bounds:
+            previous = AccessAggregator(self.interval, snapshot["bounds"])
+            previous.restore(snapshot)
+            for summary in previous.flush():
+                send_to_graylog(summary)
+            return
+        with self.lock:
+            self.window_start = snapshot["window_start"]
+            self.groups = {(ph, status_class): group for ph, status_class, group in snapshot["groups"]}
+
+aggregator = AccessAggregator(AGGREGATE_INTERVAL, [float(b) for b in LATENCY_BUCKETS_MS.split(",") if b.strip()]) if AGGREGATE else None
+SAMPLE_THRESHOLD = int(SAMPLE_RATE * 2 ** 32)
+
+def sampled(line):
+    """Deterministic: the same line is kept or dropped the same way on every agent and every run"""
+    return zlib.crc32(line.encode("utf-8", "ignore")) < SAMPLE_THRESHOLD
+
+def flush_aggregates(force=False):
+    if aggregator and (force or aggregator.due()):
+        for summary in aggregator.flush():
+            send_to_graylog(summary)
+
+# --- Line Processing ---
+def process_line(path, log_type, proxy_host, line):
+    line = line.strip()
+    if not line: return
+    line_counters[log_type].inc()
+    fields = parse_line(log_type, line)
+    reason = problem_reason(log_type, fields)
+    sample = False
+    if aggregator and fields and log_type == "access":
+        aggregator.add(proxy_host, fields)
+        # Problem lines still go out verbatim; everything else is covered by the summary and a sample
+        if not reason:
+            if not sampled(line): return
+            sample = True
+
+    msg = {
+        "timestamp": now_iso(),
+        "source": SOURCE_NAME,
+        "log_type": log_type,
+        "proxy_host": proxy_host,
+        "file": os.path.basename(path),
+        "message": line
+    }
+    if fields: msg.update(fields)
+    if sample: msg["sample_rate"] = SAMPLE_RATE
+
+    if reason:
+        problem_lines.inc()
+        msg["problem"] = reason
+        tid, new = issues.record(proxy_host, line)
+        msg["tid"] = tid
+        if new:
+            logging.info(f"New issue detected proxy={proxy_host}, TID={tid}")
+            msg["event"] = "issue_start"
+    else:
+        msg["tid"] = issues.tid(proxy_host)
+
+    send_to_graylog(msg)
+
+def tail_file(path, max_bytes=None):
+    """Process the lines appended to path; returns the bytes consumed"""
+    info = selector.classify(path)
+    if info is None:
+        return 0
+    log_type, proxy_host = info
+
+    lines = tailer.iter_new_lines(path, max_bytes)
+    try:
+        while True:
+            process_line(path, log_type, proxy_host, next(lines))
+    except StopIteration as done:
+        return done.value
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.error(f"Failed to read {path}: {e}")
+    return 0
+
+# --- Tailer Pool ---
+class TailerPool:
+    """Worker threads that tail files concurrently: one read per file at a time however many events arrive,
+    round-robin turns of at most slice_bytes, and a cap on bytes read but not yet processed across workers"""
+    def __init__(self, workers, slice_bytes, max_inflight_bytes):
+        self.workers = workers
+        self.slice_bytes = slice_bytes
+        self.max_inflight = max_inflight_bytes
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.budget = threading.Condition(self.lock)
+        self.queue = collections.deque()   # paths waiting for a turn, oldest first
+        self.queued = set()
+        self.running = set()
+        self.rerun = set()                 # modified while a worker was reading it
+        self.behind_since = {}             # path -> monotonic time of the first unread event
+        self.inflight = 0
+        self.stopping = False
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"tailer-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def schedule(self, path):
+        if selector.classify(path) is None: return
+        with self.lock:
+            self.behind_since.setdefault(path, time.monotonic())
+            if path in self.running:
+                self.rerun.add(path)
+            elif path not in self.queued:
+                self.queued.add(path)
+                self.queue.append(path)
+                self.ready.notify()
+
+    def _reserve(self, path):
+        want = min(tailer.lag(path), self.slice_bytes)
+        with self.lock:
+            # A lone reader always proceeds so one turn larger than the cap cannot stall the pool
+            while self.inflight and self.inflight + want > self.max_inflight and not self.stopping:
+                self.budget.wait(1.0)
+            self.inflight += want
+        return want
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                while not self.queue and not self.stopping:
+                    self.ready.wait()
+                if not self.queue: return
+                path = self.queue.popleft()
+                self.queued.discard(path)
+                self.running.add(path)
+            reserved = self._reserve(path)
+            start = time.monotonic()
+            consumed = 0
+            try:
+                consumed = tail_file(path, self.slice_bytes)
+            finally:
+                tail_latency.observe(time.monotonic() - start)
+                # Complete lines left behind after progress mean the turn ran out of slice. A turn that made no
+                # progress (only an unterminated line, or the file cannot be opened) waits for the next event.
+                remaining = tailer.lag(path) if consumed else 0
+                with self.lock:
+                    self.inflight -= reserved
+                    self.budget.notify_all()
+                    self.running.discard(path)
+                    more = path in self.rerun or remaining > 0
+                    self.rerun.discard(path)
+                    if more and os.path.exists(path):
+                        # Back of the line: a busy file gets another slice only after every other waiting file
+                        self.queued.add(path)
+                        self.queue.append(path)
+                        self.ready.notify()
+                    else:
+                        self.behind_since.pop(path, None)
+
+    def stats(self):
+        """Per-file lag for files with unread data, largest first"""
+        now = time.monotonic()
+        with self.lock:
+            behind = dict(self.behind_since)
+            depth, inflight = len(self.queue), self.inflight
+        lag = []
+        for path, since in behind.items():
+            lag.append({"file": os.path.basename(path), "lag_bytes": tailer.lag(path), "lag_sec": round(now - since, 3)})
+        lag.sort(key=lambda f: (f["lag_bytes"], f["lag_sec"]), reverse=True)
+        return {"queued": depth, "inflight_bytes": inflight, "files": lag}
+
+    def stop(self, timeout=5.0):
+        """Let workers finish what is queued (up to timeout), then stop them"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if not self.queue and not self.running: break
+            time.sleep(0.05)
+        with self.lock:
+            self.stopping = True
+            self.queue.clear()
+            self.ready.notify_all()
+            self.budget.notify_all()
+        for t in self.threads:
+            t.join(timeout=1.0)
+
+pool = TailerPool(TAIL_WORKERS, TAIL_SLICE, TAIL_MAX_INFLIGHT)
+metrics.gauge("tail_queue", "Files waiting for a tailer turn", lambda: len(pool.queue))
+metrics.gauge("tail_inflight_bytes", "Bytes reserved by tailer workers", lambda: pool.inflight)
+metrics.gauge("tail_lag_bytes", "Unread bytes per lagging log file",
+              lambda: {(("file", f["file"]),): f["lag_bytes"] for f in pool.stats()["files"]}, event=False)
+metrics.gauge("tail_lag_seconds", "Seconds since the oldest unread change per lagging log file",
+              lambda: {(("file", f["file"]),): f["lag_sec"] for f in pool.stats()["files"]}, event=False)
+metrics.gauge("tail_lag_bytes_max", "Largest unread backlog of any log file",
+              lambda: max((f["lag_bytes"] for f in pool.stats()["files"]), default=0))
+metrics.gauge("tail_lag_seconds_max", "Longest time any log file has been behind",
+              lambda: max((f["lag_sec"] for f in pool.stats()["files"]), default=0))
+metrics.gauge("lagging_files", "Log files with unread data", lambda: len(pool.stats()["files"]))
+
+def log_tailer_stats():
+    st = pool.stats()
+    lagging = ", ".join(f"{f['file']}={f['lag_bytes']}B/{f['lag_sec']}s" for f in st["files"][:5])
+    logging.info(f"Tailer: queued={st['queued']} inflight_bytes={st['inflight_bytes']} lagging_files={len(st['files'])}"
+                 + (f" top: {lagging}" if lagging else ""))
 
 # --- Watchdog Handler ---
 class LogHandler(FileSystemEventHandler):
+    def __init__(self):
+        self.events = 0   # any event at all proves inotify sees writes on this mount
+
+    def on_any_event(self, event):
+        self.events += 1
+
     def on_modified(self, event):
-        if event.is_directory or not event.src_path.endswith(".log"):
+        if event.is_directory:
             return
+        pool.schedule(event.src_path)
+
+    on_created = on_modified
 
-        log_type = "access" if "access" in event.src_path else "error"
-        proxy_host = None
-        if "proxy-host" in event.src_path:
+    def on_moved(self, event):
+        if event.is_directory:
+            return
+        pool.schedule(event.dest_path)
+
+# --- Polling Watcher ---
+class LogPoller:
+    """Stat-based watcher for mounts where inotify sees nothing (network filesystems, some Docker bind mounts):
+    one stat per selected file per interval, and a directory is only re-listed when its mtime changes"""
+    def __init__(self, selector, interval, on_change):
+        self.selector = selector
+        self.interval = interval
+        self.on_change = on_change
+        self.dirs = {selector.root: None}   # directory -> st_mtime_ns at the last listing
+        self.files = {}                     # path -> (inode, size, mtime_ns) at the last poll
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _list(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            if self.dirs.get(directory) == mtime: return
+            self.dirs[directory] = mtime
+            for entry in os.scandir(directory):
+                if entry.is_dir(follow_symlinks=False):
+                    if self.selector.recursive: self.dirs.setdefault(entry.path, None)
+                elif entry.path not in self.files and self.selector.classify(entry.path):
+                    self.files[entry.path] = None
+        except FileNotFoundError:
+            if directory != self.selector.root: self.dirs.pop(directory, None)
+        except OSError as e:
+            logging.error(f"Failed to list {directory}: {e}")
+
+    def poll_once(self):
+        listed = set()
+        while len(listed) < len(self.dirs):   # subdirectories found while listing are listed in the same poll
+            for directory in [d for d in self.dirs if d not in listed]:
+                listed.add(directory)
+                self._list(directory)
+        for path, last in list(self.files.items()):
             try:
-                proxy_host = event.src_path.split("proxy-host-")[1].split("_")[0]
-            except Exception:
-                proxy_host = "unknown"
+                st = os.stat(path)
+            except OSError:
+                del self.files[path]
+                continue
+            sig = (st.st_ino, st.st_size, st.st_mtime_ns)
+            if sig != last:
+                self.files[path] = sig
+                self.on_change(path)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.poll_once()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="log-poller", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def join(self):
+        if self.thread: self.thread.join()
+
+class InotifyCheck(LogPoller):
+    """auto mode: polls next to inotify until inotify has reported anything. On Docker bind mounts and network
+    filesystems the watch is set up fine but no events ever arrive; when selected files grow for MISSES polls in
+    a row without a single event, this poller takes over scheduling reads."""
+    MISSES = 3
+
+    def __init__(self, selector, interval, on_change, handler):
+        super().__init__(selector, interval, self._changed)
+        self.schedule = on_change
+        self.handler = handler
+        self.primed = False   # the first poll only records where every file stands
+        self.grew = False
+        self.misses = 0
+        self.active = False
+
+    def _changed(self, path):
+        if self.active:
+            self.schedule(path)
+        else:
+            self.grew = True
+
+    def poll_once(self):
+        self.grew = False
+        super().poll_once()
+        if self.active: return
+        if self.handler.events:
+            logging.debug(f"inotify events arrive from {LOG_DIR}, stopping the polling check")
+            self.stop_event.set()
+            return
+        self.misses = self.misses + 1 if self.primed and self.grew else 0
+        self.primed = True
+        if self.misses >= self.MISSES:
+            self.active = True
+            logging.warning(f"Logs in {LOG_DIR} grew for {self.misses} polls without an inotify event (bind mount or "
+                            f"network filesystem?), polling every {self.interval}s instead; set watch_mode = poll "
+                            f"to skip the check")
+            for path in self.files:
+                self.schedule(path)
 
+def start_watcher():
+    """Watchers to stop at shutdown: inotify through watchdog (with a polling check in auto mode), or the stat
+    poller when configured or when inotify cannot be set up"""
+    if WATCH_MODE != "poll":
+        handler = LogHandler()
+        observer = Observer()
         try:
-            with open(event.src_path, "rb") as f:
-                f.seek(0, os.SEEK_END)
-                fsize = f.tell()
-                f.seek(max(fsize - 2048, 0), os.SEEK_SET)
-                lines = f.read().decode(errors="ignore").splitlines()[-5:]
-                for line in lines:
-                    msg = {
-                        "timestamp": datetime.datetime.now(tz).isoformat(),
-                        "source": SOURCE_NAME,
-                        "log_type": log_type,
-                        "proxy_host": proxy_host,
-                        "file": os.path.basename(event.src_path),
-                        "message": line.strip()
-                    }
-
-                    if is_problem(log_type, line):
-                        issue = active_issues.get(proxy_host)
-                        if not issue:
-                            tid = str(uuid.uuid4())
-                            active_issues[proxy_host] = {
-                                "tid": tid,
-                                "start": datetime.datetime.now(tz),
-                                "last_seen": datetime.datetime.now(tz),
-                                "count": 1,
-                                "last_error": line.strip()
-                            }
-                            logging.info(f"New issue detected proxy={proxy_host}, TID={tid}")
-                            msg["tid"] = tid
-                            msg["event"] = "issue_start"
-                        else:
-                            issue["last_seen"] = datetime.datetime.now(tz)
-                            issue["count"] += 1
-                            issue["last_error"] = line.strip()
-                            msg["tid"] = issue["tid"]
-                    else:
-                        msg["tid"] = active_issues.get(proxy_host, {}).get("tid")
-
-                    send_to_graylog(msg)
-
-        except Exception as e:
-            logging.error(f"Failed to read {event.src_path}: {e}")
-
-# --- Issue Cleanup ---
-def cleanup_issues(timeout=60):
-    now = datetime.datetime.now(tz)
-    expired = [ph for ph, issue in active_issues.items() if (now - issue["last_seen"]).total_seconds() > timeout]
-    for ph in expired:
-        issue = active_issues[ph]
-        summary = {
-            "timestamp": now.isoformat(),
-            "source": SOURCE_NAME,
-            "proxy_host": ph,
-            "tid": issue["tid"],
-            "event": "issue_summary",
-            "start_time": issue["start"].isoformat(),
-            "end_time": issue["last_seen"].isoformat(),
-            "duration_sec": (issue["last_seen"] - issue["start"]).total_seconds(),
-            "error_count": issue["count"],
-            "last_error": issue["last_error"]
-        }
-        logging.info(f"Issue resolved proxy={ph}, TID={issue['tid']}, duration={summary['duration_sec']}s")
-        send_to_graylog(summary)
-        del active_issues[ph]
+            observer.schedule(handler, LOG_DIR, recursive=RECURSIVE)
+            observer.start()
+        except OSError as e:
+            if WATCH_MODE == "inotify": raise
+            logging.warning(f"inotify watch on {LOG_DIR} failed ({e}), polling every {POLL_INTERVAL}s instead")
+        else:
+            if WATCH_MODE == "inotify": return [observer]
+            check = InotifyCheck(selector, POLL_INTERVAL, pool.schedule, handler)
+            check.start()
+            return [observer, check]
+    poller = LogPoller(selector, POLL_INTERVAL, pool.schedule)
+    poller.start()
+    return [poller]
+
+# --- Issue Tracking ---
+class IssueTracker:
+    """Active issue per proxy host. Expiry runs off a heap of deadlines on its own thread, so an issue is
+    finalized when its timeout passes rather than on the next sweep, at O(log n) per expiry."""
+    def __init__(self, default_timeout, timeouts, on_expire):
+        self.default_timeout = default_timeout
+        self.timeouts = timeouts
+        self.on_expire = on_expire
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.issues = {}   # proxy_host -> {"tid", "start", "last_seen", "last_mono", "count", "last_error"}
+        self.heap = []     # (deadline, seq, proxy_host); stale entries are re-checked when they surface
+        self.seq = 0
+        self.stopping = False
+        self.thread = None
+
+    def timeout_for(self, proxy_host):
+        return self.timeouts.get(proxy_host, self.default_timeout)
+
+    def _push(self, deadline, proxy_host):
+        self.seq += 1
+        heapq.heappush(self.heap, (deadline, self.seq, proxy_host))
+        if self.heap[0][1] == self.seq: self.wakeup.notify()   # new earliest deadline
+
+    def record(self, proxy_host, line):
+        """Count a problem line; returns (tid, True if this line opened the issue)"""
+        mono, now = time.monotonic(), datetime.datetime.now(tz)
+        with self.lock:
+            issue = self.issues.get(proxy_host)
+            if issue:
+                # Only last_seen moves; the heap entry is pushed back when its old deadline comes up
+                issue["last_seen"], issue["last_mono"] = now, mono
+                issue["count"] += 1
+                issue["last_error"] = line
+                return issue["tid"], False
+            tid = str(uuid.uuid4())
+            self.issues[proxy_host] = {"tid": tid, "start": now, "last_seen": now, "last_mono": mono,
+                                       "count": 1, "last_error": line}
+            self._push(mono + self.timeout_for(proxy_host), proxy_host)
+            return tid, True
+
+    def tid(self, proxy_host):
+        with self.lock:
+            issue = self.issues.get(proxy_host)
+            return issue["tid"] if issue else None
+
+    def _pop_expired(self, now):
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, proxy_host = heapq.heappop(self.heap)
+            issue = self.issues.get(proxy_host)
+            if issue is None: continue
+            deadline = issue["last_mono"] + self.timeout_for(proxy_host)
+            if deadline > now:
+                self._push(deadline, proxy_host)
+            else:
+                expired.append((proxy_host, self.issues.pop(proxy_host)))
+        return expired
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.stopping and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.wakeup.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                if self.stopping: return
+                expired = self._pop_expired(time.monotonic())
+            for proxy_host, issue in expired:
+                try:
+                    self.on_expire(proxy_host, issue)
+                except Exception as e:
+                    logging.error(f"Failed to finalize issue {issue['tid']}: {e}")
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="issue-expiry", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+            self.wakeup.notify()
+        if self.thread: self.thread.join(timeout=1.0)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.issues)
+
+    def snapshot(self):
+        with self.lock:
+            return [dict(issue, proxy_host=ph, start=issue["start"].isoformat(), last_seen=issue["last_seen"].isoformat())
+                    for ph, issue in self.issues.items()]
+
+    def restore(self, snapshot):
+        """Adopt issues from snapshot(); ones whose timeout passed during the reload expire right away"""
+        with self.lock:
+            for issue in snapshot:
+                ph = issue.pop("proxy_host")
+                issue.update(start=datetime.datetime.fromisoformat(issue["start"]),
+                             last_seen=datetime.datetime.fromisoformat(issue["last_seen"]))
+                self.issues[ph] = issue
+                self._push(issue["last_mono"] + self.timeout_for(ph), ph)
+
+def finalize_issue(ph, issue):
+    summary = {
+        "timestamp": now_iso(),
+        "source": SOURCE_NAME,
+        "proxy_host": ph,
+        "tid": issue["tid"],
+        "event": "issue_summary",
+        "start_time": issue["start"].isoformat(),
+        "end_time": issue["last_seen"].isoformat(),
+        "duration_sec": (issue["last_seen"] - issue["start"]).total_seconds(),
+        "error_count": issue["count"],
+        "last_error": issue["last_error"]
+    }
+    logging.info(f"Issue resolved proxy={ph}, TID={issue['tid']}, duration={summary['duration_sec']}s")
+    send_to_graylog(summary)
+
+issues = IssueTracker(ISSUE_TIMEOUT, ISSUE_TIMEOUTS, finalize_issue)
+metrics.gauge("open_issues", "Proxy hosts with an open issue (TID)", lambda: len(issues))
+
+# --- Metrics Endpoint ---
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass   # one line per scrape would drown the agent log
+
+def start_metrics_server():
+    try:
+        server = http.server.ThreadingHTTPServer((METRICS_LISTEN, METRICS_PORT), MetricsHandler)
+    except OSError as e:
+        logging.error(f"Metrics endpoint disabled, cannot listen on {METRICS_LISTEN}:{METRICS_PORT}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"Serving metrics on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+    return server
+
+def emit_agent_stats():
+    send_to_graylog({
+        "timestamp": now_iso(),
+        "source": SOURCE_NAME,
+        "event": "agent_stats",
+        "agent_version": AGENT_VERSION,
+        **metrics.event_fields()
+    })
+
+# --- Hot Reload ---
+# `systemctl reload` (ExecReload=kill -HUP) makes the agent write its state and unsent messages to
+# HANDOFF_FILE and exec the script on disk, usually just replaced by the updater; the new process
+# resumes from the file, so TIDs, interval aggregates and queued messages carry over instead of being reset.
+HANDOFF_VERSION = 1
+reload_requested = False
+stop_requested = False   # SIGTERM, as sent by `systemctl stop/restart`: same shutdown path as Ctrl-C
+signal_r, signal_w = os.pipe()
+os.set_blocking(signal_r, False)
+os.set_blocking(signal_w, False)
+
+def on_sighup(signum, frame):
+    global reload_requested
+    reload_requested = True
+
+def on_sigterm(signum, frame):
+    global stop_requested
+    stop_requested = True
+
+def install_signal_handlers():
+    signal.set_wakeup_fd(signal_w)   # wakes sleep_unless_signalled() as soon as the signal lands
+    signal.signal(signal.SIGHUP, on_sighup)
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+def sleep_unless_signalled(seconds):
+    """time.sleep() that returns early, True, once a reload or a stop has been requested"""
+    if not (reload_requested or stop_requested):
+        select.select([signal_r], [], [], seconds)
+        try: os.read(signal_r, 4096)
+        except BlockingIOError: pass
+    return reload_requested or stop_requested
+
+def boot_id():
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def read_handoff():
+    """State left by the previous process, or None; queued messages go straight back on the send queue"""
+    try:
+        with open(HANDOFF_FILE) as f:
+            payload = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable handoff {HANDOFF_FILE}: {e}")
+        payload = None
+    try: os.remove(HANDOFF_FILE)   # consumed once, a crash loop must not replay it
+    except OSError: pass
+    if not payload or payload.get("handoff_version") != HANDOFF_VERSION: return None
+    for data in payload["queued"]:
+        send_queue.put(base64.b64decode(data))
+    # Monotonic deadlines and PIDs only mean something within the same boot
+    if payload["boot_id"] != boot_id():
+        logging.warning(f"Handoff predates a reboot, kept {len(payload['queued'])} queued messages only")
+        return None
+    logging.info(f"Resuming from {payload['agent_version']} handoff with {len(payload['queued'])} queued messages")
+    return payload["state"]
+
+def hand_over(state):
+    """Write state and everything not yet sent to HANDOFF_FILE, then exec the script on disk in our place"""
+    stop_shipper_thread()
+    queued = send_queue.take_all()
+    transport.close()   # flushes what the shipper had already batched
+    if spool: spool.close()
+    try:
+        payload = {"handoff_version": HANDOFF_VERSION, "agent_version": AGENT_VERSION, "boot_id": boot_id(),
+                   "written": time.time(), "state": state,
+                   "queued": [base64.b64encode(data).decode("ascii") for data in queued]}
+        tmp = HANDOFF_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(payload, f)
+        os.replace(tmp, HANDOFF_FILE)
+    except (OSError, TypeError, ValueError) as e:
+        logging.error(f"Handoff to {HANDOFF_FILE} failed ({e}), sending queued messages and reloading cold")
+        for data in queued:
+            transport.send(data)
+        transport.close()
+    logging.info(f"Reloading {sys.argv[0]} ({len(queued)} queued messages handed over)")
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+def snapshot_state():
+    return {"issues": issues.snapshot(), "aggregation": aggregator.snapshot() if aggregator else None}
+
+def restore_state(state):
+    issues.restore(state["issues"])
+    if state["aggregation"]:
+        if aggregator:
+            aggregator.restore(state["aggregation"])
+        else:   # aggregation was switched off: send what the previous process had collected
+            previous = AccessAggregator(AGGREGATE_INTERVAL, state["aggregation"]["bounds"])
+            previous.restore(state["aggregation"])
+            for summary in previous.flush():
+                send_to_graylog(summary)
+    logging.info(f"Restored {len(issues)} open issues")
 
 # --- Main ---
 if __name__ == "__main__":
     logging.info(f"Starting NPM Monitor watching {LOG_DIR}, sending to {GRAYLOG_HOST}:{GRAYLOG_PORT}")
-    event_handler = LogHandler()
-    observer = Observer()
-    observer.schedule(event_handler, LOG_DIR, recursive=False)
-    observer.start()
+    install_signal_handlers()
+    state = read_handoff()
+    if state: restore_state(state)
+    start_shipper_thread()
+    issues.start()
+    paths = list(selector.scan())
+    tailer.prime(paths)
+    pool.start()
+    # Pick up whatever was appended while the agent was down; live events queue up behind it
+    for path in paths:
+        pool.schedule(path)
+    watchers = start_watcher()
+    if METRICS_ENABLED: start_metrics_server()
+    last_stats = last_agent_stats = time.monotonic()
     try:
         while True:
-            cleanup_issues()
-            time.sleep(5)
+            flush_aggregates()
+            tailer.save()
+            if STATS_INTERVAL and time.monotonic() - last_stats >= STATS_INTERVAL:
+                last_stats = time.monotonic()
+                log_tailer_stats()
+            if METRICS_INTERVAL and time.monotonic() - last_agent_stats >= METRICS_INTERVAL:
+                last_agent_stats = time.monotonic()
+                emit_agent_stats()
+            if sleep_unless_signalled(5): break
     except KeyboardInterrupt:
-        observer.stop()
         logging.info("NPM Monitor stopped")
-    observer.join()
+    if stop_requested and not reload_requested:
+        logging.info("NPM Monitor stopped (SIGTERM), shipping queued messages")
+    for watcher in watchers: watcher.stop()
+    for watcher in watchers: watcher.join()
+    pool.stop()
+    issues.stop()
+    if reload_requested:
+        tailer.save()   # offsets already live in the checkpoint file, the handoff carries the rest
+        hand_over(snapshot_state())
+    flush_aggregates(force=True)
+    tailer.save()
+    drain_sender()